@@ -1,17 +1,26 @@
-from fastapi import FastAPI, Depends, HTTPException, Query
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from config.settings import settings
+import asyncio
+import json
 import logging
-from sqlalchemy.orm import Session
-from core.database import get_db
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from core.database import async_engine, get_async_db
+from core import metrics, outbox, rollups, tracking, webhooks
+from core.redis_client import get_async_redis
+from core.segments import SegmentRuleError, compile_rules
+from core.templates import TemplateError, compile_template
 from core.models import (
     Notification, Subscription, NotificationAction, 
     NotificationSchedule, NotificationTracking, NotificationSegment,
     Template, Campaign, WebhookEvent, CampaignSegment
 )
-from workers.tasks import process_notification, process_webhook_event
+from workers.celery_worker import queue_for_priority
+from workers.tasks import process_notification
 from typing import List, Dict, Any, Optional  # Add Optional here
-from datetime import datetime
+from datetime import datetime, timezone
 from pydantic import BaseModel
 from api.schemas import (
     NotificationCreate, NotificationResponse,
@@ -20,7 +29,7 @@ from api.schemas import (
     CDPProfileSync, DashboardMetrics, SegmentPerformance,
     TemplateCreate, TemplateResponse,
     CampaignCreate, CampaignResponse,
-    AnalyticsResponse, CampaignAnalytics
+    AnalyticsResponse, CampaignAnalytics, CampaignStatus, NotificationType
 )
 from api.services import analytics, segment_service, cdp_service
 
@@ -45,30 +54,25 @@ async def startup_event():
         from core.database import init_db
         logger.info("Initializing database...")
         init_db()
+        app.state.cdp_coalescer = asyncio.create_task(cdp_service.coalescer.run())
+        # Loaded before serving, so the first events are routed to every webhook
+        registry = webhooks.get_registry()
+        registry.reload()
+        app.state.webhook_registry = asyncio.create_task(registry.listen())
         logger.info("✅ Application startup complete")
     except Exception as e:
         logger.error(f"❌ Startup failed: {str(e)}")
         raise
 
-class NotificationCreate(BaseModel):
-    title: str
-    body: str
-    icon: str = None
-    data: dict = None
-
-class NotificationResponse(BaseModel):
-    id: int
-    title: str
-    body: str
-    icon: str = None
-    data: dict = None
-    created_at: datetime
-
-    class Config:
-        orm_mode = True
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.webhook_registry.cancel()
+    # Write profile updates still waiting in the coalescing window
+    app.state.cdp_coalescer.cancel()
+    await cdp_service.coalescer.flush()
 
 @app.post("/notifications/", response_model=NotificationResponse)
-async def create_notification(notification: NotificationCreate, db: Session = Depends(get_db)):
+async def create_notification(notification: NotificationCreate, db: AsyncSession = Depends(get_async_db)):
     db_notification = Notification(
         title=notification.title,
         body=notification.body,
@@ -80,11 +84,29 @@ async def create_notification(notification: NotificationCreate, db: Session = De
         ttl=notification.ttl,
         require_interaction=notification.require_interaction,
         variant_id=notification.variant_id,
-        ab_test_group=notification.ab_test_group
+        ab_test_group=notification.ab_test_group,
+        # Set up front so the response never lazy-loads them
+        schedule=None,
+        tracking=None,
+        actions=[],
+        segments=[]
     )
     
+    deferred = False
     if notification.schedule:
         db_notification.schedule = NotificationSchedule(**notification.schedule.dict())
+        send_at = notification.schedule.send_at
+        if send_at is not None and send_at.tzinfo is not None:
+            # Schedules are stored as naive UTC like every other timestamp
+            send_at = send_at.astimezone(timezone.utc).replace(tzinfo=None)
+            db_notification.schedule.send_at = send_at
+        deferred = (
+            notification.schedule.type == NotificationType.time_based
+            and send_at is not None
+            and send_at > datetime.utcnow()
+        )
+        if not deferred:
+            db_notification.schedule.dispatched_at = datetime.utcnow()
     
     if notification.tracking:
         db_notification.tracking = NotificationTracking(**notification.tracking.dict())
@@ -96,28 +118,59 @@ async def create_notification(notification: NotificationCreate, db: Session = De
         ]
     
     if notification.segments:
+        try:
+            for segment in notification.segments:
+                compile_rules(segment.conditions.dict())
+        except SegmentRuleError as e:
+            raise HTTPException(status_code=422, detail=f"Invalid segment rules: {str(e)}")
         db_notification.segments = [
-            NotificationSegment(**segment.dict())
+            NotificationSegment(segment_name=segment.name, targeting_rules=segment.conditions.dict())
             for segment in notification.segments
         ]
 
     db.add(db_notification)
-    db.commit()
-    db.refresh(db_notification)
+    await db.flush()
     
-    # Queue notification for processing
-    process_notification.delay(db_notification.id)
+    # Queue notification for processing on the queue matching its priority,
+    # through the outbox so it is queued if and only if it is saved; future
+    # time-based schedules are dispatched by workers.scheduler
+    if not deferred:
+        outbox.enqueue(
+            db, process_notification, (db_notification.id,),
+            queue=queue_for_priority(db_notification.priority)
+        )
+    await db.commit()
     
     return db_notification
 
+def _notifications_query():
+    """Notifications with every relationship the response includes"""
+    return select(Notification).options(
+        selectinload(Notification.schedule),
+        selectinload(Notification.tracking),
+        selectinload(Notification.actions),
+        selectinload(Notification.segments)
+    )
+
 @app.get("/notifications/", response_model=List[NotificationResponse])
-def get_notifications(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    notifications = db.query(Notification).offset(skip).limit(limit).all()
+async def get_notifications(
+    skip: int = 0,
+    limit: int = 100,
+    after_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """List notifications; pass the last seen id as after_id for keyset paging"""
+    query = _notifications_query().order_by(Notification.id)
+    if after_id is not None:
+        query = query.where(Notification.id > after_id)
+    elif skip:
+        query = query.offset(skip)
+    notifications = (await db.scalars(query.limit(limit))).all()
     return notifications
 
 @app.get("/notifications/{notification_id}", response_model=NotificationResponse)
-def get_notification(notification_id: int, db: Session = Depends(get_db)):
-    notification = db.query(Notification).filter(Notification.id == notification_id).first()
+async def get_notification(notification_id: int, db: AsyncSession = Depends(get_async_db)):
+    notification = await db.scalar(_notifications_query().where(Notification.id == notification_id))
     if notification is None:
         raise HTTPException(status_code=404, detail="Notification not found")
     return notification
@@ -126,9 +179,9 @@ def get_notification(notification_id: int, db: Session = Depends(get_db)):
 async def health_check():
     try:
         # Add more comprehensive health checks
-        from core.database import engine
         # Test DB
-        engine.connect()
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
         # Test Redis if needed
         # Test RabbitMQ if needed
         return {
@@ -143,13 +196,23 @@ async def health_check():
             detail={"status": "unhealthy", "error": str(e)}
         )
 
+@app.get("/metrics")
+async def get_metrics():
+    """Counters and gauges recorded by the API and worker processes"""
+    # The metrics store is read with the blocking Redis client
+    return await asyncio.to_thread(metrics.snapshot)
+
 # Update template endpoints
 @app.post("/api/templates", response_model=TemplateResponse)  # Note: removed trailing slash
-async def create_template(template: TemplateCreate, db: Session = Depends(get_db)):
+async def create_template(template: TemplateCreate, db: AsyncSession = Depends(get_async_db)):
+    try:
+        compile_template(template.title_template, template.body_template, template.variables)
+    except TemplateError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     db_template = Template(**template.dict())
     db.add(db_template)
-    db.commit()
-    db.refresh(db_template)
+    await db.commit()
+    await db.refresh(db_template)
     return db_template
 
 # Template endpoints
@@ -158,19 +221,24 @@ async def get_templates(
     skip: int = 0, 
     limit: int = 100, 
     category: Optional[str] = None,
-    db: Session = Depends(get_db)
+    after_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Get all templates with optional category filter"""
-    query = db.query(Template)
+    """Get all templates with optional category filter and keyset paging via after_id"""
+    query = select(Template).order_by(Template.id)
     if category:
-        query = query.filter(Template.category == category)
-    templates = query.offset(skip).limit(limit).all()
+        query = query.where(Template.category == category)
+    if after_id is not None:
+        query = query.where(Template.id > after_id)
+    elif skip:
+        query = query.offset(skip)
+    templates = (await db.scalars(query.limit(limit))).all()
     return templates
 
 @app.get("/api/templates/{template_id}", response_model=TemplateResponse)
-async def get_template(template_id: int, db: Session = Depends(get_db)):
+async def get_template(template_id: int, db: AsyncSession = Depends(get_async_db)):
     """Get template by ID"""
-    template = db.query(Template).filter(Template.id == template_id).first()
+    template = await db.get(Template, template_id)
     if not template:
         raise HTTPException(
             status_code=404,
@@ -179,16 +247,16 @@ async def get_template(template_id: int, db: Session = Depends(get_db)):
     return template
 
 @app.get("/api/campaigns/{campaign_id}/template", response_model=TemplateResponse)
-async def get_campaign_template(campaign_id: int, db: Session = Depends(get_db)):
+async def get_campaign_template(campaign_id: int, db: AsyncSession = Depends(get_async_db)):
     """Get template associated with a campaign"""
-    campaign = db.query(Campaign).filter(Campaign.id == campaign_id).first()
+    campaign = await db.get(Campaign, campaign_id)
     if not campaign:
         raise HTTPException(
             status_code=404,
             detail=f"Campaign with id {campaign_id} not found"
         )
     
-    template = db.query(Template).filter(Template.id == campaign.template_id).first()
+    template = await db.get(Template, campaign.template_id) if campaign.template_id is not None else None
     if not template:
         raise HTTPException(
             status_code=404,
@@ -198,10 +266,10 @@ async def get_campaign_template(campaign_id: int, db: Session = Depends(get_db))
 
 # Update campaign endpoints
 @app.post("/api/campaigns", response_model=CampaignResponse)
-async def create_campaign(campaign: CampaignCreate, db: Session = Depends(get_db)):
+async def create_campaign(campaign: CampaignCreate, db: AsyncSession = Depends(get_async_db)):
     """Create a new campaign with segments"""
     # First check if template exists
-    template = db.query(Template).filter(Template.id == campaign.template_id).first()
+    template = await db.get(Template, campaign.template_id)
     if not template:
         raise HTTPException(
             status_code=404,
@@ -209,6 +277,11 @@ async def create_campaign(campaign: CampaignCreate, db: Session = Depends(get_db
         )
 
     campaign_data = campaign.dict(exclude={'segments'})
+    campaign_data['status'] = campaign.status.value
+    # Stored as naive UTC, like every other timestamp the workers compare against
+    for field in ('start_date', 'end_date'):
+        if campaign_data[field] is not None and campaign_data[field].tzinfo is not None:
+            campaign_data[field] = campaign_data[field].astimezone(timezone.utc).replace(tzinfo=None)
     db_campaign = Campaign(**campaign_data)
 
     # Add segments
@@ -220,27 +293,54 @@ async def create_campaign(campaign: CampaignCreate, db: Session = Depends(get_db
     
     try:
         db.add(db_campaign)
-        db.commit()
-        db.refresh(db_campaign)
+        await db.commit()
+        await db.refresh(db_campaign)
         return db_campaign
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Failed to create campaign: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail="Failed to create campaign. Please ensure all required data is valid."
         )
 
+async def _set_campaign_status(campaign_id: int, status: CampaignStatus, allowed_from, db: AsyncSession):
+    campaign = await db.scalar(select(Campaign).where(Campaign.id == campaign_id).with_for_update())
+    if not campaign:
+        raise HTTPException(status_code=404, detail=f"Campaign with id {campaign_id} not found")
+    if campaign.status not in allowed_from:
+        await db.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail=f"Campaign {campaign_id} is {campaign.status}; cannot change it to {status.value}"
+        )
+    campaign.status = status.value
+    await db.commit()
+    return campaign
+
+@app.post("/api/campaigns/{campaign_id}/pause", response_model=CampaignResponse)
+async def pause_campaign(campaign_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Hold the campaign's unsent chunks; running chunks stop at their next checkpoint"""
+    return await _set_campaign_status(campaign_id, CampaignStatus.paused, (CampaignStatus.active.value,), db)
+
+@app.post("/api/campaigns/{campaign_id}/resume", response_model=CampaignResponse)
+async def resume_campaign(campaign_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Start a draft or continue a paused campaign from where it stopped"""
+    return await _set_campaign_status(
+        campaign_id, CampaignStatus.active,
+        (CampaignStatus.paused.value, CampaignStatus.draft.value, None), db
+    )
+
 # Update analytics endpoints
 @app.get("/api/analytics/campaign/{campaign_id}", response_model=AnalyticsResponse)
 async def get_campaign_analytics(
     campaign_id: int,
     start_date: datetime = Query(None),
     end_date: datetime = Query(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get campaign analytics with segment performance and A/B test results"""
-    campaign_metrics = await analytics.get_campaign_metrics(
+    campaign_metrics = await analytics.get_campaign_analytics(
         campaign_id=campaign_id,
         start_date=start_date,
         end_date=end_date,
@@ -248,67 +348,138 @@ async def get_campaign_analytics(
     )
     return campaign_metrics
 
+def _int_or_none(value) -> Optional[int]:
+    """Payload ids arrive as numbers or strings; asyncpg binds integer columns strictly"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
 @app.post("/webhooks/{event_type}")
-async def process_webhook(event_type: str, payload: Dict[str, Any], db: Session = Depends(get_db)):
-    event = WebhookEvent(
-        event_type=event_type,
-        payload=payload,
-        notification_id=payload.get("notification_id"),
-        subscription_id=payload.get("subscription_id")
-    )
-    db.add(event)
-    db.commit()
-    process_webhook_event.delay(event.id)
+async def process_webhook(event_type: str, payload: Dict[str, Any], db: AsyncSession = Depends(get_async_db)):
+    event = {
+        "event_type": event_type,
+        "payload": payload,
+        "notification_id": _int_or_none(payload.get("notification_id")),
+        "subscription_id": _int_or_none(payload.get("subscription_id"))
+    }
+    # One row per subscribed webhook, routed from memory; workers.webhook_dispatcher
+    # delivers them, and the payload's own webhook_url if it has one
+    rows = [
+        WebhookEvent(**event, webhook_id=endpoint.id)
+        for endpoint in webhooks.get_registry().endpoints_for(event_type)
+    ]
+    if payload.get("webhook_url") or not rows:
+        rows.append(WebhookEvent(**event))
+    db.add_all(rows)
+    # Counted in the same transaction as the event, so each event is counted once
+    await db.run_sync(rollups.record_events, [(event["notification_id"], event_type, datetime.utcnow())])
+    await db.commit()
     return {"status": "accepted"}
 
+@app.post("/api/track", status_code=202)
+async def track_events(request: Request):
+    """
+    Beacon endpoint for delivery, open, click and conversion events from the
+    service worker. Accepts a JSON list or {"events": [...]}, including
+    text/plain bodies from navigator.sendBeacon, and queues the batch on the
+    tracking stream in one round trip.
+    """
+    try:
+        events = tracking.parse_events(json.loads(await request.body()))
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=f"Invalid tracking batch: {str(e)}")
+    if events:
+        queued = await tracking.append_entry(get_async_redis(), tracking.encode_entry(events, datetime.utcnow()))
+        if queued is None:
+            # The consumers are behind; the stream is never trimmed ahead of them
+            raise HTTPException(status_code=503, detail="Tracking backlog is full", headers={"Retry-After": "5"})
+    return {"accepted": len(events)}
+
 # Segment Management
 @app.post("/api/segments", response_model=Dict[str, Any])
-async def create_segment(segment: SegmentCreate, db: Session = Depends(get_db)):
+async def create_segment(segment: SegmentCreate, db: AsyncSession = Depends(get_async_db)):
     return await segment_service.create_segment(segment, db)
 
 @app.get("/api/segments", response_model=List[Dict[str, Any]])
-async def list_segments(db: Session = Depends(get_db)):
+async def list_segments(db: AsyncSession = Depends(get_async_db)):
     return await segment_service.list_segments(db)
 
+@app.get("/api/segments/audience", response_model=Dict[str, Any])
+async def estimate_segment_audience(
+    segments: List[str] = Query(...),
+    mode: str = Query("union")
+):
+    """Size of the union or intersection of segments, from their membership bitmaps"""
+    return await segment_service.estimate_audience(segments, mode)
+
 # Campaign Analytics
 @app.get("/api/analytics/campaigns/{campaign_id}")
 async def get_campaign_analytics(
     campaign_id: str,
     metrics: List[str] = Query(["delivery_rate", "ctr", "conversion_rate"]),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     return await analytics.get_campaign_metrics(campaign_id, metrics, db)
 
 # A/B Testing
 @app.post("/api/ab-tests", response_model=Dict[str, Any])  # Added response model
-async def create_ab_test(test: ABTestCreate, db: Session = Depends(get_db)):
-    """Create a new A/B test for a campaign"""
+async def create_ab_test(test: ABTestCreate, db: AsyncSession = Depends(get_async_db)):
+    """Create an A/B test for a draft campaign; the campaign is resumed once the test exists"""
     return await analytics.create_ab_test(test, db)
 
 # Webhooks
 @app.post("/api/webhooks")
-async def register_webhook(webhook: WebhookCreate, db: Session = Depends(get_db)):
+async def register_webhook(webhook: WebhookCreate, db: AsyncSession = Depends(get_async_db)):
     return await segment_service.register_webhook(webhook, db)
 
+@app.get("/api/webhooks")
+async def list_webhooks(db: AsyncSession = Depends(get_async_db)):
+    return await segment_service.list_webhooks(db)
+
+@app.delete("/api/webhooks/{webhook_id}")
+async def delete_webhook(webhook_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await segment_service.delete_webhook(webhook_id, db)
+
 # CDP Integration
 @app.post("/api/cdp/sync")
-async def sync_cdp_profile(profile: CDPProfileSync, db: Session = Depends(get_db)):
+async def sync_cdp_profile(profile: CDPProfileSync, db: AsyncSession = Depends(get_async_db)):
     return await cdp_service.sync_user_profile(profile, db)
 
+@app.post("/api/cdp/sync/batch")
+async def sync_cdp_profiles(request: Request, db: AsyncSession = Depends(get_async_db)):
+    """Bulk profile sync from a JSON list or NDJSON (application/x-ndjson) body"""
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            records = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            records = json.loads(body)
+        if not isinstance(records, list):
+            raise ValueError("expected a list of profiles")
+        profiles = [CDPProfileSync(**record) for record in records]
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=f"Invalid profile batch: {str(e)}")
+    return await cdp_service.sync_user_profiles(profiles, db)
+
 # Dashboard
 @app.get("/api/dashboard/segments")
 async def get_segment_performance(
     date_range: str = Query("last_7_days"),
-    db: Session = Depends(get_db)
+    start_date: Optional[datetime] = Query(None),
+    end_date: Optional[datetime] = Query(None),
+    segments: Optional[List[str]] = Query(None),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    return await analytics.get_segment_metrics(date_range, db)
+    """Per-segment counters and rates; start_date/end_date override date_range"""
+    return await analytics.get_segment_metrics(date_range, db, start_date, end_date, segments)
 
 # User Notifications
 @app.post("/api/users/{user_id}/notifications")
 async def send_user_notification(
     user_id: str,
     notification: NotificationCreate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     return await segment_service.send_targeted_notification(user_id, notification, db)
 
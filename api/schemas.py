@@ -8,6 +8,12 @@ class NotificationPriority(str, Enum):
     medium = "medium"
     high = "high"
 
+class CampaignStatus(str, Enum):
+    draft = "draft"
+    active = "active"
+    paused = "paused"
+    completed = "completed"
+
 class NotificationType(str, Enum):
     time_based = "time_based"
     trigger_based = "trigger_based"
@@ -56,9 +62,18 @@ class NotificationCreate(BaseModel):
     actions: Optional[List[ActionCreate]]
     segments: Optional[List[SegmentCreate]]
 
+class NotificationSegmentResponse(BaseModel):
+    segment_name: str
+    targeting_rules: Optional[Dict[str, Any]]
+
+    class Config:
+        from_attributes = True
+
 class NotificationResponse(NotificationCreate):
     id: int
     created_at: datetime
+    # Stored segments keep their name and compiled rules, not the request's shape
+    segments: Optional[List[NotificationSegmentResponse]]
 
     class Config:
         orm_mode = True
@@ -72,6 +87,7 @@ class TemplateCreate(BaseModel):
 
 class TemplateResponse(TemplateCreate):
     id: int
+    version: int = 1
     created_at: datetime
 
     class Config:
@@ -85,6 +101,8 @@ class CampaignCreate(BaseModel):
     segments: List[str]
     schedule_type: str  # immediate, scheduled, trigger-based
     trigger_conditions: Optional[Dict[str, Any]]
+    # Active campaigns are picked up by the campaign runner; drafts wait until resumed
+    status: CampaignStatus = CampaignStatus.active
 
 class CampaignResponse(BaseModel):
     id: int
@@ -114,14 +132,19 @@ class TriggerCreate(BaseModel):
     linked_campaign_id: str
 
 class ABTestCreate(BaseModel):
-    campaign_id: str
+    campaign_id: str  # A draft campaign that has not sent anything yet
     variants: List[Dict[str, str]]
     test_duration: str
+    metric: str = "clicked"  # opened, clicked or converted
+    sample_percent: int = 20  # Share of the audience the variants are tested on
+    confidence: float = 0.95  # P(best) at which a variant wins early
+    min_exposures: int = 1000  # Per variant, before an early win
+    auto_rollout: bool = True  # Send the winner to the rest of the audience
 
 class WebhookCreate(BaseModel):
     url: HttpUrl
-    events: List[str]
-    secret: Optional[str]
+    events: List[str]  # Event types, or ["*"] for all
+    secret: Optional[str] = None  # HMAC signing key; generated when omitted
 
 class CDPProfileSync(BaseModel):
     user_id: str
@@ -1,3 +1,3 @@
 from .analytics import get_campaign_metrics, get_segment_metrics
-from .segment_service import create_segment, list_segments, register_webhook, send_targeted_notification
-from .cdp_service import sync_user_profile
+from .segment_service import create_segment, list_segments, estimate_audience, register_webhook, send_targeted_notification
+from .cdp_service import sync_user_profile, sync_user_profiles
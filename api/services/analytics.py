@@ -1,76 +1,236 @@
-from sqlalchemy.orm import Session
-from typing import List, Dict, Any
-from datetime import datetime, timedelta
-from core.models import Campaign, Notification, DeliveryStatus, NotificationSegment
+from fastapi import HTTPException
+from sqlalchemy import exists, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import List, Dict, Any, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from core import ab_testing, outbox, rollups
+from core.models import ABTest, Campaign, CampaignStatus, Notification, NotificationRollup, NotificationSegment
+from core.segments import parse_duration
+from workers.celery_worker import queue_for_priority
+from workers.tasks import process_notification
 from api.schemas import ABTestCreate
+import logging
+import re
 
-async def get_campaign_metrics(campaign_id: str, metrics: List[str], db: Session) -> Dict[str, float]:
-    """Calculate campaign performance metrics"""
-    result = {}
-    campaign = db.query(Campaign).filter(Campaign.id == campaign_id).first()
-    
-    if "delivery_rate" in metrics:
-        total = db.query(DeliveryStatus).filter(
-            DeliveryStatus.notification_id.in_([n.id for n in campaign.notifications])
-        ).count()
-        delivered = db.query(DeliveryStatus).filter(
-            DeliveryStatus.status == "delivered"
-        ).count()
-        result["delivery_rate"] = (delivered / total * 100) if total > 0 else 0
-    
-    # Add more metric calculations
-    return result
-
-async def get_segment_metrics(date_range: str, db: Session) -> Dict[str, Dict[str, float]]:
-    """Calculate performance metrics per segment"""
-    segments = {}
-    end_date = datetime.utcnow()
-    
-    if date_range == "last_7_days":
-        start_date = end_date - timedelta(days=7)
+logger = logging.getLogger(__name__)
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Rollup buckets are naive UTC; convert aware query parameters to match"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _campaign_id(campaign_id: Any) -> int:
+    """Campaign ids arrive as path or body strings; asyncpg binds integer columns strictly"""
+    try:
+        return int(campaign_id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=404, detail=f"Campaign with id {campaign_id} not found")
+
+async def _campaign_counts(db: AsyncSession, campaign_id: int, start_date: Optional[datetime] = None,
+                           end_date: Optional[datetime] = None) -> Dict[str, int]:
+    query = select(*rollups.summed(NotificationRollup)).where(
+        NotificationRollup.campaign_id == campaign_id,
+        NotificationRollup.segment_name == rollups.ALL_SUBSCRIBERS
+    )
+    if start_date is not None:
+        query = query.where(NotificationRollup.bucket >= rollups.hour_bucket(start_date))
+    if end_date is not None:
+        query = query.where(NotificationRollup.bucket <= end_date)
+    return dict((await db.execute(query)).one()._mapping)
+
+async def get_campaign_metrics(campaign_id: str, metrics: List[str], db: AsyncSession) -> Dict[str, float]:
+    """Calculate campaign performance metrics from the rollup counters"""
+    campaign = await db.get(Campaign, _campaign_id(campaign_id))
+    if not campaign:
+        raise HTTPException(status_code=404, detail=f"Campaign with id {campaign_id} not found")
+
+    campaign_rates = rollups.rates(await _campaign_counts(db, campaign.id))
+    return {metric: campaign_rates[metric] for metric in metrics if metric in campaign_rates}
+
+async def _ab_test_results(db: AsyncSession, campaign_id: int) -> Optional[Dict[str, Any]]:
+    """Latest stored evaluation of the campaign's most recent A/B test"""
+    return await db.scalar(
+        select(ABTest.results)
+        .where(ABTest.campaign_id == campaign_id)
+        .order_by(ABTest.id.desc())
+        .limit(1)
+    )
+
+async def get_campaign_analytics(campaign_id: int, start_date: Optional[datetime],
+                                 end_date: Optional[datetime], db: AsyncSession) -> Dict[str, Any]:
+    """Campaign totals and per-segment performance, summed from the hourly rollups"""
+    campaign = await db.get(Campaign, campaign_id)
+    if not campaign:
+        raise HTTPException(status_code=404, detail=f"Campaign with id {campaign_id} not found")
+
+    start_date = _naive_utc(start_date) or campaign.start_date
+    end_date = _naive_utc(end_date) or datetime.utcnow()
+    counts = await _campaign_counts(db, campaign.id, start_date, end_date)
+
+    by_segment = await db.execute(
+        select(NotificationRollup.segment_name, *rollups.summed(NotificationRollup))
+        .where(
+            NotificationRollup.campaign_id == campaign.id,
+            NotificationRollup.bucket >= rollups.hour_bucket(start_date),
+            NotificationRollup.bucket <= end_date
+        )
+        .group_by(NotificationRollup.segment_name)
+    )
+    segment_performance = {}
+    for row in by_segment:
+        segment_counts = dict(row._mapping)
+        segment_name = segment_counts.pop("segment_name")
+        segment_performance[segment_name] = {**segment_counts, **rollups.rates(segment_counts)}
+
+    return {
+        "campaign_id": campaign.id,
+        "start_date": start_date,
+        "end_date": end_date,
+        "total_sent": counts["sent"],
+        "metrics": {
+            "deliveries": counts["delivered"],
+            "clicks": counts["clicked"],
+            "opens": counts["opened"],
+            "conversions": counts["converted"],
+        },
+        "segment_performance": segment_performance,
+        "ab_test_results": await _ab_test_results(db, campaign.id),
+    }
+
+# "last_7_days", "last_90_days", "last_12_hours"
+RELATIVE_RANGE = re.compile(r"^last_(\d+)_(hour|day|week)s?$")
+RANGE_UNITS = {"hour": "hours", "day": "days", "week": "weeks"}
+
+def parse_date_range(date_range: Optional[str], start_date: Optional[datetime] = None,
+                     end_date: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """
+    Resolve a dashboard range to naive UTC (start, end). Explicit dates win over
+    a relative date_range such as last_7_days, last_24_hours or today.
+    """
+    end = _naive_utc(end_date) or datetime.utcnow()
+    if start_date is not None:
+        start = _naive_utc(start_date)
+    elif date_range == "today":
+        start = end.replace(hour=0, minute=0, second=0, microsecond=0)
     else:
-        start_date = end_date - timedelta(days=30)
-    
-    # Calculate metrics for each segment
-    segment_stats = db.query(NotificationSegment).all()
-    for segment in segment_stats:
-        metrics = calculate_segment_performance(segment, start_date, end_date, db)
-        segments[segment.segment_name] = metrics
-    
+        match = RELATIVE_RANGE.match(date_range or "last_7_days")
+        if not match:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Invalid date_range {date_range!r}; use today, last_<n>_hours, last_<n>_days or last_<n>_weeks"
+            )
+        start = end - timedelta(**{RANGE_UNITS[match.group(2)]: int(match.group(1))})
+    if start > end:
+        raise HTTPException(status_code=422, detail="start_date must be before end_date")
+    return start, end
+
+async def get_segment_metrics(date_range: Optional[str], db: AsyncSession, start_date: Optional[datetime] = None,
+                              end_date: Optional[datetime] = None,
+                              segment_names: Optional[List[str]] = None) -> Dict[str, Dict[str, float]]:
+    """
+    Performance of every segment over a date range, in one grouped query over
+    the segment rollups
+    """
+    start, end = parse_date_range(date_range, start_date, end_date)
+    rows = await db.run_sync(lambda session: rollups.segment_totals(session, start, end, segment_names).all())
+    segments = {}
+    for row in rows:
+        counts = dict(row._mapping)
+        segment_name = counts.pop("segment_name")
+        segments[segment_name] = {**counts, **rollups.rates(counts)}
     return segments
 
-def calculate_segment_performance(segment, start_date, end_date, db):
-    """Calculate detailed performance metrics for a segment"""
-    # Implementation here
-    pass
+async def create_ab_test(test: ABTestCreate, db: AsyncSession) -> Dict[str, Any]:
+    """
+    Create an A/B test for a campaign and send each variant to its share of
+    the test sample; the winner goes to the rest of the audience later.
 
-async def create_ab_test(test: ABTestCreate, db: Session) -> Dict[str, Any]:
-    """Create and initialize an A/B test for a campaign"""
+    The test has to be created while the campaign is a draft. Once active, the
+    campaign runner sends it to the whole audience, and variants added after
+    that would push to the same subscribers again.
+    """
+    # Locked, so the campaign cannot be activated while its test is created
+    campaign = await db.scalar(
+        select(Campaign)
+        .where(Campaign.id == _campaign_id(test.campaign_id))
+        .options(selectinload(Campaign.template), selectinload(Campaign.campaign_segments))
+        .with_for_update(of=Campaign)
+    )
+    if not campaign:
+        raise HTTPException(status_code=404, detail=f"Campaign {test.campaign_id} not found")
+    launched = await db.scalar(select(exists().where(Notification.campaign_id == campaign.id)))
+    if campaign.status != CampaignStatus.draft.value or launched:
+        await db.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail=f"Campaign {test.campaign_id} is {campaign.status}; "
+                   "A/B tests are created before a campaign is activated"
+        )
+    if test.metric not in ab_testing.METRICS:
+        raise HTTPException(status_code=422, detail=f"metric must be one of {', '.join(ab_testing.METRICS)}")
+    if any("variant_id" not in variant or "title" not in variant for variant in test.variants):
+        raise HTTPException(status_code=422, detail="every variant needs a variant_id and a title")
+    duration = parse_duration(test.test_duration)
+    if duration is None:
+        raise HTTPException(status_code=422, detail="test_duration must look like 30m, 24h, 3d or 1w")
     try:
-        campaign = db.query(Campaign).filter(Campaign.id == test.campaign_id).first()
-        if not campaign:
-            raise ValueError(f"Campaign {test.campaign_id} not found")
-        
+        slots = ab_testing.variant_slots(test.sample_percent, len(test.variants))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    try:
+        db_test = ABTest(
+            campaign_id=campaign.id,
+            metric=test.metric,
+            sample_percent=test.sample_percent,
+            confidence=test.confidence,
+            min_exposures=test.min_exposures,
+            auto_rollout=test.auto_rollout,
+            ends_at=datetime.utcnow() + duration,
+            variants=[]
+        )
+        db.add(db_test)
+        await db.flush()
+
         # Create variant notifications
+        notifications = []
         for variant in test.variants:
             notification = Notification(
                 title=variant["title"],
-                body=campaign.template.body_template,  # Use template body
+                body=variant.get("body") or campaign.template.body_template,  # Use template body
                 variant_id=variant["variant_id"],
-                ab_test_group=test.campaign_id,
-                campaign_id=campaign.id
+                ab_test_group=str(db_test.id),
+                campaign_id=campaign.id,
+                segments=[
+                    NotificationSegment(segment_name=segment.segment_name)
+                    for segment in campaign.campaign_segments
+                ]
             )
             db.add(notification)
-        
-        db.commit()
-        
-        return {
-            "status": "created",
-            "campaign_id": test.campaign_id,
-            "variants": test.variants,
-            "test_duration": test.test_duration
-        }
+            notifications.append(notification)
+        await db.flush()
+
+        db_test.variants = [
+            {"variant_id": notification.variant_id, "notification_id": notification.id, "slots": list(variant_slots)}
+            for notification, variant_slots in zip(notifications, slots)
+        ]
+        for notification in notifications:
+            outbox.enqueue(
+                db, process_notification, (notification.id,), queue=queue_for_priority(notification.priority)
+            )
+        await db.commit()
     except Exception as e:
         logger.error(f"Failed to create A/B test: {str(e)}")
-        db.rollback()
+        await db.rollback()
         raise
+
+    return {
+        "status": "created",
+        "test_id": db_test.id,
+        "campaign_id": test.campaign_id,
+        "variants": db_test.variants,
+        "test_duration": test.test_duration,
+        "ends_at": db_test.ends_at
+    }
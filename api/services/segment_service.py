@@ -1,40 +1,97 @@
-from sqlalchemy.orm import Session
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Dict, Any
-from core.models import NotificationSegment, Notification
+from core.models import NotificationSegment, Webhook
+from core import outbox, segment_bitmaps, webhooks
+from core.segments import SegmentRuleError, compile_rules
+from workers.tasks import build_segment_bitmap_task
 from api.schemas import SegmentCreate, WebhookCreate, NotificationCreate
+import asyncio
 import logging
+import secrets
 
 logger = logging.getLogger(__name__)
 
-async def create_segment(segment: SegmentCreate, db: Session) -> Dict[str, Any]:
+async def create_segment(segment: SegmentCreate, db: AsyncSession) -> Dict[str, Any]:
     """Create a new segment with targeting rules"""
+    targeting_rules = segment.conditions.dict()
+    try:
+        # Reject rules the segment engine cannot compile before saving them
+        compile_rules(targeting_rules)
+    except SegmentRuleError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid segment rules: {str(e)}")
+
     db_segment = NotificationSegment(
         segment_name=segment.name,
-        targeting_rules=segment.conditions.dict()
+        targeting_rules=targeting_rules
     )
     db.add(db_segment)
-    db.commit()
-    db.refresh(db_segment)
+    # Materialize membership once; profile changes keep it current afterwards
+    outbox.enqueue(db, build_segment_bitmap_task, (segment.name, targeting_rules))
+    await db.commit()
+
     return {"id": db_segment.id, "name": db_segment.segment_name}
 
-async def list_segments(db: Session) -> List[Dict[str, Any]]:
+async def list_segments(db: AsyncSession) -> List[Dict[str, Any]]:
     """List all available segments"""
-    segments = db.query(NotificationSegment).all()
+    segments = (await db.scalars(select(NotificationSegment))).all()
     return [{"id": s.id, "name": s.segment_name, "rules": s.targeting_rules} for s in segments]
 
-async def register_webhook(webhook: WebhookCreate, db: Session) -> Dict[str, Any]:
-    """Register a new webhook endpoint"""
-    # Implementation for webhook registration
+async def estimate_audience(segment_names: List[str], mode: str = "union") -> Dict[str, Any]:
+    """Audience size of a union or intersection of segments, from their bitmaps"""
+    if mode not in ("union", "intersection"):
+        raise HTTPException(status_code=422, detail="mode must be 'union' or 'intersection'")
+    return {
+        "segments": segment_names,
+        "mode": mode,
+        "audience_size": len(await asyncio.to_thread(segment_bitmaps.audience, segment_names, mode))
+    }
+
+async def register_webhook(webhook: WebhookCreate, db: AsyncSession) -> Dict[str, Any]:
+    """Register a new webhook endpoint; the signing secret is generated unless given"""
+    if not webhook.events:
+        raise HTTPException(status_code=422, detail="A webhook needs at least one event type")
+
+    db_webhook = Webhook(
+        url=str(webhook.url),
+        events=sorted(set(webhook.events)),
+        secret=webhook.secret or secrets.token_urlsafe(32)
+    )
+    db.add(db_webhook)
+    await db.commit()
+    await webhooks.publish_change()
+
+    # The only response that includes the secret
     return {
-        "url": str(webhook.url),
-        "events": webhook.events,
+        "id": db_webhook.id,
+        "url": db_webhook.url,
+        "events": db_webhook.events,
+        "secret": db_webhook.secret,
         "status": "registered"
     }
 
+async def list_webhooks(db: AsyncSession) -> List[Dict[str, Any]]:
+    """List the active webhook endpoints"""
+    return [
+        {"id": w.id, "url": w.url, "events": w.events, "created_at": w.created_at}
+        for w in await db.scalars(select(Webhook).where(Webhook.active).order_by(Webhook.id))
+    ]
+
+async def delete_webhook(webhook_id: int, db: AsyncSession) -> Dict[str, Any]:
+    """Deactivate a webhook; events still queued for it are dropped"""
+    db_webhook = await db.scalar(select(Webhook).where(Webhook.id == webhook_id, Webhook.active))
+    if not db_webhook:
+        raise HTTPException(status_code=404, detail="Webhook not found")
+    db_webhook.active = False
+    await db.commit()
+    await webhooks.publish_change()
+    return {"id": webhook_id, "status": "deleted"}
+
 async def send_targeted_notification(
     user_id: str,
     notification: NotificationCreate,
-    db: Session
+    db: AsyncSession
 ) -> Dict[str, Any]:
     """Send notification to a specific user with CDP data"""
     # Implementation for targeted notification
@@ -1,5 +1,6 @@
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Any, Dict, Optional, List
+import os
 
 class Settings(BaseModel):
     # API Settings
@@ -16,6 +17,27 @@ class Settings(BaseModel):
     POSTGRES_HOST: str = "db"
     POSTGRES_PORT: int = 5432
     DATABASE_URL: Optional[str] = None
+    ASYNC_DATABASE_URL: Optional[str] = None  # asyncpg URL for the API; derived from DATABASE_URL
+    STREAM_PAGE_SIZE: int = 10000  # Rows per keyset page in streaming scans
+    STREAM_YIELD_PER: int = 1000  # Rows fetched per server-side cursor round trip
+
+    # Connection pools, per process: a process holds at most pool_size +
+    # max_overflow connections per engine. The role is set per service in the
+    # compose files; "delivery" is per task process, a prefork child or a
+    # --pool=solo worker, and too small for threaded worker pools.
+    DB_POOL_ROLE: str = os.getenv("DB_POOL_ROLE", "default")
+    DB_POOLS: Dict[str, Dict[str, int]] = {
+        "api": {"pool_size": 6, "max_overflow": 4},
+        "delivery": {"pool_size": 2, "max_overflow": 1},  # A task's session plus the result writer
+        "webhooks": {"pool_size": 2, "max_overflow": 1},
+        "scheduler": {"pool_size": 2, "max_overflow": 1},
+        "default": {"pool_size": 2, "max_overflow": 3},
+    }
+    DB_POOL_TIMEOUT: float = 30.0  # Seconds a checkout waits for a free connection
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_METRICS_INTERVAL: float = 15.0  # Seconds between pool metric reports per process
+    # DATABASE_URL points at PgBouncer in transaction pooling mode
+    DB_PGBOUNCER: bool = False
 
     # RabbitMQ Settings
     RABBITMQ_HOST: str = "rabbitmq"
@@ -23,14 +45,111 @@ class Settings(BaseModel):
     RABBITMQ_USER: str = "guest"
     RABBITMQ_PASS: str = "guest"
 
+    # Campaign Settings
+    CAMPAIGN_TICK_INTERVAL: float = 30.0  # Seconds between send waves
+    CAMPAIGN_SEND_WINDOW: int = 3600  # Seconds a scheduled campaign without end_date is spread over
+    CAMPAIGN_MAX_CHUNKS_PER_WAVE: int = 20  # Chunks one campaign may release per wave
+    CAMPAIGN_MAX_CHUNKS_IN_FLIGHT: int = 200  # Released but unfinished chunks across all campaigns
+    CAMPAIGN_CHUNK_TIMEOUT: int = 1800  # Seconds a released chunk may stay unfinished before it is released again
+    CAMPAIGN_CHUNK_MAX_ATTEMPTS: int = 3  # Releases before a stalled chunk is marked failed
+
+    # Tracking Settings
+    TRACKING_MAX_EVENTS_PER_REQUEST: int = 1000
+    TRACKING_STREAM_MAXLEN: int = 1_000_000  # Unconsumed stream entries before beacons are refused
+    TRACKING_MAX_DELIVERIES: int = 5  # Attempts before a failing entry moves to the dead-letter stream
+    TRACKING_DEAD_LETTER_MAXLEN: int = 100_000
+    TRACKING_BATCH_SIZE: int = 10000  # Events written per database transaction
+    TRACKING_FLUSH_INTERVAL: float = 1.0  # Max seconds an event waits for a full batch
+
+    # Webhook Settings
+    WEBHOOK_COALESCE_WINDOW: float = 0.5  # Seconds events to one endpoint are collected into a batch
+    WEBHOOK_CLAIM_BATCH_SIZE: int = 5000  # Pending events claimed per poll
+    WEBHOOK_MAX_IN_FLIGHT: int = 20000  # Claimed events not yet delivered or rescheduled
+    WEBHOOK_MAX_EVENTS_PER_REQUEST: int = 500
+    WEBHOOK_MAX_CONCURRENCY: int = 200  # In-flight POSTs across all endpoints
+    WEBHOOK_CONCURRENCY_PER_ENDPOINT: int = 4
+    WEBHOOK_REQUEST_TIMEOUT: float = 10.0
+    WEBHOOK_CLAIM_LEASE: float = 300.0  # Seconds before a claimed event is picked up again
+    WEBHOOK_MAX_ATTEMPTS: int = 8
+    WEBHOOK_RETRY_BASE_DELAY: float = 5.0  # Doubled after every failed attempt
+    WEBHOOK_RETRY_MAX_DELAY: float = 3600.0
+    WEBHOOK_BREAKER_THRESHOLD: int = 5  # Consecutive failures that open an endpoint's circuit
+    WEBHOOK_BREAKER_COOLDOWN: float = 30.0  # Seconds an open circuit holds events back
+    WEBHOOK_REGISTRY_REFRESH_INTERVAL: float = 300.0  # Full reload, in case a change notice was missed
+
+    # A/B Test Settings
+    AB_TEST_EVALUATION_INTERVAL: float = 60.0  # Seconds between winner evaluations
+
+    # Template Settings
+    TEMPLATE_CACHE_SIZE: int = 1024  # Compiled templates kept per worker process
+
+    # CDP Settings
+    CDP_UPSERT_BATCH_SIZE: int = 5000  # Profiles per INSERT ... ON CONFLICT statement
+    CDP_COALESCE_WINDOW: float = 1.0  # Seconds single-profile syncs are buffered
+    SEGMENT_RECONCILE_INTERVAL: float = 900.0  # Seconds between full passes over segment bitmaps
+
+    # Partition Settings
+    PARTITION_PREMAKE_DAYS: int = 7  # Daily partitions created ahead of time
+    PARTITION_RETENTION_DAYS: int = 30  # Partitions older than this are dropped
+    PARTITION_MAINTENANCE_INTERVAL: float = 3600.0  # Seconds between partition maintenance runs
+
+    # Outbox Settings
+    OUTBOX_BATCH_SIZE: int = 500  # Tasks published per relay transaction
+    OUTBOX_POLL_INTERVAL: float = 0.2  # Seconds between polls once the outbox is drained
+    OUTBOX_CONFIRM_TIMEOUT: float = 30.0  # Seconds to wait for the broker to confirm a batch
+
+    # Scheduler Settings
+    SCHEDULER_POLL_INTERVAL: float = 0.5  # Seconds between due-queue polls
+    SCHEDULER_BATCH_SIZE: int = 500  # Schedules claimed per poll
+
+    # Worker pools: queues each pool consumes, with its concurrency and prefetch
+    WORKER_POOLS: Dict[str, Dict[str, Any]] = {
+        "transactional": {"queues": ["transactional"], "concurrency": 8, "prefetch_multiplier": 1},
+        "broadcast": {"queues": ["broadcast"], "concurrency": 4, "prefetch_multiplier": 1},
+        "maintenance": {"queues": ["maintenance"], "concurrency": 2, "prefetch_multiplier": 1},
+    }
+    QUEUE_METRICS_INTERVAL: float = 15.0  # Seconds between queue depth samples
+
     # Redis Settings
     REDIS_HOST: str = "redis"
     REDIS_PORT: int = 6379
+    REDIS_DB: int = 0
+
+    # Delivery Settings
+    SEND_CHUNK_SIZE: int = 5000  # Subscriptions per fan-out child task
+    SEND_CHECKPOINT_SIZE: int = 1000  # Subscriptions sent between chunk checkpoints
+    PUSH_MAX_CONCURRENCY: int = 500  # In-flight pushes per worker process
+    PUSH_CONNECTIONS_PER_ORIGIN: int = 10
+    PUSH_REQUEST_TIMEOUT: float = 10.0
+    PUSH_DEFAULT_TTL: int = 86400
+    # 0 uses one process per CPU core; not used by prefork children, which encrypt in-process
+    PUSH_ENCRYPTION_PROCESSES: int = 0
+    RESULT_BUFFER_SIZE: int = 5000  # Delivery outcomes buffered per bulk write
+    ROLLUP_SLOTS: int = 16  # Rows each rollup counter is spread over, so concurrent writers rarely share one
+
+    # Push Service Rate Limits (token bucket per origin, shared through Redis)
+    PUSH_DEFAULT_RATE: float = 1000.0  # Pushes/sec for origins not listed below
+    PUSH_RATE_LIMITS: Dict[str, float] = {}  # e.g. {"fcm.googleapis.com": 5000.0}
+    PUSH_MIN_RATE: float = 10.0
+    PUSH_MAX_RATE: float = 20000.0
+    PUSH_RATE_BURST_SECONDS: float = 1.0
+    PUSH_RATE_INCREASE: float = 50.0  # Added per unthrottled batch
+    PUSH_RATE_DECREASE_FACTOR: float = 0.5  # Applied on 429/503
+    PUSH_THROTTLE_BACKOFF: float = 5.0  # Block when no Retry-After is given
+    PUSH_RATE_LIMIT_MAX_WAIT: float = 5.0  # Longer waits reschedule the pushes
+    PUSH_MAX_DEFERRALS: int = 5  # Reschedules of a rate-limited push before it is recorded as failed
+
+    # VAPID Settings
+    VAPID_PRIVATE_KEY: str = ""  # base64url-encoded raw P-256 private key
+    VAPID_SUBJECT: str = "mailto:admin@example.com"
+    VAPID_TOKEN_TTL: int = 12 * 3600
 
     def __init__(self, **data):
         super().__init__(**data)
         if not self.DATABASE_URL:
             self.DATABASE_URL = f"postgresql://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
+        if not self.ASYNC_DATABASE_URL:
+            self.ASYNC_DATABASE_URL = "postgresql+asyncpg://" + self.DATABASE_URL.split("://", 1)[1]
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,130 @@
+"""
+A/B test evaluation over the streaming rollup counters.
+
+Each variant is a Notification sent to its own slice of subscription id
+slots (id % SLOTS) within the test's sample; the rest of the audience is kept
+for the winner. Exposures and successes per variant are read from the
+notification rollups, which are incremented as pushes and tracking events
+arrive, so an evaluation costs the same however long the test has run.
+
+Winner probabilities are Bayesian: every variant's rate gets a Beta(1 + s,
+1 + n - s) posterior, and P(variant is best) is estimated by sampling.
+"""
+from datetime import datetime
+from random import Random
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, func
+
+from core import rollups
+from core.models import ABTest, NotificationRollup, Subscription
+
+SLOTS = 100
+POSTERIOR_SAMPLES = 20000
+METRICS = ("opened", "clicked", "converted")
+
+ROLLOUT_VARIANT = "rollout"
+
+def variant_slots(sample_percent: int, count: int) -> List[Tuple[int, int]]:
+    """Split slots [0, sample_percent) into count contiguous [lo, hi) ranges"""
+    if count < 1 or not 0 < sample_percent <= SLOTS:
+        raise ValueError("an A/B test needs at least one variant and a sample of 1-100%")
+    if sample_percent < count:
+        raise ValueError(f"a {sample_percent}% sample cannot be split between {count} variants")
+    bounds = [sample_percent * i // count for i in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def slot_filter(lo: int, hi: int):
+    return and_(Subscription.id % SLOTS >= lo, Subscription.id % SLOTS < hi)
+
+def sample_filter(db, notification):
+    """Restrict an A/B variant or rollout notification to its slots; None for other notifications"""
+    if not notification.ab_test_group or not notification.ab_test_group.isdigit():
+        return None
+    test = db.query(ABTest).filter(ABTest.id == int(notification.ab_test_group)).first()
+    if test is None:
+        return None
+    if notification.variant_id == ROLLOUT_VARIANT:
+        return slot_filter(test.sample_percent, SLOTS)
+    for variant in test.variants:
+        if variant["notification_id"] == notification.id:
+            return slot_filter(*variant["slots"])
+    return None
+
+def win_probabilities(stats: Dict[str, Tuple[int, int]], samples: int = POSTERIOR_SAMPLES,
+                      seed: int = 0) -> Dict[str, float]:
+    """
+    P(each variant has the highest rate) from (exposures, successes), by
+    Monte Carlo over the Beta posteriors
+    """
+    if not stats:
+        return {}
+    rng = Random(seed)
+    names = list(stats)
+    posteriors = [
+        (1 + successes, 1 + max(exposures - successes, 0))
+        for exposures, successes in (stats[name] for name in names)
+    ]
+    wins = dict.fromkeys(names, 0)
+    for _ in range(samples):
+        draws = [rng.betavariate(alpha, beta) for alpha, beta in posteriors]
+        wins[names[draws.index(max(draws))]] += 1
+    return {name: wins[name] / samples for name in names}
+
+def variant_counts(db, test: ABTest) -> Dict[str, Tuple[int, int]]:
+    """(exposures, successes) per variant, summed from the notification rollups"""
+    by_notification = {variant["notification_id"]: variant["variant_id"] for variant in test.variants}
+    rows = (
+        db.query(
+            NotificationRollup.notification_id,
+            func.coalesce(func.sum(NotificationRollup.sent), 0),
+            func.coalesce(func.sum(getattr(NotificationRollup, test.metric)), 0)
+        )
+        .filter(
+            NotificationRollup.notification_id.in_(list(by_notification)),
+            NotificationRollup.segment_name == rollups.ALL_SUBSCRIBERS
+        )
+        .group_by(NotificationRollup.notification_id)
+        .all()
+    )
+    counts = dict.fromkeys(by_notification.values(), (0, 0))
+    for notification_id, exposures, successes in rows:
+        counts[by_notification[notification_id]] = (int(exposures), int(successes))
+    return counts
+
+def evaluate(db, test: ABTest, now: Optional[datetime] = None) -> Dict:
+    """
+    Recompute winner probabilities from the current counters and store them on
+    the test. A winner is declared once every variant has min_exposures and one
+    is best with at least the test's confidence, or when the test ends.
+    """
+    now = now or datetime.utcnow()
+    counts = variant_counts(db, test)
+    probabilities = win_probabilities(counts, seed=test.id)
+
+    winner = None
+    if probabilities:
+        leader = max(probabilities, key=probabilities.get)
+        enough_data = all(exposures >= test.min_exposures for exposures, _ in counts.values())
+        if (enough_data and probabilities[leader] >= test.confidence) or now >= test.ends_at:
+            winner = leader
+
+    test.results = {
+        "test_id": test.id,
+        "metric": test.metric,
+        "status": test.status,
+        "winner": winner or test.winner_variant_id,
+        "ends_at": test.ends_at.isoformat(),
+        "evaluated_at": now.isoformat(),
+        "variants": {
+            variant_id: {
+                "exposures": exposures,
+                "successes": successes,
+                "rate": round(successes / exposures * 100, 2) if exposures else 0.0,
+                "probability_best": round(probabilities.get(variant_id, 0.0), 4),
+            }
+            for variant_id, (exposures, successes) in counts.items()
+        },
+    }
+    test.evaluated_at = now
+    return test.results
@@ -1,7 +1,9 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from config.settings import settings
+from core import db_pool
 import logging
 import time
 from sqlalchemy.exc import OperationalError
@@ -9,18 +11,14 @@ from sqlalchemy import inspect
 
 logger = logging.getLogger(__name__)
 
-def create_db_engine(max_retries=5, retry_delay=5):
+def create_db_engine(max_retries=5, retry_delay=5, role=None):
+    role = role or settings.DB_POOL_ROLE
     for attempt in range(max_retries):
         try:
-            engine = create_engine(
-                settings.DATABASE_URL,
-                pool_size=5,
-                max_overflow=10,
-                pool_timeout=30,
-                pool_recycle=1800
-            )
+            engine = create_engine(settings.DATABASE_URL, **db_pool.engine_options(role))
             # Test the connection
-            engine.connect()
+            engine.connect().close()
+            db_pool.instrument(engine, "sync", role)
             return engine
         except OperationalError as e:
             if attempt < max_retries - 1:
@@ -43,6 +41,66 @@ def get_db():
     finally:
         db.close()
 
+# asyncpg engine for the API's request handlers, so a slow query suspends the
+# request instead of blocking the event loop; workers use the engine above.
+# Nothing connects until the first request.
+async_engine = create_async_engine(
+    settings.ASYNC_DATABASE_URL,
+    **db_pool.engine_options(settings.DB_POOL_ROLE, is_async=True)
+)
+db_pool.instrument(async_engine.sync_engine, "async", settings.DB_POOL_ROLE)
+
+# Objects stay loaded after commit, as attribute access cannot lazy-load on the loop
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def iter_keyset(db, id_column, columns=(), where=(), start_after=0, end_at=None, page_size=None):
+    """
+    Stream (id, *columns) rows ordered by id_column using keyset pagination.
+    Each page is read through a server-side cursor (a psycopg2 named cursor)
+    with yield_per, so neither the pages nor the rows are materialized. The
+    cursors only live inside the session's transaction, which also keeps them
+    on one server connection behind PgBouncer's transaction pooling.
+    """
+    page_size = page_size or settings.STREAM_PAGE_SIZE
+    last_id = start_after
+
+    while True:
+        query = db.query(id_column, *columns).filter(id_column > last_id, *where)
+        if end_at is not None:
+            query = query.filter(id_column <= end_at)
+
+        fetched = 0
+        for row in query.order_by(id_column).limit(page_size).yield_per(settings.STREAM_YIELD_PER):
+            fetched += 1
+            last_id = row[0]
+            yield row
+
+        if fetched < page_size:
+            return
+
+def iter_subscriptions(db, start_after=0, end_at=None, where=(), page_size=None, include_inactive=False):
+    """
+    Stream the (id, endpoint, p256dh, auth, user_id) tuples a sender needs from subscriptions
+    """
+    from core.models import Subscription
+
+    if not include_inactive:
+        where = (Subscription.active, *where)
+
+    return iter_keyset(
+        db,
+        Subscription.id,
+        (Subscription.endpoint, Subscription.p256dh, Subscription.auth, Subscription.user_id),
+        where=where,
+        start_after=start_after,
+        end_at=end_at,
+        page_size=page_size
+    )
+
 def init_db():
     try:
         # Drop all tables to ensure clean state
@@ -52,6 +110,12 @@ def init_db():
         # Create all tables
         Base.metadata.create_all(bind=engine)
         logger.info("✅ Created all tables with updated schema")
+
+        from core import partitions
+
+        with engine.begin() as conn:
+            created = partitions.maintain(conn)["created"]
+        logger.info(f"✅ Created {len(created)} table partitions")
         
         return True
     except Exception as e:
@@ -0,0 +1,157 @@
+"""
+Connection pool sizing and instrumentation for the database engines.
+
+Every process creates its own engines, so pools are sized per process role
+(settings.DB_POOL_ROLE, set for each service in the compose files) from
+settings.DB_POOLS; the sum over all processes has to stay below Postgres'
+max_connections, or PgBouncer's pool size when DB_PGBOUNCER is set.
+
+Pools time each checkout. Wait times, timeouts and how many connections are
+in use are kept in memory and published to core.metrics every
+DB_POOL_METRICS_INTERVAL seconds from a daemon thread, so a checkout never
+waits on Redis.
+"""
+from typing import Any, Dict, Optional
+from uuid import uuid4
+import logging
+import os
+import socket
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from config.settings import settings
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+class PoolStats:
+    """
+    Checkout waits and saturation of one engine's pool in one process. Checkouts
+    only update counters in memory; a daemon thread publishes them.
+    """
+
+    def __init__(self, engine_name: str, role: str, capacity: int, interval: Optional[float] = None):
+        self.engine_name = engine_name
+        self.role = role
+        self.capacity = capacity
+        self.interval = settings.DB_POOL_METRICS_INTERVAL if interval is None else interval
+        self.closed = False
+        self._pool = None
+        self._lock = threading.Lock()
+        self._reporter: Optional[threading.Thread] = None
+        self._reporter_pid: Optional[int] = None
+        self._reset()
+
+    def _reset(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, pool, waited: float, timed_out: bool = False):
+        with self._lock:
+            self._pool = pool
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            # Threads do not survive a fork, so a forked child starts its own
+            if self._reporter_pid != os.getpid():
+                self._reporter_pid = os.getpid()
+                self._reporter = threading.Thread(target=self._report, name=f"db-pool-{self.engine_name}", daemon=True)
+                self._reporter.start()
+
+    def _report(self):
+        while not self.closed:
+            time.sleep(self.interval)
+            try:
+                self.publish()
+            except Exception as e:
+                logger.warning(f"Failed to publish {self.engine_name} pool metrics: {e}")
+
+    def publish(self):
+        with self._lock:
+            checkouts, timeouts, wait_total, wait_max = self.checkouts, self.timeouts, self.wait_total, self.wait_max
+            self._reset()
+        in_use = self._pool.checkedout() if self._pool is not None else 0
+        labels = {
+            "role": self.role,
+            "engine": self.engine_name,
+            # Pools are per process; gauges from different processes must not overwrite each other
+            "process": f"{socket.gethostname()}:{os.getpid()}",
+        }
+        metrics.incr("db_pool_checkouts_total", checkouts, **labels)
+        metrics.incr("db_pool_timeouts_total", timeouts, **labels)
+        metrics.incr("db_pool_checkout_wait_seconds_sum", wait_total, **labels)
+        metrics.incr("db_pool_checkout_wait_seconds_count", checkouts + timeouts, **labels)
+        metrics.set_gauge("db_pool_checkout_wait_seconds_max", wait_max, **labels)
+        metrics.set_gauge("db_pool_in_use", in_use, **labels)
+        metrics.set_gauge("db_pool_saturation", in_use / self.capacity if self.capacity else 0.0, **labels)
+
+class TimedCheckout:
+    """Pool mixin that records how long each checkout waited, including for a new connection"""
+    stats: Optional[PoolStats] = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            if self.stats is not None:
+                self.stats.record(self, time.perf_counter() - started, timed_out=True)
+            raise
+        if self.stats is not None:
+            self.stats.record(self, time.perf_counter() - started)
+        return connection
+
+    def recreate(self):
+        # Engine.dispose() replaces the pool, also in forked children, which
+        # report as processes of their own
+        pool = super().recreate()
+        if self.stats is not None:
+            self.stats.closed = True
+            pool.stats = PoolStats(self.stats.engine_name, self.stats.role, self.stats.capacity, self.stats.interval)
+        return pool
+
+class TimedQueuePool(TimedCheckout, QueuePool):
+    pass
+
+class TimedAsyncQueuePool(TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+def pool_config(role: str) -> Dict[str, int]:
+    return settings.DB_POOLS.get(role, settings.DB_POOLS["default"])
+
+def engine_options(role: str, is_async: bool = False) -> Dict[str, Any]:
+    """create_engine()/create_async_engine() keyword arguments for a process role"""
+    pool = pool_config(role)
+    options: Dict[str, Any] = {
+        "poolclass": TimedAsyncQueuePool if is_async else TimedQueuePool,
+        "pool_size": pool["pool_size"],
+        "max_overflow": pool["max_overflow"],
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+    }
+    if settings.DB_PGBOUNCER and is_async:
+        # In transaction pooling consecutive transactions can run on different
+        # server connections, so a statement prepared on one may be missing, or
+        # its name taken, on the next. asyncpg prepares every statement, so
+        # nothing is cached and every statement gets a unique name.
+        options["connect_args"] = {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+        }
+    return options
+
+def instrument(engine, engine_name: str, role: str) -> PoolStats:
+    """Start recording checkout metrics for an engine's pool"""
+    pool = pool_config(role)
+    stats = PoolStats(engine_name, role, pool["pool_size"] + pool["max_overflow"])
+    engine.pool.stats = stats
+    return stats
@@ -0,0 +1,61 @@
+from typing import Dict, Mapping, Optional
+import logging
+
+from core.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Every process (API and workers) writes into the same Redis hashes so the
+# API can expose one aggregated view.
+COUNTERS_KEY = "webpush:metrics:counters"
+GAUGES_KEY = "webpush:metrics:gauges"
+
+def _field(name: str, labels: Optional[Mapping[str, str]] = None) -> str:
+    if not labels:
+        return name
+    rendered = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{rendered}}}"
+
+def incr_many(name: str, amounts: Mapping[str, float], label: str):
+    """Increment one counter per label value in a single round trip"""
+    if not amounts:
+        return
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for value, amount in amounts.items():
+            pipe.hincrbyfloat(COUNTERS_KEY, _field(name, {label: value}), amount)
+        pipe.execute()
+    except Exception as e:
+        # Metrics must never break the code path being measured
+        logger.warning(f"Failed to record metric {name}: {e}")
+
+def incr(name: str, amount: float = 1, **labels):
+    try:
+        get_redis().hincrbyfloat(COUNTERS_KEY, _field(name, labels), amount)
+    except Exception as e:
+        logger.warning(f"Failed to record metric {name}: {e}")
+
+def observe(name: str, value: float, **labels):
+    """Record one observation as running _sum and _count counters plus a _last gauge"""
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hincrbyfloat(COUNTERS_KEY, _field(f"{name}_sum", labels), value)
+        pipe.hincrbyfloat(COUNTERS_KEY, _field(f"{name}_count", labels), 1)
+        pipe.hset(GAUGES_KEY, _field(f"{name}_last", labels), value)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed to record metric {name}: {e}")
+
+def set_gauge(name: str, value: float, **labels):
+    try:
+        get_redis().hset(GAUGES_KEY, _field(name, labels), value)
+    except Exception as e:
+        logger.warning(f"Failed to record metric {name}: {e}")
+
+def snapshot() -> Dict[str, Dict[str, float]]:
+    """Return all counters and gauges recorded by any process"""
+    client = get_redis()
+    return {
+        "counters": {field: float(value) for field, value in client.hgetall(COUNTERS_KEY).items()},
+        "gauges": {field: float(value) for field, value in client.hgetall(GAUGES_KEY).items()},
+    }
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, DateTime, JSON, Boolean, ForeignKey, Enum as SQLEnum, func, Index
+from sqlalchemy import BigInteger, Column, Integer, SmallInteger, String, DateTime, JSON, Boolean, Float, ForeignKey, Enum as SQLEnum, func, Index, UniqueConstraint, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import enum
@@ -13,6 +14,12 @@ class NotificationType(enum.Enum):
     time_based = "time_based"
     trigger_based = "trigger_based"
 
+class CampaignStatus(enum.Enum):
+    draft = "draft"
+    active = "active"
+    paused = "paused"
+    completed = "completed"
+
 class Notification(Base):
     __tablename__ = "notifications"
 
@@ -40,25 +47,38 @@ class Notification(Base):
     campaign = relationship("Campaign", back_populates="notifications")
     template = relationship("Template")
     delivery_statuses = relationship("DeliveryStatus", back_populates="notification")
-    webhook_events = relationship("WebhookEvent", back_populates="notification")
+    webhook_events = relationship(
+        "WebhookEvent", primaryjoin="Notification.id == foreign(WebhookEvent.notification_id)",
+        viewonly=True
+    )
 
 class NotificationSchedule(Base):
     __tablename__ = "notification_schedules"
 
     id = Column(Integer, primary_key=True)
-    notification_id = Column(Integer, ForeignKey('notifications.id'))
+    notification_id = Column(Integer, ForeignKey('notifications.id', ondelete='CASCADE'))
     type = Column(SQLEnum(NotificationType))
     trigger_type = Column(String)
     trigger_conditions = Column(JSON)
     send_at = Column(DateTime)
+    # Set in the same transaction that hands the notification to the workers
+    dispatched_at = Column(DateTime, nullable=True)
     
     notification = relationship("Notification", back_populates="schedule")
 
+    # Due-queue: only pending time-based schedules are indexed
+    __table_args__ = (
+        Index(
+            'idx_notification_schedules_due', 'send_at',
+            postgresql_where=text("dispatched_at IS NULL AND type = 'time_based'")
+        ),
+    )
+
 class NotificationAction(Base):
     __tablename__ = "notification_actions"
 
     id = Column(Integer, primary_key=True)
-    notification_id = Column(Integer, ForeignKey('notifications.id'))
+    notification_id = Column(Integer, ForeignKey('notifications.id', ondelete='CASCADE'))
     type = Column(String)
     title = Column(String)
     action = Column(String)
@@ -69,7 +89,7 @@ class NotificationTracking(Base):
     __tablename__ = "notification_tracking"
 
     id = Column(Integer, primary_key=True)
-    notification_id = Column(Integer, ForeignKey('notifications.id'))
+    notification_id = Column(Integer, ForeignKey('notifications.id', ondelete='CASCADE'))
     enable_delivery_tracking = Column(Boolean, default=True)
     enable_open_tracking = Column(Boolean, default=True)
     enable_click_tracking = Column(Boolean, default=True)
@@ -81,7 +101,7 @@ class NotificationSegment(Base):
     __tablename__ = "notification_segments"
 
     id = Column(Integer, primary_key=True)
-    notification_id = Column(Integer, ForeignKey('notifications.id'))
+    notification_id = Column(Integer, ForeignKey('notifications.id', ondelete='CASCADE'))
     segment_name = Column(String)
     targeting_rules = Column(JSON)
 
@@ -95,12 +115,36 @@ class Subscription(Base):
     p256dh = Column(String, nullable=False)  # Public key for encryption
     auth = Column(String, nullable=False)    # Auth secret
     user_agent = Column(String, nullable=True)
+    # Links the browser subscription to a CDP profile in user_profiles
+    user_id = Column(String, nullable=True, index=True)
     created_at = Column(DateTime, server_default=func.now())
     last_push_at = Column(DateTime, nullable=True)
+    # Cleared when the push service reports the endpoint as gone (404/410)
+    active = Column(Boolean, nullable=False, default=True, server_default=text('true'))
+    deactivated_at = Column(DateTime, nullable=True)
 
     # Index for faster lookups
     __table_args__ = (
         Index('idx_subscriptions_endpoint', 'endpoint'),
+        # Sender scans only walk live subscriptions
+        Index('idx_subscriptions_active_id', 'id', postgresql_where=text('active')),
+    )
+
+class UserProfile(Base):
+    __tablename__ = "user_profiles"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String, nullable=False, unique=True)
+    loyalty_tier = Column(String, nullable=True, index=True)
+    country = Column(String, nullable=True, index=True)
+    last_purchase_at = Column(DateTime, nullable=True, index=True)
+    attributes = Column(JSONB, nullable=False, server_default=text("'{}'::jsonb"))
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        # Serves attribute equality rules compiled to JSONB containment
+        Index('idx_user_profiles_attributes', 'attributes', postgresql_using='gin',
+              postgresql_ops={'attributes': 'jsonb_path_ops'}),
     )
 
 class Template(Base):
@@ -112,6 +156,8 @@ class Template(Base):
     body_template = Column(String, nullable=False)
     variables = Column(JSON)  # ["name", "product", etc.]
     category = Column(String)
+    # Bumped whenever the template text changes, so compiled copies are recompiled
+    version = Column(Integer, nullable=False, default=1, server_default=text('1'))
     created_at = Column(DateTime, default=datetime.utcnow)
 
 class CampaignSegment(Base):
@@ -129,7 +175,7 @@ class Campaign(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     template_id = Column(Integer, ForeignKey('templates.id'))
-    status = Column(String, nullable=True)  # draft, active, completed, paused
+    status = Column(String, nullable=True)  # CampaignStatus: draft, active, completed, paused
     start_date = Column(DateTime, nullable=False)
     end_date = Column(DateTime, nullable=True)
     schedule_type = Column(String, nullable=False)  # immediate, scheduled, trigger-based
@@ -143,27 +189,197 @@ class Campaign(Base):
 class DeliveryStatus(Base):
     __tablename__ = "delivery_statuses"
     
-    id = Column(Integer, primary_key=True)
-    notification_id = Column(Integer, ForeignKey('notifications.id'))
+    # Range-partitioned by day of notification_created_at, see core.partitions;
+    # the primary key and unique constraint have to include the partition key
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    notification_created_at = Column(DateTime, primary_key=True)
+    notification_id = Column(Integer, ForeignKey('notifications.id', ondelete='CASCADE'))
     subscription_id = Column(Integer, ForeignKey('subscriptions.id'))
     status = Column(String)  # sent, delivered, failed, clicked
     error = Column(String, nullable=True)
     delivered_at = Column(DateTime, nullable=True)
+    opened_at = Column(DateTime, nullable=True)
     clicked_at = Column(DateTime, nullable=True)
+    converted_at = Column(DateTime, nullable=True)
     
     notification = relationship("Notification")
     subscription = relationship("Subscription")
 
+    # One outcome per notification and subscription; bulk writes upsert on it
+    __table_args__ = (
+        UniqueConstraint(
+            'notification_id', 'subscription_id', 'notification_created_at',
+            name='uq_delivery_statuses_notification_subscription'
+        ),
+        {'postgresql_partition_by': 'RANGE (notification_created_at)'},
+    )
+
+class NotificationSendProgress(Base):
+    __tablename__ = "notification_send_progress"
+
+    # One row per fan-out chunk; last_subscription_id is its high-water mark
+    id = Column(Integer, primary_key=True)
+    notification_id = Column(Integer, ForeignKey('notifications.id', ondelete='CASCADE'), nullable=False)
+    start_after = Column(Integer, nullable=False)
+    end_at = Column(Integer, nullable=True)
+    last_subscription_id = Column(Integer, nullable=False)
+    successful_pushes = Column(Integer, nullable=False, default=0)
+    failed_pushes = Column(Integer, nullable=False, default=0)
+    # Set when the campaign runner releases the chunk in a send wave
+    dispatched_at = Column(DateTime, nullable=True)
+    # Times the campaign runner released the chunk, including after it stalled
+    attempts = Column(Integer, nullable=False, default=0)
+    # Rate-limited pushes rescheduled and not yet re-sent; the chunk stays open until none are left
+    deferred_pushes = Column(Integer, nullable=False, default=0)
+    completed_at = Column(DateTime, nullable=True)
+    # Set when the chunk was given up on; it no longer counts as in flight
+    failed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint('notification_id', 'start_after', name='uq_notification_send_progress_chunk'),
+    )
+
+class ABTest(Base):
+    __tablename__ = "ab_tests"
+
+    # Variants are Notifications with ab_test_group = str(id); each is sent to its
+    # own range of subscription id slots (id % 100) inside the first sample_percent
+    id = Column(Integer, primary_key=True)
+    campaign_id = Column(Integer, ForeignKey('campaigns.id'), nullable=False, index=True)
+    status = Column(String, nullable=False, default="running")  # running, completed
+    metric = Column(String, nullable=False, default="clicked")  # clicked, converted, opened
+    sample_percent = Column(Integer, nullable=False, default=20)
+    confidence = Column(Float, nullable=False, default=0.95)
+    min_exposures = Column(Integer, nullable=False, default=1000)
+    auto_rollout = Column(Boolean, nullable=False, default=True)
+    variants = Column(JSON, nullable=False)  # [{"variant_id", "notification_id", "slots": [lo, hi]}]
+    ends_at = Column(DateTime, nullable=False)
+    winner_variant_id = Column(String, nullable=True)
+    rollout_notification_id = Column(Integer, nullable=True)
+    results = Column(JSON, nullable=True)  # Last evaluation, served by analytics as-is
+    evaluated_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    campaign = relationship("Campaign")
+
+class NotificationRollup(Base):
+    __tablename__ = "notification_rollups"
+
+    # Hourly delivery and engagement counters per notification and targeted segment.
+    # No foreign keys, so analytics outlive cleanup of old notifications.
+    id = Column(Integer, primary_key=True)
+    notification_id = Column(Integer, nullable=False)
+    campaign_id = Column(Integer, nullable=True, index=True)
+    segment_name = Column(String, nullable=False)
+    bucket = Column(DateTime, nullable=False)
+    # Concurrent writers add to different slots of a key; readers sum over them
+    slot = Column(SmallInteger, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    delivered = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    opened = Column(Integer, nullable=False, default=0)
+    clicked = Column(Integer, nullable=False, default=0)
+    converted = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('notification_id', 'segment_name', 'bucket', 'slot', name='uq_notification_rollups_key'),
+    )
+
+class SegmentRollup(Base):
+    __tablename__ = "segment_rollups"
+
+    # The same counters summed over all notifications, one row per segment, hour and slot
+    id = Column(Integer, primary_key=True)
+    segment_name = Column(String, nullable=False)
+    bucket = Column(DateTime, nullable=False)
+    slot = Column(SmallInteger, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    delivered = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    opened = Column(Integer, nullable=False, default=0)
+    clicked = Column(Integer, nullable=False, default=0)
+    converted = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('segment_name', 'bucket', 'slot', name='uq_segment_rollups_key'),
+        Index('idx_segment_rollups_bucket', 'bucket'),
+    )
+
+class SegmentDailyRollup(Base):
+    __tablename__ = "segment_daily_rollups"
+
+    # Segment counters per UTC day; long dashboard ranges read these instead of hours
+    id = Column(Integer, primary_key=True)
+    segment_name = Column(String, nullable=False)
+    bucket = Column(DateTime, nullable=False)
+    slot = Column(SmallInteger, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    delivered = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    opened = Column(Integer, nullable=False, default=0)
+    clicked = Column(Integer, nullable=False, default=0)
+    converted = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('segment_name', 'bucket', 'slot', name='uq_segment_daily_rollups_key'),
+        Index('idx_segment_daily_rollups_bucket', 'bucket'),
+    )
+
 class WebhookEvent(Base):
     __tablename__ = "webhook_events"
     
-    id = Column(Integer, primary_key=True)
+    # Range-partitioned by day of created_at, see core.partitions. An event log
+    # without foreign keys, so partitions drop on their own schedule.
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
     event_type = Column(String)  # delivery, click, conversion
-    notification_id = Column(Integer, ForeignKey('notifications.id'))
-    subscription_id = Column(Integer, ForeignKey('subscriptions.id'))
+    notification_id = Column(Integer)
+    subscription_id = Column(Integer)
     payload = Column(JSON)
     processed = Column(Boolean, default=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, primary_key=True, default=datetime.utcnow)
+    # Registered webhook the event is delivered to; None for the payload's webhook_url
+    webhook_id = Column(Integer, nullable=True)
+    # Outbound delivery state, see workers.webhook_dispatcher
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    next_attempt_at = Column(DateTime, nullable=True, default=datetime.utcnow)
+    last_error = Column(String, nullable=True)
     
-    notification = relationship("Notification")
-    subscription = relationship("Subscription")
+    notification = relationship(
+        "Notification", primaryjoin="foreign(WebhookEvent.notification_id) == Notification.id", viewonly=True
+    )
+    subscription = relationship(
+        "Subscription", primaryjoin="foreign(WebhookEvent.subscription_id) == Subscription.id", viewonly=True
+    )
+
+    __table_args__ = (
+        # Dispatcher queue: only undelivered events are indexed
+        Index(
+            'idx_webhook_events_pending', 'next_attempt_at',
+            postgresql_where=text("processed IS NOT TRUE")
+        ),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
+
+class Webhook(Base):
+    __tablename__ = "webhooks"
+
+    # Loaded into core.webhooks.WebhookRegistry in every process that routes events
+    id = Column(Integer, primary_key=True)
+    url = Column(String, nullable=False)
+    events = Column(JSON, nullable=False)  # Event types, or ["*"] for all
+    secret = Column(String, nullable=False)  # HMAC-SHA256 key for the X-Webhook-Signature header
+    active = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+
+    # Celery tasks written in the same transaction as the rows they act on;
+    # workers.outbox_relay publishes them in id order and deletes them
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    task = Column(String, nullable=False)
+    args = Column(JSON, nullable=False, default=list)
+    kwargs = Column(JSON, nullable=False, default=dict)
+    queue = Column(String, nullable=True)  # None follows the task's route
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
@@ -0,0 +1,24 @@
+"""
+Transactional outbox for Celery tasks.
+
+Code that writes rows and then needs a task run calls enqueue() before it
+commits, so the task is stored atomically with the rows it refers to: if the
+transaction commits, the task will be published, and if it rolls back there
+is nothing to publish. workers.outbox_relay publishes pending tasks to the
+broker with publisher confirms, so request handlers never wait on the broker.
+"""
+from typing import Any, Dict, Optional, Sequence, Union
+
+from core.models import OutboxMessage
+
+def enqueue(db, task: Union[str, Any], args: Sequence = (), kwargs: Optional[Dict[str, Any]] = None,
+            queue: Optional[str] = None) -> OutboxMessage:
+    """Add a task (a Celery task or its name) to the caller's transaction"""
+    message = OutboxMessage(
+        task=getattr(task, "name", task),
+        args=list(args),
+        kwargs=kwargs or {},
+        queue=queue
+    )
+    db.add(message)
+    return message
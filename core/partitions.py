@@ -0,0 +1,125 @@
+"""
+Daily range partitions of the high-volume tables.
+
+    delivery_statuses   by notification_created_at, the created_at of its notification
+    webhook_events      by created_at
+
+Partitions are named <table>_pYYYYMMDD and cover one UTC day. The maintenance
+task creates them PARTITION_PREMAKE_DAYS ahead, so inserts always find one,
+and retention detaches and drops whole days instead of deleting rows. Every
+status of a notification lands in the partition of the notification's day,
+so queries that filter on the partition key read one partition.
+
+That day can be long past when the statuses are written: a notification may
+be scheduled weeks ahead, and campaigns and A/B rollouts send for days.
+Retention keeps every delivery_statuses partition from the day of the oldest
+live notification on, one that is scheduled and not dispatched yet or has
+chunks that are neither completed nor failed.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import exists, func, or_, select, text
+
+from config.settings import settings
+from core.models import Notification, NotificationSchedule, NotificationSendProgress, NotificationType
+from core.rollups import day_bucket
+
+# Partitioned table -> its partition key
+PARTITIONED_TABLES = {
+    "delivery_statuses": "notification_created_at",
+    "webhook_events": "created_at",
+}
+
+# Maintenance gives up rather than queue writers behind its parent table lock
+LOCK_TIMEOUT = "5s"
+
+def partition_name(table: str, day: datetime) -> str:
+    return f"{table}_p{day:%Y%m%d}"
+
+def list_partitions(conn, table: str) -> Dict[datetime, str]:
+    """Day -> name of each partition attached to table"""
+    rows = conn.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:table AS regclass)"
+        ),
+        {"table": table}
+    )
+    prefix = f"{table}_p"
+    partitions = {}
+    for (name,) in rows:
+        if name.startswith(prefix):
+            partitions[datetime.strptime(name[len(prefix):], "%Y%m%d")] = name
+    return partitions
+
+def create_partitions(conn, start: datetime, end: datetime) -> List[str]:
+    """Create the missing daily partitions of every partitioned table from start's day to end's day"""
+    created = []
+    conn.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+    for table in PARTITIONED_TABLES:
+        existing = list_partitions(conn, table)
+        day = day_bucket(start)
+        while day <= end:
+            if day not in existing:
+                name = partition_name(table, day)
+                conn.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                    f"FOR VALUES FROM ('{day:%Y-%m-%d}') TO ('{day + timedelta(days=1):%Y-%m-%d}')"
+                ))
+                created.append(name)
+            day += timedelta(days=1)
+    return created
+
+def live_notifications():
+    """Filter for notifications that can still write delivery statuses"""
+    return or_(
+        exists().where(
+            NotificationSchedule.notification_id == Notification.id,
+            NotificationSchedule.type == NotificationType.time_based,
+            NotificationSchedule.dispatched_at.is_(None)
+        ),
+        exists().where(
+            NotificationSendProgress.notification_id == Notification.id,
+            NotificationSendProgress.completed_at.is_(None),
+            NotificationSendProgress.failed_at.is_(None)
+        )
+    )
+
+def oldest_live_notification(conn) -> Optional[datetime]:
+    return conn.execute(select(func.min(Notification.created_at)).where(live_notifications())).scalar()
+
+def drop_partitions(conn, before: datetime) -> List[str]:
+    """
+    Detach and drop every partition whose whole day is before the given time,
+    except delivery_statuses partitions live notifications still write to
+    """
+    cutoffs = dict.fromkeys(PARTITIONED_TABLES, before)
+    oldest_live = oldest_live_notification(conn)
+    if oldest_live is not None:
+        cutoffs["delivery_statuses"] = min(before, day_bucket(oldest_live))
+
+    dropped = []
+    conn.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+    for table, cutoff in cutoffs.items():
+        for day, name in sorted(list_partitions(conn, table).items()):
+            if day + timedelta(days=1) > cutoff:
+                break
+            conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            conn.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    return dropped
+
+def retention_cutoff(days: int, now: Optional[datetime] = None) -> datetime:
+    """Start of the oldest day kept, so the cutoff falls on a partition boundary"""
+    return day_bucket((now or datetime.utcnow()) - timedelta(days=days))
+
+def maintain(conn, now: Optional[datetime] = None, retention_days: Optional[int] = None) -> Dict[str, List[str]]:
+    """Create the partitions for the days ahead and drop those past retention"""
+    now = now or datetime.utcnow()
+    retention_days = retention_days or settings.PARTITION_RETENTION_DAYS
+    cutoff = retention_cutoff(retention_days, now)
+    return {
+        "created": create_partitions(conn, cutoff, now + timedelta(days=settings.PARTITION_PREMAKE_DAYS)),
+        "dropped": drop_partitions(conn, cutoff),
+    }
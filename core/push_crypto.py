@@ -0,0 +1,229 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from config.settings import settings
+from core.push_delivery import push_service_origin
+
+logger = logging.getLogger(__name__)
+
+RECORD_SIZE = 4096
+ENCRYPTION_BATCH_SIZE = 256
+
+# (subscription_id, p256dh, auth)
+EncryptionItem = Tuple[int, str, str]
+# (subscription_id, encrypted body or None, error or None)
+EncryptionResult = Tuple[int, Optional[bytes], Optional[str]]
+
+def b64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+def b64url_encode(value: bytes) -> str:
+    return base64.urlsafe_b64encode(value).rstrip(b"=").decode("ascii")
+
+def _hmac_sha256(key: bytes, data: bytes) -> bytes:
+    return hmac.new(key, data, hashlib.sha256).digest()
+
+def build_payload(notification, title: Optional[str] = None, body: Optional[str] = None) -> bytes:
+    """
+    Serialize the part of a Notification the service worker displays, with
+    title and body optionally replaced by a personalized rendering
+    """
+    return json.dumps({
+        "id": notification.id,
+        "title": notification.title if title is None else title,
+        "body": notification.body if body is None else body,
+        "icon": notification.icon,
+        "image": notification.image,
+        "badge": notification.badge,
+        "data": notification.data,
+        "requireInteraction": notification.require_interaction,
+        "actions": [
+            {"action": action.action, "title": action.title, "type": action.type}
+            for action in notification.actions
+        ],
+    }, separators=(",", ":")).encode("utf-8")
+
+def encrypt_payload(payload: bytes, p256dh: str, auth: str, salt: Optional[bytes] = None) -> bytes:
+    """Encrypt a push message body for one subscriber (RFC 8291, aes128gcm)"""
+    ua_public = b64url_decode(p256dh)
+    auth_secret = b64url_decode(auth)
+    salt = salt or os.urandom(16)
+
+    # A fresh application server key pair per message, as RFC 8291 requires
+    as_private = ec.generate_private_key(ec.SECP256R1())
+    as_public = as_private.public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+    ecdh_secret = as_private.exchange(
+        ec.ECDH(), ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), ua_public)
+    )
+
+    prk_key = _hmac_sha256(auth_secret, ecdh_secret)
+    ikm = _hmac_sha256(prk_key, b"WebPush: info\x00" + ua_public + as_public + b"\x01")
+    prk = _hmac_sha256(salt, ikm)
+    cek = _hmac_sha256(prk, b"Content-Encoding: aes128gcm\x00\x01")[:16]
+    nonce = _hmac_sha256(prk, b"Content-Encoding: nonce\x00\x01")[:12]
+
+    # Single record, terminated by the 0x02 last-record delimiter
+    ciphertext = AESGCM(cek).encrypt(nonce, payload + b"\x02", None)
+    header = salt + struct.pack("!IB", RECORD_SIZE, len(as_public)) + as_public
+    return header + ciphertext
+
+def _encrypt_batch(payload: bytes, items: Sequence[EncryptionItem],
+                   overrides: Optional[Dict[int, bytes]] = None) -> Tuple[List[EncryptionResult], float]:
+    """Encrypt one batch, returning the results and the CPU seconds spent"""
+    started = time.process_time()
+    results = []
+    overrides = overrides or {}
+    for subscription_id, p256dh, auth in items:
+        try:
+            body = overrides.get(subscription_id, payload)
+            results.append((subscription_id, encrypt_payload(body, p256dh, auth), None))
+        except (ValueError, TypeError) as e:
+            results.append((subscription_id, None, f"Invalid subscription keys: {e}"))
+    return results, time.process_time() - started
+
+@dataclass
+class EncryptionStats:
+    pushes: int = 0
+    cpu_seconds: float = 0.0
+
+    @property
+    def pushes_per_second_per_core(self) -> float:
+        return self.pushes / self.cpu_seconds if self.cpu_seconds > 0 else 0.0
+
+class PushEncryptor:
+    """
+    Spreads per-subscriber ECDH and AES-GCM work over a process pool.
+
+    Daemonic processes cannot start one. Celery's default prefork pool runs
+    tasks in daemonic children, so there each child encrypts in-process and
+    the worker's concurrency spreads the work over the cores. The process
+    pool needs a worker started with --pool=solo, which runs one task at a
+    time, so the delivery role's per-process database pool still fits; such
+    workers scale by process count. Threaded pools would share that database
+    pool between all their tasks.
+    """
+
+    def __init__(self, processes: Optional[int] = None):
+        self.processes = processes if processes is not None else settings.PUSH_ENCRYPTION_PROCESSES
+        self.processes = self.processes or os.cpu_count() or 1
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_disabled = self.processes <= 1
+
+    def _get_pool(self) -> Optional[ProcessPoolExecutor]:
+        if self._pool is None and not self._pool_disabled:
+            if multiprocessing.current_process().daemon:
+                logger.warning(
+                    "Encrypting in-process: daemonic processes such as Celery prefork children cannot "
+                    "start the encryption process pool; run the worker with --pool=solo to use it"
+                )
+                self._pool_disabled = True
+                return None
+            self._pool = ProcessPoolExecutor(max_workers=self.processes)
+        return self._pool
+
+    def encrypt_many(self, payload: bytes, items: Sequence[EncryptionItem],
+                     payloads: Optional[Dict[int, bytes]] = None) -> Tuple[List[EncryptionResult], EncryptionStats]:
+        """
+        Encrypt payload for every item; payloads maps subscription ids to a
+        personalized body that replaces it
+        """
+        batches = [items[i:i + ENCRYPTION_BATCH_SIZE] for i in range(0, len(items), ENCRYPTION_BATCH_SIZE)]
+        if payloads:
+            overrides = [{item[0]: payloads[item[0]] for item in batch if item[0] in payloads} for batch in batches]
+        else:
+            overrides = [None] * len(batches)
+        stats = EncryptionStats()
+        results: List[EncryptionResult] = []
+
+        pool = self._get_pool() if len(batches) > 1 else None
+        if pool is not None:
+            try:
+                outputs = list(pool.map(_encrypt_batch, [payload] * len(batches), batches, overrides))
+            except (AssertionError, OSError) as e:
+                logger.warning(f"Encryption process pool unavailable, encrypting in-process: {e}")
+                self.close()
+                self._pool_disabled = True
+                outputs = [_encrypt_batch(payload, batch, batch_overrides)
+                           for batch, batch_overrides in zip(batches, overrides)]
+        else:
+            outputs = [_encrypt_batch(payload, batch, batch_overrides)
+                       for batch, batch_overrides in zip(batches, overrides)]
+
+        for batch_results, cpu_seconds in outputs:
+            results.extend(batch_results)
+            stats.cpu_seconds += cpu_seconds
+        stats.pushes = len(results)
+        return results, stats
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+class VapidSigner:
+    """Signs VAPID JWTs (RFC 8292) and caches one per push service audience"""
+
+    def __init__(self, private_key: Optional[str] = None, subject: Optional[str] = None,
+                 token_ttl: Optional[int] = None):
+        raw_key = b64url_decode(private_key or settings.VAPID_PRIVATE_KEY)
+        self.private_key = ec.derive_private_key(int.from_bytes(raw_key, "big"), ec.SECP256R1())
+        self.public_key = b64url_encode(self.private_key.public_key().public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+        ))
+        self.subject = subject or settings.VAPID_SUBJECT
+        self.token_ttl = token_ttl or settings.VAPID_TOKEN_TTL
+        self._tokens: Dict[str, Tuple[str, float]] = {}
+
+    def _sign(self, audience: str, expires_at: int) -> str:
+        header = b64url_encode(json.dumps({"typ": "JWT", "alg": "ES256"}, separators=(",", ":")).encode())
+        claims = b64url_encode(json.dumps(
+            {"aud": audience, "exp": expires_at, "sub": self.subject}, separators=(",", ":")
+        ).encode())
+        signing_input = f"{header}.{claims}".encode("ascii")
+        r, s = decode_dss_signature(self.private_key.sign(signing_input, ec.ECDSA(hashes.SHA256())))
+        return f"{header}.{claims}.{b64url_encode(r.to_bytes(32, 'big') + s.to_bytes(32, 'big'))}"
+
+    def authorization(self, endpoint: str) -> str:
+        """Return the Authorization header value for a push endpoint"""
+        audience = push_service_origin(endpoint)
+        now = time.time()
+        cached = self._tokens.get(audience)
+        # Re-sign once the cached token is within 10% of its lifetime from expiry
+        if cached is None or cached[1] - now < self.token_ttl * 0.1:
+            expires_at = int(now + self.token_ttl)
+            cached = (self._sign(audience, expires_at), expires_at)
+            self._tokens[audience] = cached
+        return f"vapid t={cached[0]}, k={self.public_key}"
+
+_encryptor: Optional[PushEncryptor] = None
+_signer: Optional[VapidSigner] = None
+
+def get_encryptor() -> PushEncryptor:
+    global _encryptor
+    if _encryptor is None:
+        _encryptor = PushEncryptor()
+    return _encryptor
+
+def get_vapid_signer() -> Optional[VapidSigner]:
+    """Return the process-wide signer, or None when no VAPID key is configured"""
+    global _signer
+    if _signer is None and settings.VAPID_PRIVATE_KEY:
+        _signer = VapidSigner()
+    return _signer
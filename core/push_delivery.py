@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Web Push urgency values for each NotificationPriority
+URGENCY_BY_PRIORITY = {
+    "low": "low",
+    "medium": "normal",
+    "high": "high",
+}
+
+@dataclass
+class PushMessage:
+    subscription_id: int
+    endpoint: str
+    body: bytes = b""
+    headers: Dict[str, str] = field(default_factory=dict)
+
+@dataclass
+class PushResult:
+    subscription_id: int
+    endpoint: str
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+    retry_after: Optional[float] = None
+
+    @property
+    def success(self) -> bool:
+        return self.status_code is not None and 200 <= self.status_code < 300
+
+def push_service_origin(endpoint: str) -> str:
+    """Return the scheme://host[:port] origin of a push endpoint"""
+    parts = urlsplit(endpoint)
+    return f"{parts.scheme}://{parts.netloc}"
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given either in seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+class PushDeliveryEngine:
+    """
+    Sends web pushes concurrently over one keep-alive HTTP/2 connection pool
+    per push service origin (FCM, Mozilla autopush, Apple, ...).
+    """
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        connections_per_origin: Optional[int] = None,
+        timeout: Optional[float] = None,
+        http2: bool = True,
+    ):
+        self.max_concurrency = max_concurrency or settings.PUSH_MAX_CONCURRENCY
+        self.connections_per_origin = connections_per_origin or settings.PUSH_CONNECTIONS_PER_ORIGIN
+        self.timeout = timeout or settings.PUSH_REQUEST_TIMEOUT
+        self.http2 = http2
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def _client_for(self, origin: str) -> httpx.AsyncClient:
+        client = self._clients.get(origin)
+        if client is None:
+            client = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.connections_per_origin,
+                    max_keepalive_connections=self.connections_per_origin,
+                ),
+            )
+            self._clients[origin] = client
+        return client
+
+    async def send(self, message: PushMessage) -> PushResult:
+        """Send a single push, bounded by the engine-wide concurrency limit"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        client = self._client_for(push_service_origin(message.endpoint))
+        async with self._semaphore:
+            try:
+                response = await client.post(
+                    message.endpoint,
+                    content=message.body,
+                    headers=message.headers,
+                )
+            except httpx.HTTPError as e:
+                return PushResult(
+                    subscription_id=message.subscription_id,
+                    endpoint=message.endpoint,
+                    error=f"{type(e).__name__}: {e}",
+                )
+
+        result = PushResult(
+            subscription_id=message.subscription_id,
+            endpoint=message.endpoint,
+            status_code=response.status_code,
+        )
+        if not result.success:
+            result.error = response.text[:200] or response.reason_phrase
+            result.retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        return result
+
+    async def send_many(self, messages: Iterable[PushMessage]) -> List[PushResult]:
+        """Send a batch of pushes concurrently, returning results in input order"""
+        return await asyncio.gather(*(self.send(message) for message in messages))
+
+    async def aclose(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+# One event loop and engine per worker process, so keep-alive connections
+# survive across the chunk tasks that process executes.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_engine: Optional[PushDeliveryEngine] = None
+
+def deliver(messages: Iterable[PushMessage]) -> List[PushResult]:
+    """Synchronous entry point for Celery tasks"""
+    global _loop, _engine
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        _engine = PushDeliveryEngine()
+    return _loop.run_until_complete(_engine.send_many(messages))
@@ -0,0 +1,116 @@
+from typing import Optional, Tuple
+from urllib.parse import urlsplit
+import logging
+
+from config.settings import settings
+from core.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Token bucket per push service origin, refilled continuously at the
+# bucket's current rate. Uses the Redis clock so every worker agrees.
+# Returns {granted, wait_ms until the next token or until a block ends}.
+ACQUIRE_SCRIPT = """
+local blocked = redis.call('PTTL', KEYS[2])
+if blocked > 0 then
+    return {0, blocked}
+end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local requested = tonumber(ARGV[1])
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate') or ARGV[2])
+local capacity = math.max(rate * tonumber(ARGV[3]), 1)
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or capacity)
+local ts = tonumber(redis.call('HGET', KEYS[1], 'ts') or now)
+tokens = math.min(capacity, tokens + (now - ts) * rate / 1000)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now, 'rate', tostring(rate))
+redis.call('EXPIRE', KEYS[1], 3600)
+local wait = 0
+if granted < requested then
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+return {granted, wait}
+"""
+
+# Multiplicative decrease on throttling, plus a block for the Retry-After period
+THROTTLE_SCRIPT = """
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate') or ARGV[1])
+rate = math.max(tonumber(ARGV[2]), rate * tonumber(ARGV[3]))
+redis.call('HSET', KEYS[1], 'rate', tostring(rate), 'tokens', '0')
+redis.call('EXPIRE', KEYS[1], 3600)
+redis.call('SET', KEYS[2], '1', 'PX', ARGV[4])
+return tostring(rate)
+"""
+
+# Additive increase after pushes were accepted
+RECOVER_SCRIPT = """
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate') or ARGV[1])
+rate = math.min(tonumber(ARGV[2]), rate + tonumber(ARGV[3]))
+redis.call('HSET', KEYS[1], 'rate', tostring(rate))
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(rate)
+"""
+
+class PushServiceRateLimiter:
+    """
+    Adaptive (AIMD) token bucket per push service origin, shared by all
+    workers through Redis. Push services throttle by origin, so a 429 from
+    FCM only slows down FCM traffic.
+    """
+
+    def __init__(self, client=None):
+        self.client = client or get_redis()
+        self._acquire = self.client.register_script(ACQUIRE_SCRIPT)
+        self._throttle = self.client.register_script(THROTTLE_SCRIPT)
+        self._recover = self.client.register_script(RECOVER_SCRIPT)
+
+    @staticmethod
+    def _keys(origin: str) -> Tuple[str, str]:
+        return f"webpush:ratelimit:{origin}", f"webpush:ratelimit:{origin}:blocked"
+
+    @staticmethod
+    def initial_rate(origin: str) -> float:
+        return settings.PUSH_RATE_LIMITS.get(urlsplit(origin).hostname, settings.PUSH_DEFAULT_RATE)
+
+    def acquire(self, origin: str, count: int) -> Tuple[int, float]:
+        """
+        Take up to count tokens. Returns how many were granted and, if fewer
+        than requested, how many seconds until more become available.
+        """
+        granted, wait_ms = self._acquire(
+            keys=self._keys(origin),
+            args=[count, self.initial_rate(origin), settings.PUSH_RATE_BURST_SECONDS],
+        )
+        return int(granted), int(wait_ms) / 1000
+
+    def throttled(self, origin: str, retry_after: Optional[float] = None) -> float:
+        """Halve the origin's rate and block it until Retry-After has passed"""
+        block_seconds = retry_after if retry_after else settings.PUSH_THROTTLE_BACKOFF
+        rate = self._throttle(
+            keys=self._keys(origin),
+            args=[
+                self.initial_rate(origin),
+                settings.PUSH_MIN_RATE,
+                settings.PUSH_RATE_DECREASE_FACTOR,
+                max(int(block_seconds * 1000), 1),
+            ],
+        )
+        logger.warning(f"Push service {origin} throttled us; rate now {float(rate):.0f}/s, blocked {block_seconds}s")
+        return block_seconds
+
+    def recovered(self, origin: str):
+        """Raise the origin's rate after a batch went through unthrottled"""
+        self._recover(
+            keys=self._keys(origin),
+            args=[self.initial_rate(origin), settings.PUSH_MAX_RATE, settings.PUSH_RATE_INCREASE],
+        )
+
+_limiter: Optional[PushServiceRateLimiter] = None
+
+def get_rate_limiter() -> PushServiceRateLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = PushServiceRateLimiter()
+    return _limiter
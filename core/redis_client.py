@@ -0,0 +1,36 @@
+from typing import Dict, Optional
+import redis
+import redis.asyncio
+
+from config.settings import settings
+
+_clients: Dict[bool, redis.Redis] = {}
+_async_client: Optional[redis.asyncio.Redis] = None
+
+def get_redis(binary: bool = False) -> redis.Redis:
+    """
+    Return the process-wide Redis client, created on first use. The binary
+    client leaves values as bytes, for serialized structures such as bitmaps.
+    """
+    client = _clients.get(binary)
+    if client is None:
+        client = redis.Redis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.REDIS_DB,
+            decode_responses=not binary
+        )
+        _clients[binary] = client
+    return client
+
+def get_async_redis() -> redis.asyncio.Redis:
+    """Process-wide asyncio Redis client, for request handlers on the event loop"""
+    global _async_client
+    if _async_client is None:
+        _async_client = redis.asyncio.Redis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.REDIS_DB,
+            decode_responses=True
+        )
+    return _async_client
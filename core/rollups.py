@@ -0,0 +1,223 @@
+"""
+Pre-aggregated delivery and engagement counters.
+
+Delivery outcomes and tracking events add to hourly counter rows as they are
+written, instead of analytics counting delivery_statuses at read time:
+
+    notification_rollups   (notification_id, segment_name, hour) + campaign_id
+    segment_rollups        (segment_name, hour)
+    segment_daily_rollups  (segment_name, day)
+
+Campaign, notification and segment views sum a handful of rollup rows, so
+their cost does not grow with the number of pushes sent.
+
+Every key is split over ROLLUP_SLOTS rows and each write adds to one picked
+at random. Otherwise every delivery transaction would queue on the same
+('all', hour) rows, whose locks are held until the statuses commit.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+import random
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from sqlalchemy import func, select, union_all
+from sqlalchemy.dialects.postgresql import insert
+
+from config.settings import settings
+from core.models import (
+    Notification, NotificationRollup, NotificationSegment, SegmentDailyRollup, SegmentRollup
+)
+
+COUNTERS = ("sent", "delivered", "failed", "opened", "clicked", "converted")
+
+# Every increment is also recorded under this segment name, so its rows hold
+# a notification's totals however many segments it targeted
+ALL_SUBSCRIBERS = "all"
+
+# Tracking and webhook event types and the counter each one increments
+EVENT_COUNTERS = {
+    "sent": "sent",
+    "failed": "failed",
+    "delivery": "delivered",
+    "delivered": "delivered",
+    "open": "opened",
+    "opened": "opened",
+    "click": "clicked",
+    "clicked": "clicked",
+    "conversion": "converted",
+    "converted": "converted",
+}
+
+# (notification_id, hour) -> counter -> amount
+Increments = Dict[Tuple[int, datetime], Counter]
+# notification_id -> (campaign_id, segment names)
+Dimensions = Dict[int, Tuple[Optional[int], List[str]]]
+
+def hour_bucket(at: datetime) -> datetime:
+    return at.replace(minute=0, second=0, microsecond=0)
+
+def day_bucket(at: datetime) -> datetime:
+    return at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def notification_dimensions(conn, notification_ids: Iterable[int]) -> Dimensions:
+    """Campaign and targeted segment names of each notification"""
+    notification_ids = list(set(notification_ids))
+    if not notification_ids:
+        return {}
+    dimensions: Dimensions = {
+        notification_id: (campaign_id, [])
+        for notification_id, campaign_id in conn.execute(
+            select(Notification.id, Notification.campaign_id).where(Notification.id.in_(notification_ids))
+        )
+    }
+    segments = conn.execute(
+        select(NotificationSegment.notification_id, NotificationSegment.segment_name)
+        .where(NotificationSegment.notification_id.in_(notification_ids))
+    )
+    for notification_id, segment_name in segments:
+        dimensions[notification_id][1].append(segment_name)
+    return dimensions
+
+def _upsert(model, rows: List[Dict], key: Tuple[str, ...], constraint: str):
+    # Rows in key order, so concurrent writers lock them in the same order
+    rows.sort(key=lambda row: tuple(row[column] for column in key))
+    stmt = insert(model).values(rows)
+    return stmt.on_conflict_do_update(
+        constraint=constraint,
+        set_={counter: getattr(model, counter) + getattr(stmt.excluded, counter) for counter in COUNTERS}
+    )
+
+def increment_statements(increments: Increments, dimensions: Dimensions, slot: int = 0) -> list:
+    """
+    INSERT ... ON CONFLICT DO UPDATE statements adding the increments to the
+    slot's rows of the rollup tables. Notifications missing from dimensions
+    are skipped.
+    """
+    notification_rows: Dict[Tuple, Dict] = {}
+    segment_rows: Dict[Tuple, Dict] = {}
+    daily_rows: Dict[Tuple, Dict] = {}
+
+    for (notification_id, bucket), counts in increments.items():
+        if notification_id not in dimensions:
+            continue
+        campaign_id, segment_names = dimensions[notification_id]
+        for segment_name in {ALL_SUBSCRIBERS, *segment_names}:
+            row = notification_rows.setdefault((notification_id, segment_name, bucket), {
+                "notification_id": notification_id,
+                "campaign_id": campaign_id,
+                "segment_name": segment_name,
+                "bucket": bucket,
+                "slot": slot,
+                **dict.fromkeys(COUNTERS, 0),
+            })
+            segment_row = segment_rows.setdefault((segment_name, bucket), {
+                "segment_name": segment_name,
+                "bucket": bucket,
+                "slot": slot,
+                **dict.fromkeys(COUNTERS, 0),
+            })
+            daily_row = daily_rows.setdefault((segment_name, day_bucket(bucket)), {
+                "segment_name": segment_name,
+                "bucket": day_bucket(bucket),
+                "slot": slot,
+                **dict.fromkeys(COUNTERS, 0),
+            })
+            for counter, amount in counts.items():
+                row[counter] += amount
+                segment_row[counter] += amount
+                daily_row[counter] += amount
+
+    if not notification_rows:
+        return []
+    return [
+        _upsert(NotificationRollup, list(notification_rows.values()),
+                ("notification_id", "segment_name", "bucket"), "uq_notification_rollups_key"),
+        _upsert(SegmentRollup, list(segment_rows.values()),
+                ("segment_name", "bucket"), "uq_segment_rollups_key"),
+        _upsert(SegmentDailyRollup, list(daily_rows.values()),
+                ("segment_name", "bucket"), "uq_segment_daily_rollups_key"),
+    ]
+
+def record(conn, increments: Increments, dimensions: Optional[Dimensions] = None):
+    """Apply increments on conn (a Connection or Session), inside the caller's transaction"""
+    increments = {key: counts for key, counts in increments.items() if counts}
+    if not increments:
+        return
+    if dimensions is None:
+        dimensions = notification_dimensions(conn, (notification_id for notification_id, _ in increments))
+    slot = random.randrange(settings.ROLLUP_SLOTS)
+    for statement in increment_statements(increments, dimensions, slot):
+        conn.execute(statement)
+
+def record_events(conn, events: Iterable[Tuple[int, str, datetime]]) -> int:
+    """
+    Count (notification_id, event_type, occurred_at) tracking events into the
+    rollups; event types without a counter are ignored. Returns the number counted.
+    """
+    increments: Increments = defaultdict(Counter)
+    counted = 0
+    for notification_id, event_type, occurred_at in events:
+        counter = EVENT_COUNTERS.get(event_type)
+        if counter is None or notification_id is None:
+            continue
+        try:
+            notification_id = int(notification_id)
+        except (TypeError, ValueError):
+            continue
+        increments[(notification_id, hour_bucket(occurred_at))][counter] += 1
+        counted += 1
+    record(conn, increments)
+    return counted
+
+def summed(model) -> list:
+    """SUM() of every counter of a rollup model, labelled with the counter name"""
+    return [func.coalesce(func.sum(getattr(model, counter)), 0).label(counter) for counter in COUNTERS]
+
+def segment_totals(conn, start: datetime, end: datetime, segment_names: Optional[List[str]] = None):
+    """
+    Counters per segment over [start, end] in one grouped query. Whole UTC days
+    are read from the daily rollups and only the partial days at either end
+    from the hourly ones, so a year costs about as much as a week.
+    """
+    def part(model, *conditions):
+        query = select(model.segment_name, *(getattr(model, counter) for counter in COUNTERS)).where(*conditions)
+        if segment_names is not None:
+            query = query.where(model.segment_name.in_(segment_names))
+        return query
+
+    first_day = day_bucket(start)
+    if first_day < start:
+        first_day += timedelta(days=1)
+    last_day = day_bucket(end)
+
+    if first_day >= last_day:
+        parts = [part(SegmentRollup, SegmentRollup.bucket >= hour_bucket(start), SegmentRollup.bucket <= end)]
+    else:
+        parts = [
+            part(SegmentRollup, SegmentRollup.bucket >= hour_bucket(start), SegmentRollup.bucket < first_day),
+            part(SegmentDailyRollup, SegmentDailyRollup.bucket >= first_day, SegmentDailyRollup.bucket < last_day),
+            part(SegmentRollup, SegmentRollup.bucket >= last_day, SegmentRollup.bucket <= end),
+        ]
+
+    facts = union_all(*parts).subquery()
+    return conn.execute(
+        select(
+            facts.c.segment_name,
+            *(func.sum(facts.c[counter]).label(counter) for counter in COUNTERS)
+        ).group_by(facts.c.segment_name)
+    )
+
+def rates(counts: Mapping[str, int]) -> Dict[str, float]:
+    """Delivery, open, click and conversion rates in percent of pushes sent"""
+    sent = counts.get("sent", 0)
+    attempted = sent + counts.get("failed", 0)
+
+    def percent(value: int, total: int) -> float:
+        return round(value / total * 100, 2) if total > 0 else 0.0
+
+    return {
+        "delivery_rate": percent(counts.get("delivered", 0), attempted),
+        "open_rate": percent(counts.get("opened", 0), sent),
+        "ctr": percent(counts.get("clicked", 0), sent),
+        "conversion_rate": percent(counts.get("converted", 0), sent),
+    }
@@ -0,0 +1,288 @@
+"""
+Materialized segment membership: one compressed roaring bitmap of
+subscription ids per named segment, stored in Redis.
+
+A bitmap is built once when its segment is created and then maintained
+incrementally from profile changes, so audiences for unions and
+intersections of segments are computed in memory and their sizes come
+for free. Subscriptions are written outside this service, so no profile
+change reports a new subscription or one linked to another user: those
+created since the last pass are reconciled before a send is planned, and
+all subscriptions every SEGMENT_RECONCILE_INTERVAL. Segments with relative durations in their rules (">30d") change
+membership as time passes, so they are never materialized and are always
+evaluated from their SQL rules.
+
+While a build scans, profile changes are not applied to the bitmap; the
+affected subscription ids are queued instead and re-evaluated once the new
+bitmap is stored, so no change is lost between the scan and the write.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import logging
+
+from pyroaring import BitMap
+from redis.exceptions import WatchError
+from sqlalchemy import case
+
+from config.settings import settings
+from core.database import iter_keyset
+from core.models import NotificationSegment, Subscription, UserProfile
+from core.redis_client import get_redis
+from core.segments import compile_rules, is_time_relative, resolve_segment_rules
+
+logger = logging.getLogger(__name__)
+
+BITMAP_KEY = "webpush:segment:bitmap:{}"
+BUILDING_KEY = "webpush:segment:building:{}"
+PENDING_KEY = "webpush:segment:pending:{}"
+# Highest subscription id the bitmaps were reconciled up to
+RECONCILED_KEY = "webpush:segment:reconciled"
+
+# A crashed build stops diverting changes after this long
+BUILD_TIMEOUT = 3600
+
+def _key(segment_name: str) -> str:
+    return BITMAP_KEY.format(segment_name)
+
+def named_segments(db) -> List[Tuple[str, dict]]:
+    """(name, rules) of the segments saved through /api/segments, newest definition wins"""
+    rows = (
+        db.query(NotificationSegment.segment_name, NotificationSegment.targeting_rules)
+        .filter(NotificationSegment.notification_id.is_(None))
+        .order_by(NotificationSegment.id)
+        .all()
+    )
+    return list({name: rules for name, rules in rows}.items())
+
+def _evaluate(db, predicate, subscription_ids: Sequence[int]) -> Tuple[BitMap, BitMap]:
+    """(added, removed): which of the subscriptions match the predicate now"""
+    rows = (
+        db.query(Subscription.id, Subscription.active, case((predicate, True), else_=False))
+        .outerjoin(UserProfile, UserProfile.user_id == Subscription.user_id)
+        .filter(Subscription.id.in_(list(subscription_ids)))
+        .all()
+    )
+    added, removed = BitMap(), BitMap(subscription_ids)
+    for subscription_id, active, matches in rows:
+        if active and matches:
+            added.add(subscription_id)
+            removed.discard(subscription_id)
+    return added, removed
+
+def _patch(segment_name: str, added: BitMap, removed: BitMap):
+    """Read-modify-write one stored bitmap, retrying if another worker changed it meanwhile"""
+    client = get_redis(binary=True)
+    key = _key(segment_name)
+    with client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                blob = pipe.get(key)
+                bitmap = BitMap.deserialize(blob) if blob is not None else BitMap()
+                bitmap |= added
+                bitmap -= removed
+                pipe.multi()
+                pipe.set(key, bitmap.serialize())
+                pipe.execute()
+                return
+            except WatchError:
+                continue
+
+def _replay_pending(db, segment_name: str, predicate):
+    """Re-evaluate the subscriptions changed during a build, then end the build"""
+    client = get_redis(binary=True)
+    pending_key = PENDING_KEY.format(segment_name)
+    with client.pipeline() as pipe:
+        while True:
+            ids = [int(member) for member in client.spop(pending_key, 10000) or ()]
+            if ids:
+                _patch(segment_name, *_evaluate(db, predicate, ids))
+                continue
+            try:
+                # Stop diverting changes only once nothing is queued, atomically
+                pipe.watch(pending_key)
+                if pipe.scard(pending_key):
+                    pipe.unwatch()
+                    continue
+                pipe.multi()
+                pipe.delete(BUILDING_KEY.format(segment_name))
+                pipe.execute()
+                return
+            except WatchError:
+                continue
+
+def build_segment_bitmap(db, segment_name: str, rules: dict) -> int:
+    """Evaluate a segment over all live subscriptions and store its bitmap"""
+    client = get_redis(binary=True)
+    if is_time_relative(rules):
+        client.delete(_key(segment_name))
+        logger.info(f"Segment {segment_name} has relative durations; it is evaluated per send, not materialized")
+        return 0
+
+    predicate = compile_rules(rules)
+    # Divert profile changes to the pending set until the new bitmap is stored
+    client.set(BUILDING_KEY.format(segment_name), 1, ex=BUILD_TIMEOUT)
+    bitmap = BitMap()
+    rows = iter_keyset(
+        db,
+        Subscription.id,
+        where=(
+            Subscription.active,
+            Subscription.user_id.in_(db.query(UserProfile.user_id).filter(predicate)),
+        )
+    )
+    for (subscription_id,) in rows:
+        bitmap.add(subscription_id)
+
+    client.set(_key(segment_name), bitmap.serialize())
+    _replay_pending(db, segment_name, predicate)
+    logger.info(f"Built bitmap for segment {segment_name} with {len(bitmap)} subscriptions")
+    return len(bitmap)
+
+def load_bitmaps(segment_names: Sequence[str]) -> Dict[str, Optional[BitMap]]:
+    """Fetch several segment bitmaps in one round trip; missing ones are None"""
+    if not segment_names:
+        return {}
+    blobs = get_redis(binary=True).mget([_key(name) for name in segment_names])
+    return {
+        name: BitMap.deserialize(blob) if blob is not None else None
+        for name, blob in zip(segment_names, blobs)
+    }
+
+def combine(bitmaps: Iterable[BitMap], mode: str = "union") -> BitMap:
+    bitmaps = list(bitmaps)
+    if not bitmaps:
+        return BitMap()
+    if mode == "intersection":
+        return BitMap.intersection(*bitmaps)
+    return BitMap.union(*bitmaps)
+
+def audience(segment_names: Sequence[str], mode: str = "union") -> BitMap:
+    """Union or intersection of segment memberships; unknown segments count as empty"""
+    bitmaps = load_bitmaps(segment_names)
+    return combine((bitmap if bitmap is not None else BitMap() for bitmap in bitmaps.values()), mode)
+
+def notification_bitmap(db, notification) -> Optional[BitMap]:
+    """
+    Audience of a notification from materialized bitmaps, or None when any of
+    its segments carries its own rules, is time-relative or has no bitmap yet
+    """
+    segments = notification.segments
+    if not segments:
+        return None
+    names = []
+    for segment in segments:
+        rules = segment.targeting_rules or {}
+        if any(value is not None for value in rules.values()):
+            return None
+        if is_time_relative(resolve_segment_rules(db, segment)):
+            return None
+        names.append(segment.segment_name)
+    bitmaps = load_bitmaps(names)
+    if any(bitmap is None for bitmap in bitmaps.values()):
+        return None
+    return combine(bitmaps.values())
+
+def _apply_changes(segment_name: str, added: BitMap, removed: BitMap):
+    """Patch one bitmap, or queue the subscriptions for the build in progress"""
+    changed = added | removed
+    if not changed:
+        return
+    client = get_redis(binary=True)
+    key, building_key = _key(segment_name), BUILDING_KEY.format(segment_name)
+    with client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key, building_key)
+                if pipe.exists(building_key):
+                    # The build re-evaluates these once its bitmap is stored
+                    pipe.multi()
+                    pipe.sadd(PENDING_KEY.format(segment_name), *changed)
+                    pipe.execute()
+                    return
+                blob = pipe.get(key)
+                if blob is None:
+                    # Never built; a build that starts later scans the committed profiles
+                    pipe.unwatch()
+                    return
+                bitmap = BitMap.deserialize(blob)
+                bitmap |= added
+                bitmap -= removed
+                pipe.multi()
+                pipe.set(key, bitmap.serialize())
+                pipe.execute()
+                return
+            except WatchError:
+                continue
+
+def _materialized_segments(db) -> List[Tuple[str, dict]]:
+    # Time-relative segments are never materialized
+    return [(name, rules) for name, rules in named_segments(db) if not is_time_relative(rules)]
+
+def _membership_query(db, segments: List[Tuple[str, dict]]):
+    """(id, active, matches segment 0, matches segment 1, ...) of subscriptions, in one query"""
+    columns = [
+        case((compile_rules(rules), True), else_=False).label(f"s{i}")
+        for i, (_, rules) in enumerate(segments)
+    ]
+    return (
+        db.query(Subscription.id, Subscription.active, *columns)
+        .outerjoin(UserProfile, UserProfile.user_id == Subscription.user_id)
+    )
+
+def _patch_memberships(segments: List[Tuple[str, dict]], rows) -> Dict[str, int]:
+    changes = {}
+    for i, (name, _) in enumerate(segments):
+        added, removed = BitMap(), BitMap()
+        for row in rows:
+            # No profile (outer join miss) never matches
+            matches = bool(row[2 + i]) and row.active
+            (added if matches else removed).add(row.id)
+        _apply_changes(name, added, removed)
+        changes[name] = len(added)
+    return changes
+
+def update_memberships(db, user_ids: Sequence[str]) -> Dict[str, int]:
+    """
+    Re-evaluate every named segment for the subscriptions of the given users
+    only, in one query, and patch the bitmaps. Returns how many of those
+    subscriptions now belong to each segment.
+    """
+    segments = _materialized_segments(db)
+    if not segments or not user_ids:
+        return {}
+    rows = _membership_query(db, segments).filter(Subscription.user_id.in_(list(user_ids))).all()
+    return _patch_memberships(segments, rows)
+
+def reconcile_memberships(db, new_only: bool = False) -> int:
+    """
+    Re-evaluate every named segment for all subscriptions, or with new_only
+    for those created since the last pass, a keyset page at a time, and patch
+    the bitmaps. Returns how many subscriptions were evaluated.
+    """
+    segments = _materialized_segments(db)
+    if not segments:
+        return 0
+
+    client = get_redis(binary=True)
+    reconciled = int(client.get(RECONCILED_KEY) or 0)
+    last_id = reconciled if new_only else 0
+    evaluated = 0
+    while True:
+        rows = (
+            _membership_query(db, segments)
+            .filter(Subscription.id > last_id)
+            .order_by(Subscription.id)
+            .limit(settings.STREAM_PAGE_SIZE)
+            .all()
+        )
+        if not rows:
+            break
+        _patch_memberships(segments, rows)
+        evaluated += len(rows)
+        last_id = rows[-1].id
+        if last_id > reconciled:
+            reconciled = last_id
+            client.set(RECONCILED_KEY, reconciled)
+        if len(rows) < settings.STREAM_PAGE_SIZE:
+            break
+    return evaluated
@@ -0,0 +1,238 @@
+"""
+Compiles segment targeting rules into SQL predicates over user_profiles.
+
+Rules are the SegmentCondition fields (loyalty_tier, last_purchase, country)
+plus an optional custom_rules tree:
+
+    {"and": [rule, ...]}, {"or": [rule, ...]}, {"not": rule}
+    {"field": "purchase_history", "op": ">=", "value": 2}
+    {"country": "TR", "last_activity": ">7d", "purchase_history": ">=2"}
+
+Fields other than the profile columns are read from the attributes JSONB.
+Relative durations such as ">7d" ("more than 7 days ago") are evaluated
+against the database clock, so a compiled predicate never goes stale and
+can be cached for the life of the process.
+"""
+from datetime import timedelta
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Optional
+import json
+import re
+
+from sqlalchemy import DateTime, and_, cast, false, func, not_, or_, select, true
+from sqlalchemy.sql.elements import ColumnElement
+
+from core.models import NotificationSegment, Subscription, UserProfile
+
+class SegmentRuleError(ValueError):
+    """Raised for targeting rules that cannot be compiled"""
+
+PROFILE_COLUMNS = {
+    "user_id": UserProfile.user_id,
+    "loyalty_tier": UserProfile.loyalty_tier,
+    "country": UserProfile.country,
+    "last_purchase": UserProfile.last_purchase_at,
+    "last_purchase_at": UserProfile.last_purchase_at,
+}
+
+OPERATORS = {
+    "=": "eq", "==": "eq", "eq": "eq",
+    "!=": "ne", "ne": "ne",
+    ">": "gt", "gt": "gt",
+    ">=": "gte", "gte": "gte",
+    "<": "lt", "lt": "lt",
+    "<=": "lte", "lte": "lte",
+    "in": "in", "not_in": "not_in",
+    "exists": "exists",
+}
+
+# ">=2", "<30d", "TR"
+OPERATOR_PREFIX = re.compile(r"^\s*(>=|<=|!=|==|>|<|=)\s*(.+?)\s*$")
+DURATION = re.compile(r"^(\d+)\s*([mhdw])$")
+DURATION_UNITS = {"m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+
+def _utc_now():
+    return func.timezone("utc", func.now())
+
+def parse_duration(value: Any) -> Optional[timedelta]:
+    if not isinstance(value, str):
+        return None
+    match = DURATION.match(value.strip())
+    if not match:
+        return None
+    return timedelta(**{DURATION_UNITS[match.group(2)]: int(match.group(1))})
+
+def is_time_relative(rules: Any) -> bool:
+    """
+    Whether rules hold a relative duration such as ">30d", so the users they
+    match change as time passes, not only when profiles change
+    """
+    if isinstance(rules, dict):
+        return any(is_time_relative(value) for value in rules.values())
+    if isinstance(rules, list):
+        return any(is_time_relative(value) for value in rules)
+    if isinstance(rules, str):
+        match = OPERATOR_PREFIX.match(rules)
+        return parse_duration(match.group(2) if match else rules) is not None
+    return False
+
+def _coerce(value: str) -> Any:
+    """Turn the operand of a shorthand string rule into a number where possible"""
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def _compare(column, op: str, value: Any) -> ColumnElement:
+    if op == "eq":
+        return column.in_(value) if isinstance(value, list) else column == value
+    if op == "ne":
+        return column.notin_(value) if isinstance(value, list) else column != value
+    if op == "in":
+        return column.in_(list(value))
+    if op == "not_in":
+        return column.notin_(list(value))
+    if op == "gt":
+        return column > value
+    if op == "gte":
+        return column >= value
+    if op == "lt":
+        return column < value
+    if op == "lte":
+        return column <= value
+    raise SegmentRuleError(f"Unsupported operator {op!r}")
+
+def _field_condition(field: str, op: str, value: Any) -> ColumnElement:
+    if op not in OPERATORS:
+        raise SegmentRuleError(f"Unsupported operator {op!r} for field {field!r}")
+    op = OPERATORS[op]
+    column = PROFILE_COLUMNS.get(field)
+
+    if op == "exists":
+        if column is not None:
+            return column.isnot(None) if value in (None, True) else column.is_(None)
+        has_key = UserProfile.attributes.has_key(field)
+        return has_key if value in (None, True) else not_(has_key)
+
+    duration = parse_duration(value)
+    if duration is not None:
+        # ">7d" means longer ago than 7 days, i.e. an earlier timestamp;
+        # a bare "7d" means within the last 7 days
+        if op == "eq":
+            op = "lt"
+        if column is None:
+            column = cast(UserProfile.attributes[field].astext, DateTime)
+        flipped = {"gt": "lt", "gte": "lte", "lt": "gt", "lte": "gte"}.get(op, op)
+        return _compare(column, flipped, _utc_now() - duration)
+
+    if column is not None:
+        return _compare(column, op, value)
+
+    if op == "eq" and not isinstance(value, list):
+        # Containment is answered from the GIN index on attributes
+        return UserProfile.attributes.contains({field: value})
+
+    sample = value[0] if isinstance(value, list) and value else value
+    element = UserProfile.attributes[field]
+    if isinstance(sample, bool):
+        column = element.as_boolean()
+    elif isinstance(sample, (int, float)):
+        column = element.as_float()
+    else:
+        column = element.as_string()
+    return _compare(column, op, value)
+
+def compile_condition(rule: Any) -> ColumnElement:
+    """Compile one node of a custom_rules tree"""
+    if not isinstance(rule, dict):
+        raise SegmentRuleError(f"Rule must be an object, got {rule!r}")
+
+    if "and" in rule or "or" in rule:
+        combinator, children = ("and", rule["and"]) if "and" in rule else ("or", rule["or"])
+        if not isinstance(children, list):
+            raise SegmentRuleError(f"'{combinator}' expects a list of rules")
+        compiled = [compile_condition(child) for child in children]
+        if not compiled:
+            return true() if combinator == "and" else false()
+        return and_(*compiled) if combinator == "and" else or_(*compiled)
+
+    if "not" in rule:
+        return not_(compile_condition(rule["not"]))
+
+    if "field" in rule:
+        return _field_condition(rule["field"], rule.get("op", "eq"), rule.get("value"))
+
+    # Shorthand: {"country": "TR", "purchase_history": ">=2"}
+    clauses = []
+    for field, value in rule.items():
+        match = OPERATOR_PREFIX.match(value) if isinstance(value, str) else None
+        if match:
+            clauses.append(_field_condition(field, match.group(1), _coerce(match.group(2))))
+        else:
+            clauses.append(_field_condition(field, "eq", value))
+    return and_(true(), *clauses)
+
+@lru_cache(maxsize=1024)
+def _compile_cached(rules_json: str) -> ColumnElement:
+    rules = json.loads(rules_json)
+    clauses = []
+    for field in ("loyalty_tier", "country"):
+        if rules.get(field) is not None:
+            clauses.append(_field_condition(field, "eq", rules[field]))
+    if rules.get("last_purchase") is not None:
+        clauses.append(compile_condition({"last_purchase": rules["last_purchase"]}))
+    if rules.get("custom_rules"):
+        clauses.append(compile_condition(rules["custom_rules"]))
+    return and_(true(), *clauses)
+
+def compile_rules(rules: Optional[Dict[str, Any]]) -> ColumnElement:
+    """
+    Compile SegmentCondition-shaped rules into a predicate over UserProfile.
+    Plans are cached by their canonical JSON, so each segment compiles once.
+    """
+    return _compile_cached(json.dumps(rules or {}, sort_keys=True, default=str))
+
+def subscription_filter(predicates: Iterable[ColumnElement]) -> Optional[ColumnElement]:
+    """
+    Restrict subscriptions to users matching any of the predicates, as a single
+    semi-join against user_profiles
+    """
+    predicates = list(predicates)
+    if not predicates:
+        return None
+    return Subscription.user_id.in_(
+        select(UserProfile.user_id).where(or_(*predicates))
+    )
+
+def resolve_segment_rules(db, segment: NotificationSegment) -> Optional[Dict[str, Any]]:
+    """
+    Rules of a notification's segment: its own targeting_rules, or those of the
+    named segment created through /api/segments
+    """
+    rules = segment.targeting_rules or {}
+    if any(value is not None for value in rules.values()):
+        return rules
+    named = (
+        db.query(NotificationSegment.targeting_rules)
+        .filter(
+            NotificationSegment.notification_id.is_(None),
+            NotificationSegment.segment_name == segment.segment_name
+        )
+        .order_by(NotificationSegment.id.desc())
+        .first()
+    )
+    if named is None:
+        raise SegmentRuleError(f"Unknown segment {segment.segment_name!r}")
+    return named.targeting_rules
+
+def notification_filter(db, notification) -> Optional[ColumnElement]:
+    """
+    Subscription filter for a notification's segments; None means everyone
+    """
+    return subscription_filter(
+        compile_rules(resolve_segment_rules(db, segment)) for segment in notification.segments
+    )
@@ -0,0 +1,160 @@
+"""
+Compiled notification templates.
+
+Templates use str.format placeholders ("Merhaba {name}"). Each template is
+parsed once into a printf-style format string plus the ordered list of
+variables it reads, so rendering for one subscriber is an itemgetter call
+and a C-level string interpolation. Compiled templates are kept in a per-process LRU
+cache keyed by template id and version.
+"""
+from collections import OrderedDict
+from operator import itemgetter
+from string import Formatter
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, Iterator, Mapping, Optional, Sequence, Tuple
+
+from config.settings import settings
+
+class TemplateError(ValueError):
+    """Raised for templates that cannot be compiled"""
+
+_formatter = Formatter()
+
+def _compile_text(text: str) -> Tuple[str, Tuple[str, ...]]:
+    """Turn "Hi {name}" into ("Hi %s", ("name",))"""
+    parts = []
+    fields = []
+    try:
+        parsed = list(_formatter.parse(text))
+    except ValueError as e:
+        raise TemplateError(f"Invalid template {text!r}: {e}")
+
+    for literal, field, spec, conversion in parsed:
+        parts.append(literal.replace("%", "%%"))
+        if field is None:
+            continue
+        if not field.isidentifier():
+            # Rejects positional "{}" and attribute/index access like "{user.__class__}"
+            raise TemplateError(f"Invalid placeholder {{{field}}}; use a plain variable name")
+        if spec or conversion:
+            raise TemplateError(f"Format specs and conversions are not supported in {{{field}}}")
+        parts.append("%s")
+        fields.append(field)
+    return "".join(parts), tuple(fields)
+
+def _tuple_getter(fields: Tuple[str, ...]) -> Callable[[Mapping[str, Any]], tuple]:
+    """itemgetter that always returns a tuple, whatever the number of fields"""
+    if not fields:
+        return lambda values: ()
+    if len(fields) == 1:
+        field = fields[0]
+        return lambda values: (values[field],)
+    return itemgetter(*fields)
+
+class CompiledTemplate:
+    """A title/body pair reduced to printf format strings and tuple getters"""
+
+    def __init__(self, title_format: str, title_fields: Tuple[str, ...],
+                 body_format: str, body_fields: Tuple[str, ...], default: str = ""):
+        self.title_format = title_format
+        self.title_fields = title_fields
+        self.body_format = body_format
+        self.body_fields = body_fields
+        self.default = default
+        self._title_getter = _tuple_getter(title_fields)
+        self._body_getter = _tuple_getter(body_fields)
+
+    @property
+    def fields(self) -> Tuple[str, ...]:
+        return tuple(dict.fromkeys(self.title_fields + self.body_fields))
+
+    def _args(self, getter, fields: Tuple[str, ...], values: Mapping[str, Any]) -> tuple:
+        try:
+            args = getter(values)
+        except KeyError:
+            args = tuple(values.get(field) for field in fields)
+        if None in args:
+            args = tuple(self.default if arg is None else arg for arg in args)
+        return args
+
+    def render(self, values: Mapping[str, Any]) -> Tuple[str, str]:
+        """Render (title, body); missing or null variables render as the default"""
+        return (
+            self.title_format % self._args(self._title_getter, self.title_fields, values),
+            self.body_format % self._args(self._body_getter, self.body_fields, values),
+        )
+
+def compile_template(title_template: str, body_template: str,
+                     variables: Optional[Sequence[str]] = None) -> CompiledTemplate:
+    """
+    Compile a title/body pair. When variables is given, every placeholder must
+    be one of them.
+    """
+    title_format, title_fields = _compile_text(title_template)
+    body_format, body_fields = _compile_text(body_template)
+
+    if variables is not None:
+        invalid = [name for name in variables if not isinstance(name, str) or not name.isidentifier()]
+        if invalid:
+            raise TemplateError(f"Invalid variable names: {', '.join(map(repr, invalid))}")
+        undeclared = sorted(set(title_fields + body_fields) - set(variables))
+        if undeclared:
+            raise TemplateError(f"Placeholders not declared in variables: {', '.join(undeclared)}")
+
+    return CompiledTemplate(title_format, title_fields, body_format, body_fields)
+
+class TemplateCache:
+    """Per-process LRU of compiled templates keyed by (template id, version)"""
+
+    def __init__(self, maxsize: Optional[int] = None):
+        self.maxsize = maxsize if maxsize is not None else settings.TEMPLATE_CACHE_SIZE
+        self._entries: "OrderedDict[Tuple[int, int], CompiledTemplate]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, template) -> CompiledTemplate:
+        key = (template.id, template.version or 1)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        compiled = compile_template(template.title_template, template.body_template)
+        with self._lock:
+            self._entries[key] = compiled
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_cache: Optional[TemplateCache] = None
+
+def get_template_cache() -> TemplateCache:
+    global _cache
+    if _cache is None:
+        _cache = TemplateCache()
+    return _cache
+
+def render_many(template, profiles: Iterable[Mapping[str, Any]],
+                defaults: Optional[Mapping[str, Any]] = None) -> Iterator[Tuple[str, str]]:
+    """
+    Render a stored template against a stream of profile dicts, lazily.
+    Values in defaults are used for variables a profile does not set.
+    """
+    render = get_template_cache().get(template).render
+    if not defaults:
+        for profile in profiles:
+            yield render(profile)
+        return
+    for profile in profiles:
+        values: Dict[str, Any] = dict(defaults)
+        values.update((key, value) for key, value in profile.items() if value is not None)
+        yield render(values)
@@ -0,0 +1,204 @@
+"""
+Ingestion of delivery, open, click and conversion beacons.
+
+The API validates each batch of events and appends it to a Redis stream as a
+single entry, so a request costs one round trip however many events it
+carries. workers.tracking_consumer reads the stream in large batches and
+applies them to delivery_statuses and the analytics rollups, one transaction
+per batch. The stream is only trimmed behind the consumers, so no entry is
+dropped before it is applied; when the consumers fall TRACKING_STREAM_MAXLEN
+entries behind, new beacons are refused instead.
+
+Each (notification, subscription, event type) is counted once: an event only
+counts if it is the first to set its timestamp column on the delivery status.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime
+from itertools import chain
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import json
+
+from sqlalchemy import DateTime, Integer, case, column, select, update, values
+
+from config.settings import settings
+from core import rollups
+from core.models import DeliveryStatus, Notification, NotificationTracking
+
+TRACKING_STREAM = "webpush:tracking:events"
+TRACKING_GROUP = "tracking-writers"
+# Entries that kept failing, with the last error, for inspection and replay
+TRACKING_DEAD_LETTER_STREAM = "webpush:tracking:dead-letter"
+
+# Appends an entry unless TRACKING_STREAM_MAXLEN entries are queued already
+APPEND_SCRIPT = """
+if redis.call('XLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+    return false
+end
+return redis.call('XADD', KEYS[1], '*', unpack(ARGV, 2))
+"""
+_append_script = None
+
+# Event type -> the DeliveryStatus timestamp it sets
+EVENT_COLUMNS = {
+    "delivery": "delivered_at",
+    "open": "opened_at",
+    "click": "clicked_at",
+    "conversion": "converted_at",
+}
+EVENT_ALIASES = {"delivered": "delivery", "opened": "open", "clicked": "click", "converted": "conversion"}
+
+# Event type -> the NotificationTracking switch that must be on for it to be recorded
+TRACKING_SWITCHES = {
+    "delivery": "enable_delivery_tracking",
+    "open": "enable_open_tracking",
+    "click": "enable_click_tracking",
+}
+
+# Status a delivery moves to, and the statuses it may move from
+STATUS_TRANSITIONS = {
+    "delivery": ("delivered", ("sent",)),
+    "click": ("clicked", ("sent", "delivered")),
+}
+
+# (event type, notification_id, subscription_id)
+Event = Tuple[str, int, int]
+
+class TrackingEventError(ValueError):
+    """Raised for a beacon batch that cannot be accepted"""
+
+def parse_events(payload: Any) -> List[Event]:
+    """
+    Validate a beacon body: a list of events, or {"events": [...]}, each with
+    type (or event), notification_id and subscription_id
+    """
+    if isinstance(payload, dict):
+        payload = payload.get("events")
+    if not isinstance(payload, list):
+        raise TrackingEventError("expected a list of events")
+    if len(payload) > settings.TRACKING_MAX_EVENTS_PER_REQUEST:
+        raise TrackingEventError(f"at most {settings.TRACKING_MAX_EVENTS_PER_REQUEST} events per request")
+
+    events = []
+    for index, event in enumerate(payload):
+        if not isinstance(event, dict):
+            raise TrackingEventError(f"event {index} must be an object")
+        event_type = event.get("type") or event.get("event")
+        event_type = EVENT_ALIASES.get(event_type, event_type)
+        if event_type not in EVENT_COLUMNS:
+            raise TrackingEventError(f"event {index} has unknown type {event_type!r}")
+        try:
+            events.append((event_type, int(event["notification_id"]), int(event["subscription_id"])))
+        except (KeyError, TypeError, ValueError):
+            raise TrackingEventError(f"event {index} needs integer notification_id and subscription_id")
+    return events
+
+def encode_entry(events: Sequence[Event], received_at: datetime) -> Dict[str, str]:
+    """Stream entry fields for one accepted batch"""
+    return {"received_at": received_at.isoformat(), "events": json.dumps(events, separators=(",", ":"))}
+
+async def append_entry(client, fields: Dict[str, str]) -> Optional[str]:
+    """Queue one entry in one round trip; None when the consumers are too far behind"""
+    global _append_script
+    if _append_script is None:
+        _append_script = client.register_script(APPEND_SCRIPT)
+    return await _append_script(
+        keys=[TRACKING_STREAM], args=[settings.TRACKING_STREAM_MAXLEN, *chain.from_iterable(fields.items())]
+    )
+
+def _stream_id(entry_id: str) -> Tuple[int, int]:
+    milliseconds, _, sequence = entry_id.partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+def trim_consumed(client):
+    """Trim the entries before the oldest one not yet acknowledged"""
+    group = next(group for group in client.xinfo_groups(TRACKING_STREAM) if group["name"] == TRACKING_GROUP)
+    oldest = group["last-delivered-id"]
+    pending = client.xpending(TRACKING_STREAM, TRACKING_GROUP)
+    if pending["pending"]:
+        oldest = min(oldest, pending["min"], key=_stream_id)
+    client.xtrim(TRACKING_STREAM, minid=oldest, approximate=True)
+
+def decode_entry(fields: Dict[str, str]) -> List[Tuple[str, int, int, datetime]]:
+    received_at = datetime.fromisoformat(fields["received_at"])
+    return [(event_type, notification_id, subscription_id, received_at)
+            for event_type, notification_id, subscription_id in json.loads(fields["events"])]
+
+def _disabled(conn, events: Iterable[Tuple[str, int, int, datetime]]) -> set:
+    """(event type, notification_id) pairs whose tracking is switched off"""
+    notification_ids = {notification_id for _, notification_id, _, _ in events}
+    disabled = set()
+    rows = conn.execute(
+        select(NotificationTracking.notification_id, *(
+            getattr(NotificationTracking, switch) for switch in TRACKING_SWITCHES.values()
+        )).where(NotificationTracking.notification_id.in_(notification_ids))
+    )
+    for notification_id, *switches in rows:
+        for event_type, enabled in zip(TRACKING_SWITCHES, switches):
+            if enabled is False:
+                disabled.add((event_type, notification_id))
+    return disabled
+
+def _created_at(conn, events: Iterable[Tuple[str, int, int, datetime]]) -> Dict[int, datetime]:
+    """Partition key of each notification's delivery statuses"""
+    notification_ids = {notification_id for _, notification_id, _, _ in events}
+    return dict(conn.execute(
+        select(Notification.id, Notification.created_at).where(Notification.id.in_(notification_ids))
+    ).all())
+
+def apply_events(conn, events: List[Tuple[str, int, int, datetime]]) -> Counter:
+    """
+    Stamp the delivery statuses the events refer to and add first-time events
+    to the rollups, inside the caller's transaction. Returns counts per type.
+    """
+    if not events:
+        return Counter()
+    disabled = _disabled(conn, events)
+    created_at = _created_at(conn, events)
+
+    by_type: Dict[str, Dict[Tuple[int, int], datetime]] = defaultdict(dict)
+    for event_type, notification_id, subscription_id, received_at in events:
+        if (event_type, notification_id) in disabled or notification_id not in created_at:
+            continue
+        # Earliest report of a repeated event wins
+        by_type[event_type].setdefault((notification_id, subscription_id), received_at)
+
+    increments: rollups.Increments = defaultdict(Counter)
+    counted = Counter()
+    for event_type in sorted(by_type):
+        timestamp = getattr(DeliveryStatus, EVENT_COLUMNS[event_type])
+        # Sorted so concurrent consumers lock delivery rows in the same order
+        rows = sorted((key[0], key[1], created_at[key[0]], at) for key, at in by_type[event_type].items())
+        tracked = values(
+            column("notification_id", Integer), column("subscription_id", Integer),
+            column("created_at", DateTime), column("at", DateTime),
+            name="tracked"
+        ).data(rows)
+        # Constant bounds, so the planner prunes to the batch's partitions
+        partition_keys = [row[2] for row in rows]
+
+        changes = {timestamp: tracked.c.at}
+        if event_type in STATUS_TRANSITIONS:
+            new_status, from_statuses = STATUS_TRANSITIONS[event_type]
+            changes[DeliveryStatus.status] = case(
+                (DeliveryStatus.status.in_(from_statuses), new_status), else_=DeliveryStatus.status
+            )
+
+        stamped = conn.execute(
+            update(DeliveryStatus)
+            .where(
+                DeliveryStatus.notification_created_at.between(min(partition_keys), max(partition_keys)),
+                DeliveryStatus.notification_created_at == tracked.c.created_at,
+                DeliveryStatus.notification_id == tracked.c.notification_id,
+                DeliveryStatus.subscription_id == tracked.c.subscription_id,
+                timestamp.is_(None)
+            )
+            .values(changes)
+            .returning(DeliveryStatus.notification_id, timestamp)
+        )
+        counter = rollups.EVENT_COUNTERS[event_type]
+        for notification_id, at in stamped:
+            increments[(notification_id, rollups.hour_bucket(at))][counter] += 1
+            counted[event_type] += 1
+
+    rollups.record(conn, increments)
+    return counted
@@ -0,0 +1,128 @@
+"""
+Registered webhook endpoints, routed from memory.
+
+Every process that routes or delivers webhook events keeps a WebhookRegistry:
+an index from event type to the active endpoints subscribed to it, loaded
+from the webhooks table. Writers call publish_change() after committing and
+each registry reloads on the notice, with a periodic full reload in case a
+notice was missed, so routing an event never reads the database.
+
+Batches are signed once per request body:
+
+    X-Webhook-Signature: t=<unix time>,v1=<hex HMAC-SHA256 of "<t>.<body>">
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import asyncio
+import hashlib
+import hmac
+import logging
+import time
+
+from config.settings import settings
+from core.database import SessionLocal
+from core.models import Webhook
+from core.redis_client import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+WEBHOOKS_CHANNEL = "webpush:webhooks:changed"
+SIGNATURE_HEADER = "X-Webhook-Signature"
+
+# Subscribes a webhook to every event type
+ALL_EVENTS = "*"
+
+@dataclass(frozen=True)
+class WebhookEndpoint:
+    id: int
+    url: str
+    secret: str
+
+def sign(secret: str, timestamp: int, body: bytes) -> str:
+    return hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+
+def signature_headers(secret: str, body: bytes, timestamp: Optional[int] = None) -> Dict[str, str]:
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    return {SIGNATURE_HEADER: f"t={timestamp},v1={sign(secret, timestamp, body)}"}
+
+async def publish_change():
+    """Tell every registry to reload; call after committing a webhook change"""
+    await get_async_redis().publish(WEBHOOKS_CHANNEL, "changed")
+
+class WebhookRegistry:
+    """
+    In-memory index of the active webhooks. Lookups read whatever index was
+    last loaded; a reload builds new dicts and swaps them in whole.
+    """
+
+    def __init__(self):
+        self._by_event: Dict[str, List[WebhookEndpoint]] = {}
+        self._all_events: List[WebhookEndpoint] = []
+        self._by_id: Dict[int, WebhookEndpoint] = {}
+
+    def load(self, db):
+        by_event: Dict[str, List[WebhookEndpoint]] = {}
+        all_events: List[WebhookEndpoint] = []
+        by_id: Dict[int, WebhookEndpoint] = {}
+
+        for webhook in db.query(Webhook).filter(Webhook.active).order_by(Webhook.id):
+            endpoint = WebhookEndpoint(webhook.id, webhook.url, webhook.secret)
+            by_id[endpoint.id] = endpoint
+            if ALL_EVENTS in webhook.events:
+                all_events.append(endpoint)
+            else:
+                for event_type in set(webhook.events):
+                    by_event.setdefault(event_type, []).append(endpoint)
+
+        # Wildcard subscribers are merged in once here rather than on every lookup
+        for event_type, endpoints in by_event.items():
+            endpoints.extend(all_events)
+        self._by_event, self._all_events, self._by_id = by_event, all_events, by_id
+        logger.debug(f"Loaded {len(by_id)} webhooks")
+
+    def reload(self):
+        db = SessionLocal()
+        try:
+            self.load(db)
+        finally:
+            db.close()
+
+    def endpoints_for(self, event_type: str) -> List[WebhookEndpoint]:
+        return self._by_event.get(event_type, self._all_events)
+
+    def get(self, webhook_id: int) -> Optional[WebhookEndpoint]:
+        return self._by_id.get(webhook_id)
+
+    async def listen(self):
+        """Reload on every change notice and every WEBHOOK_REGISTRY_REFRESH_INTERVAL; runs until cancelled"""
+        while True:
+            pubsub = get_async_redis().pubsub()
+            try:
+                await pubsub.subscribe(WEBHOOKS_CHANNEL)
+                # Loaded after subscribing, so no change between the two is missed
+                await asyncio.to_thread(self.reload)
+                while True:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=settings.WEBHOOK_REGISTRY_REFRESH_INTERVAL
+                    )
+                    if message is not None:
+                        # Changes made together arrive together; one reload covers them
+                        while await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.1):
+                            pass
+                    await asyncio.to_thread(self.reload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Webhook registry listener failed, resubscribing: {str(e)}")
+                await asyncio.sleep(1.0)
+            finally:
+                await pubsub.aclose()
+
+_registry: Optional[WebhookRegistry] = None
+
+def get_registry() -> WebhookRegistry:
+    """Process-wide registry; start its listen() task on the process's event loop"""
+    global _registry
+    if _registry is None:
+        _registry = WebhookRegistry()
+    return _registry
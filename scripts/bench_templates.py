@@ -0,0 +1,58 @@
+"""
+Measure template renders/sec for a campaign-sized audience.
+
+    python -m scripts.bench_templates --profiles 1000000
+
+Compares the compiled renderer with calling str.format on the raw template
+for every subscriber.
+"""
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+from core.templates import get_template_cache, render_many
+
+TEMPLATE = SimpleNamespace(
+    id=1,
+    version=1,
+    title_template="Merhaba {name}, sepetinizdeki ürün tükeniyor!",
+    body_template="{product} için son {time} saat kaldı. Hemen tamamla: {link}",
+)
+
+def make_profiles(count: int):
+    products = ["Kahve", "Çay", "Kupa", "Termos"]
+    for i in range(count):
+        yield {
+            "name": f"user{i}",
+            "product": random.choice(products),
+            "time": random.randint(1, 48),
+            "link": f"https://shop.example/cart/{i}",
+        }
+
+def bench(label: str, render, count: int):
+    profiles = list(make_profiles(count))
+    started = time.perf_counter()
+    rendered = sum(1 for _ in render(profiles))
+    elapsed = time.perf_counter() - started
+    print(f"{label:<12} {rendered} renders in {elapsed:.2f}s = {rendered / elapsed:,.0f} renders/sec")
+
+def format_each(profiles):
+    for profile in profiles:
+        yield (
+            TEMPLATE.title_template.format(**profile),
+            TEMPLATE.body_template.format(**profile),
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--profiles", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    bench("str.format", format_each, args.profiles)
+    bench("compiled", lambda profiles: render_many(TEMPLATE, profiles), args.profiles)
+    cache = get_template_cache()
+    print(f"template cache: {cache.hits} hits, {cache.misses} misses")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import threading
+
+import pytest
+from sqlalchemy import JSON, Integer, MetaData, create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+# Tables the send path, campaign runner and cleanup touch
+SEND_PATH_TABLES = (
+    "templates", "campaigns", "campaign_segments", "notifications", "notification_schedules",
+    "notification_tracking", "notification_actions", "notification_segments", "subscriptions",
+    "delivery_statuses", "notification_send_progress", "ab_tests", "outbox", "user_profiles",
+)
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Records every POST and answers it with the server's respond(path) -> (status, headers)"""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.requests.append(
+                SimpleNamespace(path=self.path, body=body, headers=self.headers, peer=self.client_address)
+            )
+        status, headers = self.server.respond(self.path)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def stand_in_server():
+    """Starts local stand-ins for remote HTTP services; call it with respond(path)"""
+    servers = []
+
+    def start(respond):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        server.respond, server.requests, server.lock = respond, [], threading.Lock()
+        server.url = f"http://127.0.0.1:{server.server_address[1]}"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def sqlite_engine(tmp_path):
+    """A file-backed SQLite copy of the send-path tables, so sessions and writers use their own connections"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'webpush.db'}")
+
+    @event.listens_for(engine, "connect")
+    def postgres_functions(connection, _):
+        # Every chunk gets its advisory lock
+        connection.create_function("pg_try_advisory_xact_lock", 2, lambda key, chunk: 1)
+
+    # Loading the models sets up core.database, which only these tests need
+    from core.database import Base
+    import core.models  # noqa: F401
+
+    metadata = MetaData()
+    for name in SEND_PATH_TABLES:
+        Base.metadata.tables[name].to_metadata(metadata)
+    # SQLite cannot autoincrement a composite primary key; tests set delivery status ids
+    metadata.tables["delivery_statuses"].c.id.autoincrement = False
+    # Nor a BIGINT one; outbox messages get SQLite's rowid
+    metadata.tables["outbox"].c.id.type = Integer()
+    # Profile attributes are JSONB with a Postgres cast as default
+    attributes = metadata.tables["user_profiles"].c.attributes
+    attributes.type, attributes.server_default = JSON(), None
+    metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def session_factory(sqlite_engine):
+    return sessionmaker(bind=sqlite_engine, autocommit=False, autoflush=False)
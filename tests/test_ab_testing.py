@@ -0,0 +1,21 @@
+import pytest
+
+from core.ab_testing import variant_slots, win_probabilities
+
+def test_variant_slots_split_the_sample_without_gaps():
+    assert variant_slots(20, 2) == [(0, 10), (10, 20)]
+    assert variant_slots(10, 3) == [(0, 3), (3, 6), (6, 10)]
+
+    with pytest.raises(ValueError):
+        variant_slots(2, 3)
+
+def test_clear_leader_gets_most_of_the_probability():
+    probabilities = win_probabilities({"A": (5000, 250), "B": (5000, 150)}, samples=5000)
+
+    assert probabilities["A"] > 0.99
+    assert probabilities["A"] + probabilities["B"] == pytest.approx(1.0)
+
+def test_identical_variants_split_the_probability():
+    probabilities = win_probabilities({"A": (1000, 50), "B": (1000, 50)}, samples=5000)
+
+    assert probabilities["A"] == pytest.approx(0.5, abs=0.05)
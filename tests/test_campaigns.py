@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from core.models import Campaign, CampaignStatus, Notification, NotificationSendProgress, OutboxMessage
+from workers import campaigns
+
+START = datetime(2026, 3, 1, 12)
+
+@pytest.fixture
+def db(session_factory):
+    db = session_factory()
+    yield db
+    db.close()
+
+def add_campaign(db, chunks=10, status=CampaignStatus.active, **values):
+    db.add(Campaign(id=1, name="spring", status=status.value, start_date=START, **values))
+    db.add(Notification(id=1, title="t", body="b", campaign_id=1))
+    db.flush()
+    db.add_all(
+        NotificationSendProgress(notification_id=1, start_after=i * 100, end_at=(i + 1) * 100,
+                                 last_subscription_id=i * 100)
+        for i in range(chunks)
+    )
+    db.commit()
+
+def released(db):
+    """start_after of the chunks published so far, in release order"""
+    db.expire_all()
+    return [message.args[1] for message in db.query(OutboxMessage).order_by(OutboxMessage.id)]
+
+def test_scheduled_campaign_releases_its_share_of_chunks_per_wave(db):
+    add_campaign(db, schedule_type=campaigns.SCHEDULED, end_date=START + timedelta(seconds=1000))
+
+    # The first wave covers the tick about to pass: 30s of a 1000s window
+    assert campaigns.run_campaigns(db, START)["released_chunks"] == 1
+    # Half the window in, half the audience is due
+    assert campaigns.run_campaigns(db, START + timedelta(seconds=470))["released_chunks"] == 4
+    # An overlapping wave releases nothing already released
+    assert campaigns.run_campaigns(db, START + timedelta(seconds=470))["released_chunks"] == 0
+
+    assert released(db) == [0, 100, 200, 300, 400]
+    message = db.query(OutboxMessage).first()
+    assert message.task == "tasks.send_notification_chunk" and message.args == [1, 0, 100]
+
+def test_waves_respect_the_per_campaign_and_in_flight_caps(db, monkeypatch):
+    monkeypatch.setattr(campaigns.settings, "CAMPAIGN_MAX_CHUNKS_PER_WAVE", 4)
+    monkeypatch.setattr(campaigns.settings, "CAMPAIGN_MAX_CHUNKS_IN_FLIGHT", 6)
+    add_campaign(db, schedule_type=campaigns.IMMEDIATE)
+
+    assert campaigns.run_campaigns(db, START)["released_chunks"] == 4
+    assert campaigns.run_campaigns(db, START)["released_chunks"] == 2
+    assert campaigns.chunks_in_flight(db) == 6
+
+def test_paused_campaign_releases_nothing_until_resumed(db):
+    add_campaign(db, status=CampaignStatus.paused, schedule_type=campaigns.IMMEDIATE)
+
+    assert campaigns.run_campaigns(db, START) == {"campaigns": 0, "released_chunks": 0, "completed_campaigns": 0}
+
+    db.query(Campaign).update({"status": CampaignStatus.active.value})
+    db.commit()
+    assert campaigns.run_campaigns(db, START)["released_chunks"] == 10
+
+def test_finished_campaign_is_completed(db, monkeypatch):
+    aggregated = []
+    monkeypatch.setattr(campaigns, "aggregate_notification_results",
+                        lambda results, notification_id: aggregated.append(notification_id))
+    add_campaign(db, chunks=2, schedule_type=campaigns.IMMEDIATE)
+    db.query(NotificationSendProgress).update({"completed_at": START})
+    db.commit()
+
+    assert campaigns.run_campaigns(db, START)["completed_campaigns"] == 1
+
+    assert db.get(Campaign, 1).status == CampaignStatus.completed.value
+    assert aggregated == [1]
+
+def test_stalled_chunks_are_released_again_then_failed(db):
+    add_campaign(db, chunks=3, schedule_type=campaigns.IMMEDIATE)
+    stalled_at = START - timedelta(seconds=campaigns.settings.CAMPAIGN_CHUNK_TIMEOUT + 1)
+    db.query(NotificationSendProgress).update({"dispatched_at": stalled_at, "attempts": 1})
+    db.query(NotificationSendProgress).filter(NotificationSendProgress.start_after == 200).update(
+        {"attempts": campaigns.settings.CAMPAIGN_CHUNK_MAX_ATTEMPTS}
+    )
+    db.query(NotificationSendProgress).filter(NotificationSendProgress.start_after == 100).update(
+        {"dispatched_at": START - timedelta(seconds=60)}
+    )
+    db.commit()
+
+    assert campaigns.expire_stalled_chunks(db, START) == {"released": 1, "failed": 1}
+    assert campaigns.run_campaigns(db, START)["released_chunks"] == 1
+
+    chunks = {chunk.start_after: chunk for chunk in db.query(NotificationSendProgress)}
+    # Re-released from its checkpoint, counting the attempt
+    assert (chunks[0].dispatched_at, chunks[0].attempts) == (START, 2)
+    # Still within its timeout
+    assert (chunks[100].dispatched_at, chunks[100].attempts) == (START - timedelta(seconds=60), 1)
+    # Out of attempts: failed and out of the in-flight count
+    assert chunks[200].failed_at == START and chunks[200].dispatched_at is None
+    assert released(db) == [0] and campaigns.chunks_in_flight(db) == 2
@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+
+from api.schemas import CDPProfileSync
+from api.services import cdp_service
+from api.services.cdp_service import ProfileCoalescer
+
+def test_failed_flush_keeps_accepted_updates_and_newer_values_win(monkeypatch):
+    coalescer = ProfileCoalescer()
+
+    def fail(pending):
+        raise RuntimeError("database down")
+
+    async def run():
+        await coalescer.add(CDPProfileSync(user_id="u1", profile={"country": "TR", "loyalty_tier": "gold"}))
+        monkeypatch.setattr(cdp_service.ProfileCoalescer, "_write", staticmethod(fail))
+        with pytest.raises(RuntimeError):
+            await coalescer.flush()
+        await coalescer.add(CDPProfileSync(user_id="u1", profile={"loyalty_tier": "silver"}))
+
+        written = []
+        monkeypatch.setattr(cdp_service.ProfileCoalescer, "_write", staticmethod(lambda pending: written.append(pending) or len(pending)))
+        await coalescer.flush()
+        return written
+
+    written = asyncio.run(run())
+
+    assert written == [{"u1": {"country": "TR", "loyalty_tier": "silver"}}]
@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import exc
+
+from core import db_pool
+from core.db_pool import PoolStats, TimedQueuePool
+
+@pytest.fixture
+def published(monkeypatch):
+    recorded = {}
+    monkeypatch.setattr(db_pool.metrics, "incr", lambda name, amount=1, **labels: recorded.__setitem__(name, amount))
+    monkeypatch.setattr(db_pool.metrics, "set_gauge", lambda name, value, **labels: recorded.__setitem__(name, value))
+    return recorded
+
+def timed_pool():
+    pool = TimedQueuePool(lambda: sqlite3.connect(":memory:"), pool_size=1, max_overflow=1, timeout=0.05)
+    pool.stats = PoolStats("sync", "test", capacity=2, interval=3600)
+    return pool
+
+def test_saturation_and_timeouts_are_reported(published):
+    pool = timed_pool()
+    held = [pool.connect(), pool.connect()]
+
+    with pytest.raises(exc.TimeoutError):
+        pool.connect()
+    pool.stats.publish()
+
+    assert published["db_pool_checkouts_total"] == 2
+    assert published["db_pool_timeouts_total"] == 1
+    assert published["db_pool_saturation"] == 1.0
+    assert published["db_pool_checkout_wait_seconds_max"] >= 0.05
+    for connection in held:
+        connection.close()
+
+def test_checkouts_only_count_in_memory(published):
+    pool = timed_pool()
+    for _ in range(3):
+        pool.connect().close()
+
+    # Publishing is left to the reporter thread
+    assert published == {}
+    assert pool.stats.checkouts == 3
+
+def test_recreated_pools_keep_reporting():
+    pool = timed_pool()
+    recreated = pool.recreate()
+
+    assert isinstance(recreated, TimedQueuePool)
+    assert pool.stats.closed and not recreated.stats.closed
+    assert (recreated.stats.role, recreated.stats.capacity) == ("test", 2)
@@ -0,0 +1,93 @@
+from collections import defaultdict
+from datetime import datetime
+
+import pytest
+
+from core.models import OutboxMessage
+from workers import outbox_relay
+
+class RecordingChannel:
+    """Stands in for ConfirmedChannel, recording what it publishes and when confirms were awaited"""
+
+    def __init__(self, confirmed=True):
+        self.confirmed = confirmed
+        self.calls = []
+
+    def publish(self, message):
+        self.calls.append(("publish", message.id))
+
+    def wait_for_confirms(self, timeout):
+        self.calls.append(("wait",))
+        if not self.confirmed:
+            raise RuntimeError("Broker rejected 1 tasks")
+
+def add_messages(db, count):
+    db.add_all(
+        OutboxMessage(id=i, task="workers.tasks.send_notification", args=[i], created_at=datetime(2026, 1, 1))
+        for i in range(1, count + 1)
+    )
+    db.commit()
+
+def pending(db):
+    db.expire_all()
+    return [message_id for (message_id,) in db.query(OutboxMessage.id).order_by(OutboxMessage.id)]
+
+def test_batch_is_published_then_confirmed_once_then_deleted(session_factory):
+    db = session_factory()
+    add_messages(db, 5)
+    channel = RecordingChannel()
+
+    assert outbox_relay.publish_batch(db, channel, 3) == 3
+
+    assert channel.calls == [("publish", 1), ("publish", 2), ("publish", 3), ("wait",)]
+    assert pending(db) == [4, 5]
+    db.close()
+
+def test_unconfirmed_batch_stays_in_the_outbox(session_factory):
+    db = session_factory()
+    add_messages(db, 2)
+
+    with pytest.raises(RuntimeError):
+        outbox_relay.publish_batch(db, RecordingChannel(confirmed=False), 10)
+    db.rollback()
+
+    assert pending(db) == [1, 2]
+    db.close()
+
+class AmqpChannel:
+    def __init__(self):
+        self.events = defaultdict(set)
+
+    def confirm_select(self):
+        pass
+
+class AmqpConnection:
+    """Delivers one queued confirm frame per drain"""
+
+    def __init__(self):
+        self.amqp_channel = AmqpChannel()
+        self.frames = []
+
+    def channel(self):
+        return self.amqp_channel
+
+    def drain_events(self, timeout=None):
+        event, delivery_tag, multiple = self.frames.pop(0)
+        for callback in self.amqp_channel.events[event]:
+            callback(delivery_tag, multiple)
+
+def test_confirmed_channel_waits_for_every_delivery_tag(monkeypatch):
+    monkeypatch.setattr(outbox_relay.celery_app, "send_task", lambda *args, **kwargs: None)
+    connection = AmqpConnection()
+    channel = outbox_relay.ConfirmedChannel(connection)
+    for i in range(1, 5):
+        channel.publish(OutboxMessage(id=i, task="t", args=[], kwargs={}))
+    connection.frames = [("basic_ack", 2, True), ("basic_ack", 4, False), ("basic_ack", 3, False)]
+
+    channel.wait_for_confirms(1.0)
+    assert connection.frames == []
+
+    channel.publish(OutboxMessage(id=5, task="t", args=[], kwargs={}))
+    connection.frames = [("basic_nack", 5, False)]
+    with pytest.raises(RuntimeError):
+        channel.wait_for_confirms(1.0)
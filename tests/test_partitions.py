@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+from core import partitions
+from core.models import Notification, NotificationSchedule, NotificationSendProgress, NotificationType
+from workers import tasks
+
+NOW = datetime(2026, 3, 1, 12)
+
+class RecordingConnection:
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement, *params):
+        self.statements.append(str(statement))
+
+def daily(table, first, days):
+    return {first + timedelta(days=i): partitions.partition_name(table, first + timedelta(days=i)) for i in range(days)}
+
+def add_notifications(db):
+    old = NOW - timedelta(days=40)
+    db.add_all([
+        Notification(id=1, title="sent", body="b", created_at=old),
+        Notification(id=2, title="scheduled", body="b", created_at=old + timedelta(days=2), schedule=NotificationSchedule(
+            type=NotificationType.time_based, send_at=NOW + timedelta(days=1)
+        )),
+        Notification(id=3, title="sending", body="b", created_at=old + timedelta(days=5)),
+        Notification(id=4, title="given up", body="b", created_at=old + timedelta(days=1)),
+        Notification(id=5, title="recent", body="b", created_at=NOW - timedelta(days=1)),
+    ])
+    db.add_all([
+        NotificationSendProgress(notification_id=1, start_after=0, last_subscription_id=0, completed_at=old),
+        NotificationSendProgress(notification_id=3, start_after=0, last_subscription_id=0),
+        NotificationSendProgress(notification_id=4, start_after=0, last_subscription_id=0, failed_at=old),
+    ])
+    db.commit()
+
+def test_retention_cutoff_falls_on_a_partition_boundary():
+    assert partitions.retention_cutoff(30, NOW) == datetime(2026, 1, 30)
+    assert partitions.partition_name("webhook_events", datetime(2026, 1, 30)) == "webhook_events_p20260130"
+
+def test_delivery_partitions_of_live_notifications_are_kept(monkeypatch):
+    first = datetime(2026, 1, 25)
+    monkeypatch.setattr(partitions, "list_partitions", lambda conn, table: daily(table, first, 10))
+    monkeypatch.setattr(partitions, "oldest_live_notification", lambda conn: datetime(2026, 1, 27, 18))
+    conn = RecordingConnection()
+
+    dropped = partitions.drop_partitions(conn, datetime(2026, 1, 30))
+
+    assert [name for name in dropped if name.startswith("webhook_events")] == [
+        "webhook_events_p20260125", "webhook_events_p20260126", "webhook_events_p20260127",
+        "webhook_events_p20260128", "webhook_events_p20260129",
+    ]
+    # Kept from the day the oldest live notification writes its statuses to
+    assert [name for name in dropped if name.startswith("delivery_statuses")] == [
+        "delivery_statuses_p20260125", "delivery_statuses_p20260126",
+    ]
+    assert "DROP TABLE delivery_statuses_p20260127" not in conn.statements
+
+def test_oldest_live_notification_is_scheduled_or_still_sending(sqlite_engine, session_factory):
+    db = session_factory()
+    add_notifications(db)
+    db.close()
+
+    with sqlite_engine.connect() as conn:
+        assert partitions.oldest_live_notification(conn) == NOW - timedelta(days=38)
+
+def test_cleanup_keeps_scheduled_and_sending_notifications(monkeypatch, sqlite_engine, session_factory):
+    db = session_factory()
+    add_notifications(db)
+    monkeypatch.setattr(tasks, "SessionLocal", session_factory)
+    monkeypatch.setattr(tasks, "engine", sqlite_engine)
+    # Partition DDL is Postgres-only; what it drops is covered above
+    monkeypatch.setattr(partitions, "drop_partitions", lambda conn, before: [])
+    monkeypatch.setattr(partitions, "retention_cutoff", lambda days: NOW - timedelta(days=days))
+
+    tasks.cleanup_old_notifications(30)
+
+    db.expire_all()
+    assert sorted(notification_id for (notification_id,) in db.query(Notification.id)) == [2, 3, 5]
+    db.close()
@@ -0,0 +1,76 @@
+from datetime import datetime
+
+import pytest
+
+from core.models import Notification, NotificationSendProgress, Subscription
+from workers import tasks
+
+@pytest.fixture
+def db(session_factory):
+    db = session_factory()
+    yield db
+    db.close()
+
+def add_subscriptions(db, ids, **values):
+    db.add_all(
+        Subscription(id=i, endpoint=f"https://push.example/{i}", p256dh="key", auth="auth", **values) for i in ids
+    )
+    db.commit()
+
+def test_empty_audience_has_no_chunks(db):
+    add_subscriptions(db, range(1, 4), active=False)
+
+    assert tasks.plan_subscription_chunks(db, 5) == []
+
+def test_audience_of_an_exact_multiple_leaves_the_last_chunk_open(db):
+    add_subscriptions(db, range(1, 11))
+
+    # Subscriptions created after planning fall into the last chunk
+    assert tasks.plan_subscription_chunks(db, 5) == [(0, 5), (5, None)]
+
+def test_remainder_gets_its_own_open_chunk(db):
+    add_subscriptions(db, range(1, 13))
+    add_subscriptions(db, range(13, 20), active=False)
+
+    assert tasks.plan_subscription_chunks(db, 5) == [(0, 5), (5, 10), (10, None)]
+    assert tasks.plan_subscription_chunks(db, 5, where=(Subscription.id % 2 == 0,)) == [(0, 10), (10, None)]
+
+@pytest.fixture
+def chords(monkeypatch, session_factory):
+    dispatched = []
+    monkeypatch.setattr(tasks, "SessionLocal", session_factory)
+    monkeypatch.setattr(tasks, "chord", lambda header: lambda callback: dispatched.append((header.tasks, callback)))
+    return dispatched
+
+def test_new_notification_is_planned_and_fanned_out(db, chords, monkeypatch):
+    monkeypatch.setattr(tasks.settings, "SEND_CHUNK_SIZE", 5)
+    add_subscriptions(db, range(1, 8))
+    db.add(Notification(id=1, title="t", body="b"))
+    db.commit()
+
+    assert tasks.process_notification(1)["chunks"] == 2
+
+    (header, callback), = chords
+    assert [signature.args for signature in header] == [(1, 0, 5), (1, 5, None)]
+    assert callback.task == "tasks.aggregate_notification_results" and callback.args == (1,)
+    assert db.query(NotificationSendProgress).count() == 2
+
+def test_redelivered_notification_resumes_its_unfinished_chunks(db, chords):
+    add_subscriptions(db, range(1, 16))
+    db.add(Notification(id=1, title="t", body="b"))
+    db.flush()
+    db.add_all([
+        NotificationSendProgress(notification_id=1, start_after=0, end_at=5, last_subscription_id=5,
+                                 completed_at=datetime(2026, 1, 1)),
+        NotificationSendProgress(notification_id=1, start_after=5, end_at=10, last_subscription_id=7),
+        NotificationSendProgress(notification_id=1, start_after=10, end_at=None, last_subscription_id=10),
+    ])
+    db.commit()
+
+    result = tasks.process_notification(1)
+
+    assert result["chunks"] == 2
+    (header, _), = chords
+    # Planned chunks are reused, not planned again; each resumes from its checkpoint when sent
+    assert [signature.args for signature in header] == [(1, 5, 10), (1, 10, None)]
+    assert db.query(NotificationSendProgress).count() == 3
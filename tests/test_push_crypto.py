@@ -0,0 +1,89 @@
+import hashlib
+import hmac
+import json
+import logging
+from types import SimpleNamespace
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from core import push_crypto
+from core.push_crypto import ENCRYPTION_BATCH_SIZE, PushEncryptor, VapidSigner, b64url_decode, b64url_encode, encrypt_payload
+
+def make_subscriber():
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    public_key = private_key.public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+    return private_key, b64url_encode(public_key), b64url_encode(b"0123456789abcdef")
+
+def decrypt(body, ua_private, p256dh, auth):
+    """User agent side of RFC 8291"""
+    salt, as_public, ciphertext = body[:16], body[21:86], body[86:]
+    ecdh_secret = ua_private.exchange(
+        ec.ECDH(), ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), as_public)
+    )
+    mac = lambda key, data: hmac.new(key, data, hashlib.sha256).digest()
+    ikm = mac(mac(b64url_decode(auth), ecdh_secret),
+              b"WebPush: info\x00" + b64url_decode(p256dh) + as_public + b"\x01")
+    prk = mac(salt, ikm)
+    cek = mac(prk, b"Content-Encoding: aes128gcm\x00\x01")[:16]
+    nonce = mac(prk, b"Content-Encoding: nonce\x00\x01")[:12]
+    return AESGCM(cek).decrypt(nonce, ciphertext, None)
+
+def test_encrypted_payload_decrypts_on_the_user_agent():
+    ua_private, p256dh, auth = make_subscriber()
+
+    body = encrypt_payload(b'{"title":"Hi"}', p256dh, auth)
+
+    assert body[16:21] == b"\x00\x00\x10\x00\x41"
+    assert decrypt(body, ua_private, p256dh, auth) == b'{"title":"Hi"}\x02'
+
+def test_encrypt_many_reports_invalid_keys_and_throughput():
+    subscribers = [make_subscriber() for _ in range(3)]
+    items = [(i, p256dh, auth) for i, (_, p256dh, auth) in enumerate(subscribers)]
+    items.append((99, "not-a-key", "bad"))
+
+    results, stats = PushEncryptor(processes=1).encrypt_many(b"payload", items)
+
+    assert [r[0] for r in results] == [0, 1, 2, 99]
+    assert all(body for _, body, _ in results[:3])
+    assert results[3][1] is None and results[3][2]
+    assert stats.pushes == 4 and stats.pushes_per_second_per_core > 0
+
+def test_daemonic_processes_encrypt_in_process_and_warn_once(monkeypatch, caplog):
+    monkeypatch.setattr(push_crypto.multiprocessing, "current_process", lambda: SimpleNamespace(daemon=True))
+    _, p256dh, auth = make_subscriber()
+    items = [(i, p256dh, auth) for i in range(ENCRYPTION_BATCH_SIZE + 1)]
+    encryptor = PushEncryptor(processes=4)
+
+    with caplog.at_level(logging.WARNING, logger="core.push_crypto"):
+        for _ in range(2):
+            results, _ = encryptor.encrypt_many(b"payload", items)
+            assert len(results) == len(items) and all(body for _, body, _ in results)
+
+    assert encryptor._pool is None
+    assert len(caplog.records) == 1
+
+def test_vapid_token_is_cached_per_audience_and_verifies():
+    key = ec.generate_private_key(ec.SECP256R1())
+    signer = VapidSigner(
+        private_key=b64url_encode(key.private_numbers().private_value.to_bytes(32, "big")),
+        subject="mailto:ops@example.com",
+    )
+
+    first = signer.authorization("https://fcm.googleapis.com/fcm/send/a")
+    assert signer.authorization("https://fcm.googleapis.com/fcm/send/b") == first
+    assert signer.authorization("https://updates.push.services.mozilla.com/wpush/v2/c") != first
+
+    token = first.split("t=")[1].split(",")[0]
+    header, claims, signature = token.split(".")
+    raw = b64url_decode(signature)
+    key.public_key().verify(
+        encode_dss_signature(int.from_bytes(raw[:32], "big"), int.from_bytes(raw[32:], "big")),
+        f"{header}.{claims}".encode(),
+        ec.ECDSA(hashes.SHA256()),
+    )
+    assert json.loads(b64url_decode(claims))["aud"] == "https://fcm.googleapis.com"
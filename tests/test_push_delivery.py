@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from core.push_delivery import PushDeliveryEngine, PushMessage, parse_retry_after, push_service_origin
+
+def push_service(path):
+    """/ok accepts, /gone expired, /busy throttled"""
+    if path.startswith("/ok"):
+        return 201, {}
+    if path.startswith("/gone"):
+        return 410, {}
+    return 429, {"Retry-After": "30"}
+
+@pytest.fixture
+def push_server(stand_in_server):
+    return stand_in_server(push_service)
+
+def send(messages, **engine_options):
+    async def run():
+        async with PushDeliveryEngine(**engine_options) as engine:
+            return await engine.send_many(messages)
+    return asyncio.run(run())
+
+def test_results_follow_push_service_status(push_server):
+    messages = [
+        PushMessage(subscription_id=1, endpoint=f"{push_server.url}/ok/1"),
+        PushMessage(subscription_id=2, endpoint=f"{push_server.url}/gone/2"),
+        PushMessage(subscription_id=3, endpoint=f"{push_server.url}/busy/3"),
+    ]
+
+    results = send(messages)
+
+    assert [r.subscription_id for r in results] == [1, 2, 3]
+    assert [r.status_code for r in results] == [201, 410, 429]
+    assert results[0].success and not results[1].success
+    assert results[2].retry_after == 30.0
+
+def test_pushes_share_pooled_keepalive_connections(push_server):
+    messages = [
+        PushMessage(subscription_id=i, endpoint=f"{push_server.url}/ok/{i}", body=b"x")
+        for i in range(500)
+    ]
+
+    results = send(messages, max_concurrency=50, connections_per_origin=4)
+
+    assert all(r.success for r in results)
+    assert len({request.peer for request in push_server.requests}) <= 4
+
+def test_unreachable_push_service_is_reported_not_raised():
+    results = send([PushMessage(subscription_id=1, endpoint="http://127.0.0.1:9/push")])
+
+    assert results[0].status_code is None
+    assert results[0].error
+
+def test_helpers():
+    assert push_service_origin("https://fcm.googleapis.com/fcm/send/abc") == "https://fcm.googleapis.com"
+    assert parse_retry_after("120") == 120.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after(None) is None
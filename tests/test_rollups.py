@@ -0,0 +1,32 @@
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy.dialects import postgresql
+
+from core import rollups
+
+def slots(statements):
+    return {value for statement in statements
+            for name, value in statement.compile(dialect=postgresql.dialect()).params.items()
+            if name.startswith("slot")}
+
+def test_increments_go_to_the_writers_slot():
+    bucket = datetime(2026, 1, 1, 12)
+    increments = {(7, bucket): Counter(sent=3, failed=1)}
+    dimensions = {7: (None, ["vip"])}
+
+    statements = rollups.increment_statements(increments, dimensions, slot=5)
+
+    assert len(statements) == 3
+    assert slots(statements) == {5}
+
+def test_writers_spread_over_slots(monkeypatch):
+    monkeypatch.setattr(rollups.settings, "ROLLUP_SLOTS", 4)
+    executed = []
+    conn = type("Conn", (), {"execute": lambda self, statement: executed.append(statement)})()
+    increments = {(7, datetime(2026, 1, 1, 12)): Counter(sent=1)}
+
+    for _ in range(50):
+        rollups.record(conn, increments, {7: (None, [])})
+
+    assert slots(executed) == {0, 1, 2, 3}
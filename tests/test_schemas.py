@@ -0,0 +1,49 @@
+from datetime import datetime
+
+from api.schemas import NotificationCreate, NotificationResponse
+from core.models import (
+    Notification, NotificationAction, NotificationPriority, NotificationSchedule, NotificationSegment,
+    NotificationTracking, NotificationType
+)
+
+def test_notification_with_segments_round_trips_through_the_response_model():
+    request = NotificationCreate.model_validate({
+        "title": "Sale",
+        "body": "20% off",
+        "icon": None,
+        "image": None,
+        "badge": None,
+        "data": None,
+        "priority": "high",
+        "ttl": None,
+        "variant_id": None,
+        "ab_test_group": None,
+        "schedule": {"type": "time_based", "trigger_type": None, "trigger_conditions": None,
+                     "send_at": "2026-01-01T09:00:00"},
+        "tracking": {"utm_params": {"utm_source": "push"}},
+        "actions": [{"type": "button", "title": "Shop", "action": "open"}],
+        "segments": [{"name": "gold", "conditions": {"loyalty_tier": "gold", "last_purchase": None,
+                                                     "country": None, "custom_rules": None}}]
+    })
+    # As loaded back from the database
+    notification = Notification(
+        id=1,
+        title=request.title,
+        body=request.body,
+        priority=NotificationPriority.high,
+        require_interaction=False,
+        created_at=datetime(2026, 1, 1),
+        schedule=NotificationSchedule(type=NotificationType.time_based, send_at=datetime(2026, 1, 1, 9)),
+        tracking=NotificationTracking(**request.tracking.dict()),
+        actions=[NotificationAction(**action.dict()) for action in request.actions],
+        segments=[
+            NotificationSegment(segment_name=segment.name, targeting_rules=segment.conditions.dict())
+            for segment in request.segments
+        ]
+    )
+
+    response = NotificationResponse.model_validate(notification, from_attributes=True)
+
+    assert response.segments[0].segment_name == "gold"
+    assert response.segments[0].targeting_rules["loyalty_tier"] == "gold"
+    assert response.priority == "high" and response.schedule.type == "time_based"
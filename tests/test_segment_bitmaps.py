@@ -0,0 +1,186 @@
+from collections import defaultdict
+
+import pytest
+from pyroaring import BitMap
+from redis.exceptions import WatchError
+
+from core import segment_bitmaps
+from core.models import NotificationSegment, Subscription, UserProfile
+
+GOLD = {"loyalty_tier": "gold"}
+
+class FakeRedis:
+    """The strings, sets and optimistic transactions the bitmaps use"""
+
+    def __init__(self):
+        self.data = {}
+        self.versions = defaultdict(int)
+        # Writes by other workers, run just before this worker's next transaction commits
+        self.interleaved = []
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+        self.versions[key] += 1
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+            self.versions[key] += 1
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(members)
+        self.versions[key] += 1
+
+    def spop(self, key, count):
+        members = self.data.get(key) or set()
+        popped = [members.pop() for _ in range(min(count, len(members)))]
+        if popped:
+            self.versions[key] += 1
+        return popped
+
+    def scard(self, key):
+        return len(self.data.get(key) or ())
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.watched = {}
+        self.queued = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def watch(self, *keys):
+        self.watched = {key: self.redis.versions[key] for key in keys}
+
+    def unwatch(self):
+        self.watched, self.queued = {}, None
+
+    def multi(self):
+        self.queued = []
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+        if self.queued is None:
+            return command
+        return lambda *args, **kwargs: self.queued.append((command, args, kwargs))
+
+    def execute(self):
+        while self.redis.interleaved:
+            self.redis.interleaved.pop(0)()
+        queued, watched = self.queued, self.watched
+        self.unwatch()
+        if any(self.redis.versions[key] != version for key, version in watched.items()):
+            raise WatchError()
+        for command, args, kwargs in queued:
+            command(*args, **kwargs)
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(segment_bitmaps, "get_redis", lambda binary=False: redis)
+    return redis
+
+@pytest.fixture
+def db(session_factory):
+    db = session_factory()
+    db.add_all([
+        UserProfile(id=1, user_id="u1", loyalty_tier="gold", attributes={}),
+        UserProfile(id=2, user_id="u2", loyalty_tier="silver", attributes={}),
+        UserProfile(id=3, user_id="u3", loyalty_tier="gold", attributes={}),
+        NotificationSegment(segment_name="gold", targeting_rules=GOLD),
+    ])
+    db.add_all([
+        Subscription(id=1, endpoint="https://push.example/1", p256dh="k", auth="a", user_id="u1"),
+        Subscription(id=2, endpoint="https://push.example/2", p256dh="k", auth="a", user_id="u2"),
+        Subscription(id=3, endpoint="https://push.example/3", p256dh="k", auth="a", user_id="u3", active=False),
+        Subscription(id=4, endpoint="https://push.example/4", p256dh="k", auth="a", user_id="u1"),
+        Subscription(id=5, endpoint="https://push.example/5", p256dh="k", auth="a"),
+    ])
+    db.commit()
+    yield db
+    db.close()
+
+def members(segment_name="gold"):
+    return list(segment_bitmaps.audience([segment_name]))
+
+def set_tier(db, user_id, tier):
+    db.query(UserProfile).filter(UserProfile.user_id == user_id).update({"loyalty_tier": tier})
+    db.commit()
+
+def test_build_stores_active_matching_subscriptions(db, redis):
+    assert segment_bitmaps.build_segment_bitmap(db, "gold", GOLD) == 2
+
+    assert members() == [1, 4]
+    assert not redis.exists(segment_bitmaps.BUILDING_KEY.format("gold"))
+
+def test_time_relative_segment_is_not_materialized(db, redis):
+    assert segment_bitmaps.build_segment_bitmap(db, "lapsed", {"last_purchase": ">30d"}) == 0
+    assert segment_bitmaps.load_bitmaps(["lapsed"]) == {"lapsed": None}
+
+def test_profile_changes_patch_the_bitmap(db, redis):
+    segment_bitmaps.build_segment_bitmap(db, "gold", GOLD)
+
+    set_tier(db, "u2", "gold")
+    assert segment_bitmaps.update_memberships(db, ["u2"]) == {"gold": 1}
+    assert members() == [1, 2, 4]
+
+    set_tier(db, "u1", "silver")
+    segment_bitmaps.update_memberships(db, ["u1"])
+    assert members() == [2]
+
+def test_changes_during_a_build_are_queued_for_it(db, redis):
+    segment_bitmaps.build_segment_bitmap(db, "gold", GOLD)
+    redis.set(segment_bitmaps.BUILDING_KEY.format("gold"), 1)
+
+    set_tier(db, "u2", "gold")
+    segment_bitmaps.update_memberships(db, ["u2"])
+
+    assert members() == [1, 4]
+    assert redis.data[segment_bitmaps.PENDING_KEY.format("gold")] == {2}
+
+def test_patch_retries_when_another_worker_wrote_the_bitmap(db, redis):
+    segment_bitmaps.build_segment_bitmap(db, "gold", GOLD)
+    key = segment_bitmaps.BITMAP_KEY.format("gold")
+
+    def concurrent_patch():
+        bitmap = BitMap.deserialize(redis.get(key))
+        bitmap.add(9)
+        redis.set(key, bitmap.serialize())
+
+    redis.interleaved.append(concurrent_patch)
+    set_tier(db, "u2", "gold")
+    segment_bitmaps.update_memberships(db, ["u2"])
+
+    # The first write lost the race; the retry applies on top of the other worker's
+    assert members() == [1, 2, 4, 9]
+
+def test_reconcile_adds_new_and_relinked_subscriptions(db, redis):
+    segment_bitmaps.build_segment_bitmap(db, "gold", GOLD)
+    redis.set(segment_bitmaps.RECONCILED_KEY, 5)
+    db.add(Subscription(id=6, endpoint="https://push.example/6", p256dh="k", auth="a", user_id="u1"))
+    db.query(Subscription).filter(Subscription.id == 2).update({"user_id": "u3"})
+    db.commit()
+
+    # Before a send only the subscriptions created since the last pass are evaluated
+    assert segment_bitmaps.reconcile_memberships(db, new_only=True) == 1
+    assert members() == [1, 4, 6]
+
+    assert segment_bitmaps.reconcile_memberships(db) == 6
+    assert members() == [1, 2, 4, 6]
+    assert redis.get(segment_bitmaps.RECONCILED_KEY) == 6
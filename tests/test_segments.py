@@ -0,0 +1,57 @@
+from datetime import timedelta
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from core.segments import SegmentRuleError, compile_condition, compile_rules, is_time_relative
+
+def compiled(rule):
+    statement = compile_condition(rule).compile(dialect=postgresql.dialect())
+    return str(statement), statement.params
+
+def test_operators_compile_to_columns_and_attributes():
+    assert compiled({"country": "TR", "purchase_history": ">=2"}) == (
+        "user_profiles.country = %(country_1)s::VARCHAR AND "
+        "CAST((user_profiles.attributes ->> %(attributes_1)s::TEXT) AS FLOAT) >= %(param_1)s::INTEGER",
+        {"country_1": "TR", "attributes_1": "purchase_history", "param_1": 2}
+    )
+    # Attribute equality is answered by JSONB containment
+    assert compiled({"field": "plan", "value": "pro"}) == (
+        "user_profiles.attributes @> %(attributes_1)s::JSONB", {"attributes_1": {"plan": "pro"}}
+    )
+    sql, params = compiled({"field": "last_seen", "op": ">", "value": "7d"})
+    # More than 7 days ago is an earlier timestamp
+    assert sql.endswith("< timezone(%(timezone_1)s::VARCHAR, now()) - %(timezone_2)s")
+    assert params["timezone_2"] == timedelta(days=7)
+    assert is_time_relative({"custom_rules": {"and": [{"field": "last_seen", "value": ">7d"}]}})
+    assert not is_time_relative({"loyalty_tier": "gold", "custom_rules": {"purchase_history": ">=2"}})
+
+def test_nested_rules_keep_their_grouping():
+    sql, params = compiled({"and": [
+        {"country": "TR"},
+        {"or": [
+            {"field": "loyalty_tier", "op": "in", "value": ["gold", "silver"]},
+            {"not": {"field": "vip", "op": "exists"}},
+        ]},
+    ]})
+
+    assert sql == (
+        "user_profiles.country = %(country_1)s::VARCHAR AND "
+        "(user_profiles.loyalty_tier IN (__[POSTCOMPILE_loyalty_tier_1]) "
+        "OR NOT ((user_profiles.attributes ? %(attributes_1)s::VARCHAR)))"
+    )
+    assert params == {"country_1": "TR", "loyalty_tier_1": ["gold", "silver"], "attributes_1": "vip"}
+    # Segment conditions left empty add nothing
+    assert str(compile_rules({"loyalty_tier": "gold", "country": None, "custom_rules": {"and": []}})) == (
+        "user_profiles.loyalty_tier = :loyalty_tier_1"
+    )
+
+@pytest.mark.parametrize("rule", [
+    {"field": "country", "op": "like", "value": "T%"},
+    {"or": {"country": "TR"}},
+    {"not": ["country", "TR"]},
+    "country = TR",
+])
+def test_invalid_rules_are_rejected(rule):
+    with pytest.raises(SegmentRuleError):
+        compile_condition(rule)
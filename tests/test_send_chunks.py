@@ -0,0 +1,202 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import func, insert, select
+
+from core.models import (
+    ABTest, Campaign, CampaignStatus, DeliveryStatus, Notification, NotificationSendProgress, Subscription
+)
+from workers import tasks
+from workers.delivery import DeliveryOutcome
+
+class RecordingWriter:
+    """Stands in for DeliveryResultWriter with the plain inserts SQLite understands"""
+
+    def __init__(self, engine, notification_id):
+        self.engine = engine
+        self.notification_id = notification_id
+        self._statuses = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, result, pushed_at=None):
+        self._statuses.append((result.subscription_id, "sent" if result.success else "failed"))
+
+    def add_failure(self, subscription_id, error):
+        self._statuses.append((subscription_id, "failed"))
+
+    def flush(self, *statements):
+        statuses, self._statuses = self._statuses, []
+        with self.engine.begin() as conn:
+            created_at = conn.execute(
+                select(Notification.created_at).where(Notification.id == self.notification_id)
+            ).scalar()
+            for subscription_id, status in statuses:
+                conn.execute(insert(DeliveryStatus).values(
+                    id=conn.execute(select(func.coalesce(func.max(DeliveryStatus.id), 0))).scalar() + 1,
+                    notification_created_at=created_at,
+                    notification_id=self.notification_id,
+                    subscription_id=subscription_id,
+                    status=status
+                ))
+            for statement in statements:
+                conn.execute(statement)
+
+class Pushes:
+    """Records the subscriptions pushed to and defers those in rate_limited"""
+
+    def __init__(self):
+        self.sent = []
+        self.rate_limited = set()
+
+    def __call__(self, notification, batch, writer):
+        outcome = DeliveryOutcome()
+        for subscription_id in batch:
+            if subscription_id in self.rate_limited:
+                outcome.deferred_ids.append(subscription_id)
+                outcome.retry_delay = 1.0
+            else:
+                self.sent.append(subscription_id)
+                writer.add(SimpleNamespace(subscription_id=subscription_id, success=True))
+                outcome.successful_pushes += 1
+        return outcome
+
+@pytest.fixture
+def send_path(monkeypatch, sqlite_engine, session_factory):
+    sent = SimpleNamespace(pushes=Pushes(), scheduled=[], aggregated=[], db=session_factory())
+    monkeypatch.setattr(tasks, "SessionLocal", session_factory)
+    monkeypatch.setattr(tasks, "DeliveryResultWriter",
+                        lambda notification_id: RecordingWriter(sqlite_engine, notification_id))
+    monkeypatch.setattr(tasks, "deliver_notification", sent.pushes)
+    monkeypatch.setattr(tasks.send_notification_chunk, "apply_async",
+                        lambda args, kwargs=None, **options: sent.scheduled.append((args, kwargs, options)))
+    monkeypatch.setattr(tasks.aggregate_notification_results, "delay",
+                        lambda *args: sent.aggregated.append(args))
+    yield sent
+    sent.db.close()
+
+def add_subscriptions(db, ids):
+    db.add_all(Subscription(id=i, endpoint=f"https://push.example/{i}", p256dh="key", auth="auth") for i in ids)
+
+def progress(db, notification_id, start_after=0):
+    db.expire_all()
+    return db.query(NotificationSendProgress).filter(
+        NotificationSendProgress.notification_id == notification_id,
+        NotificationSendProgress.start_after == start_after
+    ).one()
+
+def test_ab_variant_chunks_are_held_while_paused_and_finish_after_resume(send_path):
+    db = send_path.db
+    add_subscriptions(db, range(1, 11))
+    campaign = Campaign(id=1, name="spring", status=CampaignStatus.paused.value,
+                       start_date=datetime(2026, 1, 1), schedule_type="immediate")
+    test = ABTest(id=1, campaign_id=1, sample_percent=100, variants=[], ends_at=datetime(2026, 2, 1))
+    variant = Notification(id=1, title="A", body="b", campaign_id=1, ab_test_group="1", variant_id="A")
+    db.add_all([campaign, test, variant])
+    db.flush()
+    test.variants = [{"variant_id": "A", "notification_id": 1, "slots": [0, 100]}]
+    db.add(NotificationSendProgress(notification_id=1, start_after=0, end_at=None, last_subscription_id=0))
+    db.commit()
+
+    held = tasks.send_notification_chunk(1, 0, None)
+
+    # Not handed to the campaign runner, which never releases A/B chunks, but retried after a tick
+    assert held["paused"] and send_path.pushes.sent == []
+    (args, kwargs, options), = send_path.scheduled
+    assert args == (1, 0, None) and kwargs == {"subscription_ids": None, "deferrals": 0}
+    assert options["countdown"] == tasks.settings.CAMPAIGN_TICK_INTERVAL
+
+    campaign.status = CampaignStatus.active.value
+    db.commit()
+    resumed = tasks.send_notification_chunk(*args, **kwargs)
+
+    assert resumed["successful_pushes"] == 10 and sorted(send_path.pushes.sent) == list(range(1, 11))
+    assert progress(db, 1).completed_at is not None
+    # Outside the chord, the held chunk finishing is what completes the variant
+    assert send_path.aggregated == [([], 1)]
+
+def statuses(db, notification_id):
+    return dict(db.query(DeliveryStatus.subscription_id, DeliveryStatus.status).filter(
+        DeliveryStatus.notification_id == notification_id
+    ))
+
+def add_notification(db, subscription_ids, **progress_values):
+    add_subscriptions(db, subscription_ids)
+    db.add(Notification(id=1, title="t", body="b", created_at=datetime(2026, 1, 1)))
+    db.flush()
+    db.add(NotificationSendProgress(
+        notification_id=1, start_after=0, end_at=None, **{"last_subscription_id": 0, **progress_values}
+    ))
+    db.commit()
+
+def test_throttled_pushes_are_rescheduled_with_their_deferral_count(send_path):
+    add_notification(send_path.db, range(1, 6), deferred_pushes=2)
+    send_path.pushes.rate_limited = {4}
+
+    result = tasks.send_notification_chunk(1, 0, None, subscription_ids=[4, 5], deferrals=1)
+
+    assert result["deferred_pushes"] == 1
+    (args, kwargs, _), = send_path.scheduled
+    assert kwargs == {"subscription_ids": [4], "deferrals": 2}
+    assert progress(send_path.db, 1).deferred_pushes == 1
+
+def test_pushes_throttled_past_the_cap_are_recorded_as_failed(send_path):
+    add_notification(send_path.db, range(1, 6), deferred_pushes=2)
+    send_path.pushes.rate_limited = {4, 5}
+
+    result = tasks.send_notification_chunk(
+        1, 0, None, subscription_ids=[4, 5], deferrals=tasks.settings.PUSH_MAX_DEFERRALS
+    )
+
+    assert result["failed_pushes"] == 2 and result["deferred_pushes"] == 0
+    assert send_path.scheduled == []
+    assert statuses(send_path.db, 1) == {4: "failed", 5: "failed"}
+    chunk = progress(send_path.db, 1)
+    assert (chunk.failed_pushes, chunk.deferred_pushes) == (2, 0) and chunk.completed_at is not None
+
+def test_chunk_resumes_after_its_checkpoint(send_path, monkeypatch):
+    monkeypatch.setattr(tasks.settings, "SEND_CHECKPOINT_SIZE", 3)
+    add_notification(send_path.db, range(1, 11), last_subscription_id=4, successful_pushes=4)
+
+    tasks.send_notification_chunk(1, 0, None)
+
+    assert send_path.pushes.sent == [5, 6, 7, 8, 9, 10]
+    chunk = progress(send_path.db, 1)
+    assert (chunk.last_subscription_id, chunk.successful_pushes) == (10, 10)
+    assert chunk.completed_at is not None
+
+def test_subscriptions_with_a_status_are_not_pushed_again(send_path):
+    add_notification(send_path.db, range(1, 6))
+    with RecordingWriter(send_path.db.get_bind(), 1) as writer:
+        for subscription_id in (2, 3):
+            writer.add(SimpleNamespace(subscription_id=subscription_id, success=True))
+
+    tasks.send_notification_chunk(1, 0, None)
+
+    assert send_path.pushes.sent == [1, 4, 5]
+
+def test_chunk_stays_open_until_its_deferred_pushes_are_re_sent(send_path, monkeypatch):
+    monkeypatch.setattr(tasks.settings, "SEND_CHECKPOINT_SIZE", 3)
+    add_notification(send_path.db, range(1, 11))
+    send_path.pushes.rate_limited = {3, 7}
+
+    swept = tasks.send_notification_chunk(1, 0, None)
+
+    assert swept["deferred_pushes"] == 2
+    chunk = progress(send_path.db, 1)
+    assert (chunk.last_subscription_id, chunk.deferred_pushes) == (10, 2) and chunk.completed_at is None
+    assert send_path.aggregated == []
+
+    send_path.pushes.rate_limited = set()
+    (args, kwargs, _), = send_path.scheduled
+    tasks.send_notification_chunk(*args, **kwargs)
+
+    chunk = progress(send_path.db, 1)
+    assert (chunk.successful_pushes, chunk.deferred_pushes) == (10, 0) and chunk.completed_at is not None
+    assert send_path.aggregated == [([], 1)]
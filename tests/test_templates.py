@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+import pytest
+
+from core.templates import TemplateCache, TemplateError, compile_template, render_many
+
+def make_template(id=1, version=1, title="Merhaba {name}", body="{product} için son {time} saat kaldı"):
+    return SimpleNamespace(id=id, version=version, title_template=title, body_template=body)
+
+def test_render_fills_placeholders_and_blanks_missing_values():
+    compiled = compile_template("Merhaba {name}", "%{discount} off {product}", ["name", "discount", "product"])
+
+    assert compiled.render({"name": "Ayşe", "discount": 20, "product": "Kahve"}) == ("Merhaba Ayşe", "%20 off Kahve")
+    assert compiled.render({"name": None}) == ("Merhaba ", "% off ")
+
+@pytest.mark.parametrize("title, variables", [
+    ("Hi {name}", ["product"]),
+    ("Hi {}", []),
+    ("Hi {user.__class__}", ["user"]),
+    ("Hi {name!r}", ["name"]),
+    ("Hi {name", ["name"]),
+    ("Hi {name}", ["name", "not valid"]),
+])
+def test_invalid_templates_are_rejected(title, variables):
+    with pytest.raises(TemplateError):
+        compile_template(title, "", variables)
+
+def test_cache_compiles_once_per_version_and_evicts_least_recent():
+    cache = TemplateCache(maxsize=2)
+
+    cache.get(make_template(id=1))
+    cache.get(make_template(id=1))
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    edited = cache.get(make_template(id=1, version=2, title="Selam {name}"))
+    assert edited.render({"name": "Ali"})[0] == "Selam Ali"
+
+    cache.get(make_template(id=2))
+    cache.get(make_template(id=1, version=1))
+    assert cache.misses == 4
+
+def test_render_many_uses_defaults_for_unset_variables():
+    rendered = list(render_many(
+        make_template(id=99),
+        [{"name": "Ali"}, {"name": "Ayşe", "product": "Çay"}],
+        defaults={"product": "Kahve", "time": 3}
+    ))
+
+    assert rendered == [
+        ("Merhaba Ali", "Kahve için son 3 saat kaldı"),
+        ("Merhaba Ayşe", "Çay için son 3 saat kaldı"),
+    ]
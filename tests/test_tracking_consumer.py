@@ -0,0 +1,111 @@
+import pytest
+
+from core.tracking import TRACKING_DEAD_LETTER_STREAM
+from workers import tracking_consumer
+
+GOOD = {"received_at": "2026-01-01T00:00:00", "events": '[["click",1,2]]'}
+POISON = {"received_at": "not a timestamp", "events": "[]"}
+
+class FakeStream:
+    """Pending entries of one consumer, with their delivery counts"""
+
+    def __init__(self, entries, delivered):
+        self.pending = dict(entries)
+        self.delivered = dict(delivered)
+        self.dead = []
+
+    def xreadgroup(self, group, consumer, streams, count):
+        for entry_id in self.pending:
+            self.delivered[entry_id] += 1
+        return [("stream", list(self.pending.items()))] if self.pending else []
+
+    def xpending_range(self, stream, group, min, max, count, consumername):
+        return [{"message_id": entry_id, "times_delivered": self.delivered[entry_id]} for entry_id in self.pending]
+
+    def xack(self, stream, group, *entry_ids):
+        for entry_id in entry_ids:
+            self.pending.pop(entry_id, None)
+
+    def xadd(self, stream, fields, **options):
+        self.dead.append((stream, fields["entry_id"]))
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+@pytest.fixture
+def applied(monkeypatch):
+    applied = []
+
+    def flush(client, entry_ids, events):
+        applied.extend(entry_ids)
+        client.xack("stream", "group", *entry_ids)
+
+    monkeypatch.setattr(tracking_consumer, "flush", flush)
+    monkeypatch.setattr(tracking_consumer.metrics, "incr", lambda *args, **labels: None)
+    return applied
+
+def test_entry_failing_past_max_deliveries_is_dead_lettered(applied):
+    stream = FakeStream({"1-0": GOOD, "2-0": POISON, "3-0": GOOD}, {"1-0": 0, "2-0": 4, "3-0": 0})
+
+    assert tracking_consumer.drain_backlog(stream, "consumer")
+
+    assert applied == ["1-0", "3-0"]
+    assert stream.dead == [(TRACKING_DEAD_LETTER_STREAM, "2-0")]
+    assert stream.pending == {}
+
+def test_entry_below_max_deliveries_stays_pending(applied):
+    stream = FakeStream({"1-0": GOOD, "2-0": POISON, "3-0": GOOD}, {"1-0": 0, "2-0": 0, "3-0": 0})
+
+    with pytest.raises(ValueError):
+        tracking_consumer.drain_backlog(stream, "consumer")
+
+    assert applied == ["1-0"]
+    assert stream.dead == [] and list(stream.pending) == ["2-0", "3-0"]
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def test_abandoned_entries_are_claimed_while_consuming(monkeypatch):
+    clock = Clock()
+    calls = []
+    claimable = [0, 2]
+
+    def read_batch(client, consumer):
+        # Each read waits out one flush interval
+        clock.now += 20.0
+        calls.append("read")
+        return [], []
+
+    def claim_abandoned(client, consumer):
+        calls.append("claim")
+        return claimable.pop(0)
+
+    def drain_backlog(client, consumer):
+        calls.append("backlog")
+        return False
+
+    monkeypatch.setattr(tracking_consumer, "time", clock)
+    monkeypatch.setattr(tracking_consumer, "read_batch", read_batch)
+    monkeypatch.setattr(tracking_consumer, "claim_abandoned", claim_abandoned)
+    monkeypatch.setattr(tracking_consumer, "drain_backlog", drain_backlog)
+    monkeypatch.setattr(tracking_consumer, "trim_consumed", lambda client: None)
+    iterations = iter(range(9))
+
+    tracking_consumer.consume(object(), "consumer", lambda: next(iterations, None) is None)
+
+    # A claim every CLAIM_IDLE_MS; claimed entries are drained from the backlog before new reads
+    assert calls == [
+        "backlog", "read", "read", "read",
+        "claim", "read", "read", "read",
+        "claim", "backlog", "read",
+    ]
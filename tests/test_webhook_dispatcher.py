@@ -0,0 +1,105 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from core.webhooks import SIGNATURE_HEADER, WebhookRegistry, sign
+from workers import webhook_dispatcher
+from workers.webhook_dispatcher import CircuitBreaker, PendingEvent, WebhookDispatcher
+
+@pytest.fixture
+def endpoint(monkeypatch, stand_in_server):
+    """Local stand-in for a customer endpoint: /ok accepts, anything else fails"""
+    recorded = []
+    monkeypatch.setattr(webhook_dispatcher, "record_outcomes", recorded.extend)
+    monkeypatch.setattr(webhook_dispatcher.metrics, "incr", lambda *args, **labels: None)
+    monkeypatch.setattr(webhook_dispatcher.metrics, "observe", lambda *args, **labels: None)
+    server = stand_in_server(lambda path: (200 if path == "/ok" else 500, {}))
+    return server, recorded
+
+def batches(server):
+    return [(request.path, len(json.loads(request.body)["events"])) for request in server.requests]
+
+def dispatch(events, **dispatcher_options):
+    async def run():
+        dispatcher = WebhookDispatcher(**dispatcher_options)
+        dispatcher.dispatch(events)
+        await dispatcher.aclose()
+    asyncio.run(run())
+
+def pending(url, count, start=0, secret=None):
+    return [
+        PendingEvent(start + i, datetime(2026, 1, 1), 0, url, {"id": start + i}, secret) for i in range(count)
+    ]
+
+def test_events_for_one_url_are_coalesced_into_batches(endpoint):
+    server, recorded = endpoint
+
+    dispatch(pending(f"{server.url}/ok", 1200) + pending(f"{server.url}/down", 3, start=5000))
+
+    assert sorted(batches(server)) == [("/down", 3), ("/ok", 200), ("/ok", 500), ("/ok", 500)]
+    delivered = [outcome for outcome in recorded if outcome[2]]
+    retried = [outcome for outcome in recorded if not outcome[2]]
+    assert len(delivered) == 1200
+    assert len(retried) == 3 and all(outcome[4] is not None for outcome in retried)
+
+def test_open_circuit_holds_events_back_without_spending_attempts(endpoint):
+    server, recorded = endpoint
+    events = pending(f"{server.url}/down", 1)
+
+    async def run():
+        dispatcher = WebhookDispatcher()
+        dispatcher._breakers[events[0].url] = breaker = CircuitBreaker(threshold=1, cooldown=60)
+        breaker.failed(time.monotonic())
+        dispatcher.dispatch(events)
+        await dispatcher.aclose()
+    asyncio.run(run())
+
+    assert server.requests == []
+    assert recorded[0][3] == 0 and recorded[0][5] == "circuit open"
+
+def test_circuit_half_opens_for_a_single_probe():
+    breaker = CircuitBreaker(threshold=2, cooldown=10)
+    breaker.failed(0)
+    assert breaker.allow(1)
+    breaker.failed(1)
+
+    assert not breaker.allow(5)
+    assert breaker.allow(11)
+    assert not breaker.allow(11)
+    breaker.succeeded()
+    assert breaker.allow(12)
+
+def test_batches_to_registered_webhooks_are_signed_once_per_body(endpoint):
+    server, _ = endpoint
+
+    dispatch(pending(f"{server.url}/ok", 3, secret="s3cret") + pending(f"{server.url}/ok", 2, start=10))
+
+    signed = [(request.body, request.headers.get(SIGNATURE_HEADER)) for request in server.requests]
+    signatures = sorted(signed, key=lambda batch: batch[1] is None)
+    (raw, header), (_, unsigned) = signatures
+    timestamp, digest = (part.split("=", 1)[1] for part in header.split(","))
+    assert digest == sign("s3cret", int(timestamp), raw)
+    assert unsigned is None
+
+class FakeQuery(list):
+    def filter(self, *criteria):
+        return self
+
+    def order_by(self, *columns):
+        return self
+
+def test_registry_routes_event_types_and_wildcards():
+    webhooks = FakeQuery([
+        SimpleNamespace(id=1, url="https://a.example/hook", events=["click"], secret="a"),
+        SimpleNamespace(id=2, url="https://b.example/hook", events=["*"], secret="b"),
+    ])
+    registry = WebhookRegistry()
+    registry.load(SimpleNamespace(query=lambda model: webhooks))
+
+    assert [endpoint.id for endpoint in registry.endpoints_for("click")] == [1, 2]
+    assert [endpoint.id for endpoint in registry.endpoints_for("conversion")] == [2]
+    assert registry.get(1).secret == "a" and registry.get(3) is None
@@ -0,0 +1,111 @@
+"""
+Evaluates running A/B tests every AB_TEST_EVALUATION_INTERVAL seconds and,
+once a variant wins, sends it to the part of the audience held out of the
+test sample.
+"""
+from datetime import datetime
+from typing import Dict, Optional
+import logging
+
+from sqlalchemy import exc
+
+from core import outbox
+from core.ab_testing import ROLLOUT_VARIANT, evaluate
+from core.database import SessionLocal
+from core.models import ABTest, Notification, NotificationAction, NotificationSegment
+from workers.celery_worker import celery_app, queue_for_priority
+from workers.tasks import process_notification
+
+logger = logging.getLogger(__name__)
+
+def create_rollout(db, test: ABTest, variant_id: str) -> Optional[Notification]:
+    """Copy the winning variant into a notification for the held-out audience"""
+    winner_id = next(
+        (variant["notification_id"] for variant in test.variants if variant["variant_id"] == variant_id), None
+    )
+    winner = db.query(Notification).filter(Notification.id == winner_id).first()
+    if winner is None:
+        return None
+
+    rollout = Notification(
+        title=winner.title,
+        body=winner.body,
+        icon=winner.icon,
+        image=winner.image,
+        badge=winner.badge,
+        data=winner.data,
+        priority=winner.priority,
+        ttl=winner.ttl,
+        require_interaction=winner.require_interaction,
+        campaign_id=winner.campaign_id,
+        template_id=winner.template_id,
+        variant_id=ROLLOUT_VARIANT,
+        ab_test_group=str(test.id),
+        actions=[
+            NotificationAction(type=action.type, title=action.title, action=action.action)
+            for action in winner.actions
+        ],
+        segments=[
+            NotificationSegment(segment_name=segment.segment_name, targeting_rules=segment.targeting_rules)
+            for segment in winner.segments
+        ]
+    )
+    db.add(rollout)
+    db.flush()
+    return rollout
+
+def evaluate_tests(db, now: Optional[datetime] = None) -> Dict[str, int]:
+    """
+    Refresh the results of every running test and complete those with a winner.
+    Tests are claimed with FOR UPDATE SKIP LOCKED, so a winner is rolled out once.
+    """
+    now = now or datetime.utcnow()
+    tests = (
+        db.query(ABTest)
+        .filter(ABTest.status == "running")
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+    rollouts = []
+    completed = 0
+    for test in tests:
+        results = evaluate(db, test, now)
+        winner = results["winner"]
+        if winner is None:
+            continue
+
+        test.status = "completed"
+        test.winner_variant_id = winner
+        results = {**results, "status": test.status}
+        completed += 1
+        logger.info(
+            f"A/B test {test.id} picked variant {winner} with "
+            f"P(best)={results['variants'][winner]['probability_best']:.3f}"
+        )
+        if test.auto_rollout:
+            rollout = create_rollout(db, test, winner)
+            if rollout is not None:
+                test.rollout_notification_id = rollout.id
+                results["rollout_notification_id"] = rollout.id
+                rollouts.append(rollout)
+        # Reassigned rather than mutated, as JSON columns do not track changes in place
+        test.results = results
+
+    for rollout in rollouts:
+        outbox.enqueue(db, process_notification, (rollout.id,), queue=queue_for_priority(rollout.priority))
+    db.commit()
+
+    return {"evaluated": len(tests), "completed": completed, "rollouts": len(rollouts)}
+
+@celery_app.task(name='tasks.evaluate_ab_tests')
+def evaluate_ab_tests_task():
+    db = SessionLocal()
+    try:
+        return evaluate_tests(db)
+    except exc.SQLAlchemyError as db_error:
+        logger.error(f"Database error while evaluating A/B tests: {str(db_error)}")
+        db.rollback()
+        raise
+    finally:
+        db.close()
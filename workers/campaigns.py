@@ -0,0 +1,249 @@
+"""
+Runs campaigns in paced waves.
+
+Every CAMPAIGN_TICK_INTERVAL seconds the runner picks up active campaigns
+whose start_date has passed. On its first wave a campaign gets one
+Notification rendered from its template and targeted at its segments, and
+the audience is planned into send chunks. Each wave then releases the share
+of chunks due by that point of the campaign window, within a global budget
+of chunks in flight, so concurrent campaigns share the workers instead of
+releasing their full audiences at once.
+
+Setting Campaign.status to paused holds chunks that have not started and
+stops running ones at their next checkpoint; they are released again once
+the campaign is active. A campaign under an A/B test is not run here: the
+chunks of its variants and rollout are not the runner's to release, so a
+held one tries again every CAMPAIGN_TICK_INTERVAL until the campaign resumes.
+
+A chunk whose task was lost or gave up would hold its in-flight slot for
+good, so chunks unfinished CAMPAIGN_CHUNK_TIMEOUT after their release are
+released again, resuming from their checkpoint, and marked failed after
+CAMPAIGN_CHUNK_MAX_ATTEMPTS releases.
+"""
+from collections import deque
+from datetime import datetime, timedelta
+from math import ceil
+from typing import Dict, List, Optional
+import logging
+
+from sqlalchemy import exc, exists, func, or_
+
+from config.settings import settings
+from core import outbox
+from core.database import SessionLocal
+from core.models import (
+    ABTest, Campaign, CampaignStatus, Notification, NotificationPriority,
+    NotificationSegment, NotificationSendProgress
+)
+from core.segments import SegmentRuleError
+from workers.celery_worker import celery_app, queue_for_priority
+from workers.tasks import aggregate_notification_results, plan_notification_chunks, send_notification_chunk
+
+logger = logging.getLogger(__name__)
+
+# Campaign.schedule_type values the runner sends; trigger-based campaigns are sent by their triggers
+IMMEDIATE = "immediate"
+SCHEDULED = "scheduled"
+
+def launch_campaign(db, campaign: Campaign) -> Notification:
+    """Create the campaign's notification from its template and plan its chunks"""
+    template = campaign.template
+    notification = Notification(
+        title=template.title_template,
+        body=template.body_template,
+        priority=NotificationPriority.low,
+        campaign_id=campaign.id,
+        template_id=template.id,
+        segments=[
+            NotificationSegment(segment_name=segment.segment_name)
+            for segment in campaign.campaign_segments
+        ]
+    )
+    db.add(notification)
+    db.flush()
+    chunks = plan_notification_chunks(db, notification)
+    db.flush()
+    logger.info(f"Launched campaign {campaign.id} as notification {notification.id} in {len(chunks)} chunks")
+    return notification
+
+def release_fraction(campaign: Campaign, now: datetime) -> float:
+    """
+    Share of the audience due by now. Scheduled campaigns are spread evenly over
+    their window, counting the wave about to go out; immediate ones are all due.
+    """
+    if campaign.schedule_type != SCHEDULED:
+        return 1.0
+    if campaign.end_date is not None:
+        window = (campaign.end_date - campaign.start_date).total_seconds()
+    else:
+        window = settings.CAMPAIGN_SEND_WINDOW
+    if window <= 0:
+        return 1.0
+    elapsed = (now - campaign.start_date).total_seconds() + settings.CAMPAIGN_TICK_INTERVAL
+    return min(1.0, max(0.0, elapsed / window))
+
+def expire_stalled_chunks(db, now: datetime) -> Dict[str, int]:
+    """Release chunks that stayed unfinished too long again, or fail them after too many releases"""
+    stalled = (
+        NotificationSendProgress.dispatched_at < now - timedelta(seconds=settings.CAMPAIGN_CHUNK_TIMEOUT),
+        NotificationSendProgress.completed_at.is_(None)
+    )
+    failed = (
+        db.query(NotificationSendProgress)
+        .filter(*stalled, NotificationSendProgress.attempts >= settings.CAMPAIGN_CHUNK_MAX_ATTEMPTS)
+        .update({"dispatched_at": None, "failed_at": now}, synchronize_session=False)
+    )
+    released = (
+        db.query(NotificationSendProgress)
+        .filter(*stalled)
+        .update({"dispatched_at": None}, synchronize_session=False)
+    )
+    if failed or released:
+        logger.warning(f"Stalled campaign chunks: {released} released again, {failed} failed")
+    return {"released": released, "failed": failed}
+
+def chunks_in_flight(db) -> int:
+    """Campaign chunks released to the workers and not finished yet"""
+    return (
+        db.query(func.count(NotificationSendProgress.id))
+        .join(Notification, Notification.id == NotificationSendProgress.notification_id)
+        .filter(
+            Notification.campaign_id.isnot(None),
+            NotificationSendProgress.dispatched_at.isnot(None),
+            NotificationSendProgress.completed_at.is_(None)
+        )
+        .scalar()
+    )
+
+def _chunk_counts(db, notification_id: int):
+    """(total, released, finished) chunk counts of a notification; failed chunks are finished"""
+    finished = or_(NotificationSendProgress.completed_at.isnot(None), NotificationSendProgress.failed_at.isnot(None))
+    return db.query(
+        func.count(NotificationSendProgress.id),
+        func.count(NotificationSendProgress.id).filter(or_(
+            NotificationSendProgress.dispatched_at.isnot(None),
+            finished
+        )),
+        func.count(NotificationSendProgress.id).filter(finished)
+    ).filter(NotificationSendProgress.notification_id == notification_id).one()
+
+def _release_chunks(db, notification: Notification, count: int, now: datetime) -> int:
+    chunks = (
+        db.query(NotificationSendProgress)
+        .filter(
+            NotificationSendProgress.notification_id == notification.id,
+            NotificationSendProgress.dispatched_at.is_(None),
+            NotificationSendProgress.completed_at.is_(None),
+            NotificationSendProgress.failed_at.is_(None)
+        )
+        .order_by(NotificationSendProgress.start_after)
+        .limit(count)
+        .all()
+    )
+    queue = queue_for_priority(notification.priority)
+    for chunk in chunks:
+        chunk.dispatched_at = now
+        chunk.attempts += 1
+        outbox.enqueue(db, send_notification_chunk, (notification.id, chunk.start_after, chunk.end_at), queue=queue)
+    db.flush()
+    return len(chunks)
+
+def run_campaigns(db, now: Optional[datetime] = None) -> Dict[str, int]:
+    """
+    Send one wave for every running campaign. Campaign rows are claimed with
+    FOR UPDATE SKIP LOCKED, so overlapping waves never release a chunk twice.
+    """
+    now = now or datetime.utcnow()
+    expire_stalled_chunks(db, now)
+    campaigns = (
+        db.query(Campaign)
+        .filter(
+            Campaign.status == CampaignStatus.active.value,
+            Campaign.schedule_type.in_((IMMEDIATE, SCHEDULED)),
+            Campaign.start_date <= now,
+            # Campaigns under an A/B test are sent by its variants and rollout
+            ~exists().where(ABTest.campaign_id == Campaign.id)
+        )
+        .order_by(Campaign.id)
+        .with_for_update(of=Campaign, skip_locked=True)
+        .all()
+    )
+
+    due: Dict[int, int] = {}
+    notifications: Dict[int, Notification] = {}
+    completed: List[int] = []
+
+    for campaign in campaigns:
+        notification = (
+            db.query(Notification)
+            .filter(Notification.campaign_id == campaign.id, Notification.ab_test_group.is_(None))
+            .order_by(Notification.id)
+            .first()
+        )
+        if notification is None:
+            if campaign.template is None:
+                logger.error(f"Campaign {campaign.id} has no template; pausing it")
+                campaign.status = CampaignStatus.paused.value
+                continue
+            try:
+                with db.begin_nested():
+                    notification = launch_campaign(db, campaign)
+            except SegmentRuleError as rule_error:
+                logger.error(f"Invalid segments for campaign {campaign.id}, pausing it: {str(rule_error)}")
+                campaign.status = CampaignStatus.paused.value
+                continue
+
+        total, released, finished = _chunk_counts(db, notification.id)
+        if finished == total:
+            campaign.status = CampaignStatus.completed.value
+            completed.append(notification.id)
+            continue
+
+        target = ceil(total * release_fraction(campaign, now))
+        wave = min(target - released, settings.CAMPAIGN_MAX_CHUNKS_PER_WAVE)
+        if wave > 0:
+            due[campaign.id] = wave
+            notifications[campaign.id] = notification
+
+    # Share the in-flight budget round-robin so one large campaign cannot starve the rest
+    budget = settings.CAMPAIGN_MAX_CHUNKS_IN_FLIGHT - chunks_in_flight(db)
+    allotted: Dict[int, int] = {}
+    waiting = deque(due)
+    while budget > 0 and waiting:
+        campaign_id = waiting.popleft()
+        allotted[campaign_id] = allotted.get(campaign_id, 0) + 1
+        budget -= 1
+        if allotted[campaign_id] < due[campaign_id]:
+            waiting.append(campaign_id)
+
+    released_chunks = sum(
+        _release_chunks(db, notifications[campaign_id], count, now)
+        for campaign_id, count in allotted.items()
+    )
+    db.commit()
+
+    for notification_id in completed:
+        aggregate_notification_results([], notification_id)
+
+    if released_chunks or completed:
+        logger.info(
+            f"Campaign wave: released {released_chunks} chunks across {len(allotted)} campaigns, "
+            f"{len(completed)} campaigns completed"
+        )
+    return {
+        "campaigns": len(campaigns),
+        "released_chunks": released_chunks,
+        "completed_campaigns": len(completed)
+    }
+
+@celery_app.task(name='tasks.run_campaigns')
+def run_campaigns_task():
+    db = SessionLocal()
+    try:
+        return run_campaigns(db)
+    except exc.SQLAlchemyError as db_error:
+        logger.error(f"Database error while running campaigns: {str(db_error)}")
+        db.rollback()
+        raise
+    finally:
+        db.close()
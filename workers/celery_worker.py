@@ -1,11 +1,14 @@
 from celery import Celery
+from celery.signals import before_task_publish, task_prerun, worker_process_init
+from kombu import Queue
 from config.settings import settings
+import time
 
 celery_app = Celery(
     "webpush_worker",
     broker=f"amqp://{settings.RABBITMQ_USER}:{settings.RABBITMQ_PASS}@{settings.RABBITMQ_HOST}:{settings.RABBITMQ_PORT}//",
     backend=f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/0",
-    include=["workers.tasks"]
+    include=["workers.tasks", "workers.campaigns", "workers.ab_tests"]
 )
 
 # Optional configurations
@@ -17,18 +20,83 @@ celery_app.conf.update(
     enable_utc=True,
 )
 
-# Optional task routing
+# Queues. Transactional sends get their own worker pool so their latency
+# holds while a broadcast to millions is draining.
+TRANSACTIONAL_QUEUE = 'transactional'
+BROADCAST_QUEUE = 'broadcast'
+MAINTENANCE_QUEUE = 'maintenance'
+QUEUES = (TRANSACTIONAL_QUEUE, BROADCAST_QUEUE, MAINTENANCE_QUEUE)
+
+celery_app.conf.task_queues = [Queue(name) for name in QUEUES]
+celery_app.conf.task_default_queue = BROADCAST_QUEUE
+
+# Notification tasks are routed per call with queue_for_priority()
 celery_app.conf.task_routes = {
-    'workers.tasks.*': {'queue': 'default'}
+    'tasks.cleanup_old_notifications': {'queue': MAINTENANCE_QUEUE},
+    'tasks.record_queue_metrics': {'queue': MAINTENANCE_QUEUE},
+    'tasks.build_segment_bitmap': {'queue': MAINTENANCE_QUEUE},
+    'tasks.update_segment_memberships': {'queue': MAINTENANCE_QUEUE},
+    'tasks.reconcile_segment_memberships': {'queue': MAINTENANCE_QUEUE},
+    'tasks.run_campaigns': {'queue': MAINTENANCE_QUEUE},
+    'tasks.evaluate_ab_tests': {'queue': MAINTENANCE_QUEUE},
+    'tasks.maintain_partitions': {'queue': MAINTENANCE_QUEUE},
 }
 
-# Optional task settings
-celery_app.conf.task_annotations = {
-    '*': {
-        'rate_limit': '10/s'
-    }
+celery_app.conf.beat_schedule = {
+    'record-queue-metrics': {
+        'task': 'tasks.record_queue_metrics',
+        'schedule': settings.QUEUE_METRICS_INTERVAL,
+    },
+    'run-campaigns': {
+        'task': 'tasks.run_campaigns',
+        'schedule': settings.CAMPAIGN_TICK_INTERVAL,
+    },
+    'evaluate-ab-tests': {
+        'task': 'tasks.evaluate_ab_tests',
+        'schedule': settings.AB_TEST_EVALUATION_INTERVAL,
+    },
+    'maintain-partitions': {
+        'task': 'tasks.maintain_partitions',
+        'schedule': settings.PARTITION_MAINTENANCE_INTERVAL,
+    },
+    'reconcile-segment-memberships': {
+        'task': 'tasks.reconcile_segment_memberships',
+        'schedule': settings.SEGMENT_RECONCILE_INTERVAL,
+    },
 }
 
+def queue_for_priority(priority) -> str:
+    """
+    High-priority notifications are transactional; everything else is a broadcast
+    """
+    value = getattr(priority, 'value', priority)
+    return TRANSACTIONAL_QUEUE if value == 'high' else BROADCAST_QUEUE
+
+@before_task_publish.connect
+def stamp_enqueue_time(headers=None, **kwargs):
+    """Record when a task was published so workers can measure queue wait time"""
+    if headers is not None:
+        headers.setdefault('enqueued_at', time.time())
+
+@worker_process_init.connect
+def reset_db_pools(**kwargs):
+    """Prefork children must not share the parent's pooled connections"""
+    from core.database import async_engine, engine
+
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+
+@task_prerun.connect
+def record_queue_wait(task=None, **kwargs):
+    from core import metrics
+
+    request = task.request
+    enqueued_at = getattr(request, 'enqueued_at', None) or (request.headers or {}).get('enqueued_at')
+    if enqueued_at is None:
+        return
+    queue = (request.delivery_info or {}).get('routing_key') or 'unknown'
+    metrics.observe('queue_wait_seconds', time.time() - float(enqueued_at), queue=queue)
+
 # Make sure this is at the end of the file
 if __name__ == '__main__': 
     celery_app.start()
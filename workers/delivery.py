@@ -0,0 +1,205 @@
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Mapping, Optional
+from urllib.parse import urlsplit
+import logging
+import time
+
+from config.settings import settings
+from core import metrics
+from core.models import Notification, UserProfile
+from core.push_crypto import EncryptionStats, build_payload, get_encryptor, get_vapid_signer
+from core.push_delivery import PushMessage, URGENCY_BY_PRIORITY, deliver, push_service_origin
+from core.rate_limit import get_rate_limiter
+from core.templates import render_many
+from sqlalchemy.orm import object_session
+from workers.result_writer import DeliveryResultWriter
+
+logger = logging.getLogger(__name__)
+
+# Push service responses that mean "slow down", not "this push failed"
+THROTTLE_STATUS_CODES = (429, 503)
+
+@dataclass
+class DeliveryOutcome:
+    successful_pushes: int = 0
+    failed_pushes: int = 0
+    # Pushes held back by rate limiting, to be rescheduled after retry_delay
+    deferred_ids: List[int] = field(default_factory=list)
+    retry_delay: float = 0.0
+    encryption_stats: EncryptionStats = field(default_factory=EncryptionStats)
+
+    def defer(self, messages: List[PushMessage], delay: float):
+        self.deferred_ids.extend(message.subscription_id for message in messages)
+        self.retry_delay = max(self.retry_delay, delay)
+
+    def fail_deferred(self, writer: DeliveryResultWriter, error: str) -> int:
+        """Record the deferred pushes as failed instead of rescheduling them again"""
+        for subscription_id in self.deferred_ids:
+            writer.add_failure(subscription_id, error)
+        failed = len(self.deferred_ids)
+        self.failed_pushes += failed
+        self.deferred_ids = []
+        return failed
+
+    def merge(self, other: "DeliveryOutcome"):
+        self.successful_pushes += other.successful_pushes
+        self.failed_pushes += other.failed_pushes
+        self.deferred_ids.extend(other.deferred_ids)
+        self.retry_delay = max(self.retry_delay, other.retry_delay)
+        self.encryption_stats.pushes += other.encryption_stats.pushes
+        self.encryption_stats.cpu_seconds += other.encryption_stats.cpu_seconds
+
+def build_push_headers(notification: Notification) -> Dict[str, str]:
+    """
+    Build the Web Push protocol headers shared by every push of a notification
+    """
+    priority = notification.priority.value if notification.priority else "medium"
+    return {
+        "TTL": str(notification.ttl if notification.ttl is not None else settings.PUSH_DEFAULT_TTL),
+        "Urgency": URGENCY_BY_PRIORITY[priority],
+        "Content-Type": "application/octet-stream",
+        "Content-Encoding": "aes128gcm",
+    }
+
+def load_profiles(db, user_ids) -> Dict[str, Dict[str, Any]]:
+    """Template variables of each user: profile columns plus JSON attributes"""
+    user_ids = [user_id for user_id in set(user_ids) if user_id]
+    if not user_ids:
+        return {}
+    rows = db.query(
+        UserProfile.user_id, UserProfile.loyalty_tier, UserProfile.country,
+        UserProfile.last_purchase_at, UserProfile.attributes
+    ).filter(UserProfile.user_id.in_(user_ids))
+    profiles = {}
+    for row in rows:
+        profile = dict(row.attributes or {})
+        profile.update(
+            user_id=row.user_id, loyalty_tier=row.loyalty_tier,
+            country=row.country, last_purchase_at=row.last_purchase_at
+        )
+        profiles[row.user_id] = profile
+    return profiles
+
+def personalize_payloads(notification: Notification, subscriptions: Mapping) -> Optional[Dict[int, bytes]]:
+    """
+    Render the notification's template for each subscriber from their profile,
+    falling back to notification.data for variables a profile does not set.
+    None when the notification has no template.
+    """
+    template = notification.template
+    if template is None:
+        return None
+    rows = list(subscriptions.values())
+    profiles = load_profiles(object_session(notification), (row.user_id for row in rows))
+    rendered = render_many(
+        template,
+        (profiles.get(row.user_id, {}) for row in rows),
+        defaults=notification.data or {}
+    )
+    return {
+        row.id: build_payload(notification, title, body)
+        for row, (title, body) in zip(rows, rendered)
+    }
+
+def encrypt_messages(notification: Notification, subscriptions: Mapping, writer: DeliveryResultWriter,
+                     outcome: DeliveryOutcome) -> List[PushMessage]:
+    """Encrypt the notification payload for each (id, endpoint, p256dh, auth, user_id) row"""
+    payload = build_payload(notification)
+    encrypted, outcome.encryption_stats = get_encryptor().encrypt_many(
+        payload,
+        [(row.id, row.p256dh, row.auth) for row in subscriptions.values()],
+        payloads=personalize_payloads(notification, subscriptions)
+    )
+
+    messages = []
+    headers = build_push_headers(notification)
+    signer = get_vapid_signer()
+
+    for subscription_id, body, error in encrypted:
+        if error:
+            logger.error(f"Failed to encrypt push for subscription {subscription_id}: {error}")
+            writer.add_failure(subscription_id, error)
+            outcome.failed_pushes += 1
+            continue
+        endpoint = subscriptions[subscription_id].endpoint
+        message_headers = dict(headers)
+        if signer is not None:
+            message_headers["Authorization"] = signer.authorization(endpoint)
+        messages.append(PushMessage(
+            subscription_id=subscription_id, endpoint=endpoint, body=body, headers=message_headers
+        ))
+
+    return messages
+
+def send_rate_limited(messages: List[PushMessage], writer: DeliveryResultWriter, outcome: DeliveryOutcome):
+    """
+    Send messages within each push service's shared token bucket. Waits up to
+    PUSH_RATE_LIMIT_MAX_WAIT for tokens; anything blocked longer, or throttled
+    by the push service, is deferred rather than failed.
+    """
+    limiter = get_rate_limiter()
+    pending: Dict[str, List[PushMessage]] = defaultdict(list)
+    for message in messages:
+        pending[push_service_origin(message.endpoint)].append(message)
+
+    while pending:
+        batch: List[PushMessage] = []
+        waits: Dict[str, float] = {}
+        for origin, origin_messages in pending.items():
+            granted, wait = limiter.acquire(origin, len(origin_messages))
+            batch.extend(origin_messages[:granted])
+            pending[origin] = origin_messages[granted:]
+            if pending[origin]:
+                waits[origin] = wait
+
+        accepted: Dict[str, int] = defaultdict(int)
+        throttled: Dict[str, float] = {}
+        throttled_pushes: Dict[str, int] = defaultdict(int)
+        pushed_at = datetime.utcnow()
+
+        for result in deliver(batch):
+            origin = push_service_origin(result.endpoint)
+            if result.status_code in THROTTLE_STATUS_CODES:
+                throttled[origin] = max(throttled.get(origin, 0.0), result.retry_after or 0.0)
+                throttled_pushes[urlsplit(origin).hostname] += 1
+                outcome.deferred_ids.append(result.subscription_id)
+                continue
+
+            writer.add(result, pushed_at)
+            if result.success:
+                accepted[origin] += 1
+                outcome.successful_pushes += 1
+            else:
+                logger.error(f"Failed to push to subscription {result.subscription_id}: {result.status_code} {result.error}")
+                outcome.failed_pushes += 1
+
+        for origin, retry_after in throttled.items():
+            delay = limiter.throttled(origin, retry_after)
+            outcome.retry_delay = max(outcome.retry_delay, delay)
+            # The origin is blocked now, so hold back the rest of its queue too
+            outcome.defer(pending.pop(origin, []), delay)
+        for origin in accepted:
+            if origin not in throttled:
+                limiter.recovered(origin)
+        metrics.incr_many("pushes_throttled_total", throttled_pushes, label="push_service")
+
+        pending = {origin: queued for origin, queued in pending.items() if queued}
+        if not pending:
+            break
+
+        wait = min(waits[origin] for origin in pending)
+        if wait > settings.PUSH_RATE_LIMIT_MAX_WAIT:
+            for origin, queued in pending.items():
+                outcome.defer(queued, waits[origin])
+            break
+        time.sleep(wait)
+
+def deliver_notification(notification: Notification, subscriptions: Mapping,
+                         writer: DeliveryResultWriter) -> DeliveryOutcome:
+    """Encrypt and send a notification to the given subscription rows"""
+    outcome = DeliveryOutcome()
+    messages = encrypt_messages(notification, subscriptions, writer, outcome)
+    send_rate_limited(messages, writer, outcome)
+    return outcome
@@ -0,0 +1,151 @@
+"""
+Publishes the Celery tasks written to the outbox:
+
+    python -m workers.outbox_relay
+
+Pending tasks are claimed in id order with FOR UPDATE SKIP LOCKED, so several
+relays can run side by side. A batch is published on one channel in publisher
+confirm mode without waiting on each message; the relay then waits once for
+the broker to confirm all of them, and deletes the batch only after that. A
+relay that stops midway leaves its batch to be published again, so tasks are
+delivered at least once.
+"""
+from datetime import datetime
+from typing import Set
+import logging
+import signal
+import time
+
+from kombu import Producer
+
+from config.settings import settings
+from core import metrics
+from core.database import SessionLocal
+from core.models import OutboxMessage
+from workers.celery_worker import celery_app
+
+logger = logging.getLogger(__name__)
+
+class ConfirmedChannel:
+    """
+    A broker channel in publisher confirm mode. Publishing does not wait;
+    wait_for_confirms() waits until the broker confirmed every message so far.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.channel = connection.channel()
+        self.channel.confirm_select()
+        self.channel.events["basic_ack"].add(self._on_ack)
+        self.channel.events["basic_nack"].add(self._on_nack)
+        self.producer = Producer(self.channel)
+        # Delivery tags count the channel's publishes from 1
+        self._next_tag = 1
+        self._unconfirmed: Set[int] = set()
+        self._rejected = 0
+
+    def publish(self, message: OutboxMessage):
+        celery_app.send_task(
+            message.task,
+            args=message.args,
+            kwargs=message.kwargs,
+            queue=message.queue,
+            task_id=f"outbox-{message.id}",
+            producer=self.producer
+        )
+        self._unconfirmed.add(self._next_tag)
+        self._next_tag += 1
+
+    def _settle(self, delivery_tag: int, multiple: bool):
+        if multiple:
+            self._unconfirmed = {tag for tag in self._unconfirmed if tag > delivery_tag}
+        else:
+            self._unconfirmed.discard(delivery_tag)
+
+    def _on_ack(self, delivery_tag: int, multiple: bool):
+        self._settle(delivery_tag, multiple)
+
+    def _on_nack(self, delivery_tag: int, multiple: bool):
+        before = len(self._unconfirmed)
+        self._settle(delivery_tag, multiple)
+        self._rejected += before - len(self._unconfirmed)
+
+    def wait_for_confirms(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while self._unconfirmed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Broker did not confirm {len(self._unconfirmed)} tasks within {timeout}s")
+            self.connection.drain_events(timeout=remaining)
+        if self._rejected:
+            rejected, self._rejected = self._rejected, 0
+            raise RuntimeError(f"Broker rejected {rejected} tasks")
+
+def publish_batch(db, channel: ConfirmedChannel, limit: int) -> int:
+    """Publish up to limit pending tasks and delete them. Returns the number published."""
+    messages = (
+        db.query(OutboxMessage)
+        .order_by(OutboxMessage.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if not messages:
+        db.rollback()
+        return 0
+
+    for message in messages:
+        channel.publish(message)
+    channel.wait_for_confirms(settings.OUTBOX_CONFIRM_TIMEOUT)
+    # Read before the commit expires the deleted rows
+    lag = (datetime.utcnow() - messages[0].created_at).total_seconds()
+
+    db.query(OutboxMessage).filter(
+        OutboxMessage.id.in_([message.id for message in messages])
+    ).delete(synchronize_session=False)
+    db.commit()
+
+    metrics.incr("outbox_published_total", len(messages))
+    metrics.observe("outbox_lag_seconds", lag)
+    return len(messages)
+
+def run():
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("Outbox relay started")
+
+    connection = channel = None
+    while not stopping:
+        db = SessionLocal()
+        try:
+            if connection is None:
+                connection = celery_app.connection_for_write()
+                channel = ConfirmedChannel(connection)
+            published = publish_batch(db, channel, settings.OUTBOX_BATCH_SIZE)
+        except Exception as e:
+            logger.error(f"Failed to relay outbox tasks: {str(e)}")
+            db.rollback()
+            if connection is not None:
+                connection.release()
+            connection = channel = None
+            published = 0
+        finally:
+            db.close()
+
+        # A full batch means more are pending; drain them before sleeping
+        if published < settings.OUTBOX_BATCH_SIZE:
+            time.sleep(settings.OUTBOX_POLL_INTERVAL)
+
+    if connection is not None:
+        connection.release()
+    logger.info("Outbox relay stopped")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()
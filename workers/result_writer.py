@@ -0,0 +1,138 @@
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+import logging
+
+from sqlalchemy import Integer, DateTime, column, select, update, values
+from sqlalchemy.dialects.postgresql import insert
+
+from config.settings import settings
+from core.database import engine
+from core import metrics, rollups
+from core.models import DeliveryStatus, Notification, Subscription
+from core.push_delivery import PushResult
+
+# Push service responses meaning the subscription has expired or was revoked
+GONE_STATUS_CODES = (404, 410)
+
+logger = logging.getLogger(__name__)
+
+class DeliveryResultWriter:
+    """
+    Buffers the delivery outcomes of a notification and flushes them with
+    set-based statements: one multi-row INSERT ... ON CONFLICT into
+    delivery_statuses and one UPDATE subscriptions ... FROM (VALUES ...)
+    for last_push_at, instead of one dirty ORM object per subscription.
+    Subscriptions the push service reports as gone are deactivated, and the
+    sent/failed rollup counters incremented, in the same flush.
+    """
+
+    def __init__(self, notification_id: int, max_buffer: Optional[int] = None, bind=None):
+        self.notification_id = notification_id
+        self.max_buffer = max_buffer or settings.RESULT_BUFFER_SIZE
+        self.bind = bind or engine
+        self._statuses: List[Dict] = []
+        self._pushed: List[Tuple[int, datetime]] = []
+        self._gone: List[int] = []
+        self._gone_by_service: Counter = Counter()
+        self._dimensions: Optional[rollups.Dimensions] = None
+        # Partition key of the notification's delivery statuses
+        self._created_at: Optional[datetime] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, result: PushResult, pushed_at: Optional[datetime] = None):
+        pushed_at = pushed_at or datetime.utcnow()
+        self._statuses.append({
+            "notification_id": self.notification_id,
+            "subscription_id": result.subscription_id,
+            "status": "sent" if result.success else "failed",
+            "error": result.error,
+        })
+        if result.success:
+            self._pushed.append((result.subscription_id, pushed_at))
+        elif result.status_code in GONE_STATUS_CODES:
+            self._gone.append(result.subscription_id)
+            self._gone_by_service[urlsplit(result.endpoint).hostname] += 1
+
+        if len(self._statuses) >= self.max_buffer:
+            self.flush()
+
+    def add_failure(self, subscription_id: int, error: str):
+        self._statuses.append({
+            "notification_id": self.notification_id,
+            "subscription_id": subscription_id,
+            "status": "failed",
+            "error": error,
+        })
+        if len(self._statuses) >= self.max_buffer:
+            self.flush()
+
+    def flush(self, *statements):
+        """
+        Write the buffered outcomes in a single transaction, together with any
+        extra statements such as a send checkpoint
+        """
+        if not self._statuses and not statements:
+            return
+        statuses, self._statuses = self._statuses, []
+        pushed, self._pushed = self._pushed, []
+        gone, self._gone = self._gone, []
+        gone_by_service, self._gone_by_service = self._gone_by_service, Counter()
+
+        with self.bind.begin() as conn:
+            if statuses:
+                if self._created_at is None:
+                    self._created_at = conn.execute(
+                        select(Notification.created_at).where(Notification.id == self.notification_id)
+                    ).scalar_one()
+                for status in statuses:
+                    status["notification_created_at"] = self._created_at
+                stmt = insert(DeliveryStatus).values(statuses)
+                conn.execute(stmt.on_conflict_do_update(
+                    constraint='uq_delivery_statuses_notification_subscription',
+                    set_={"status": stmt.excluded.status, "error": stmt.excluded.error}
+                ))
+
+            if pushed:
+                pushed_values = values(
+                    column("id", Integer), column("pushed_at", DateTime), name="pushed"
+                ).data(pushed)
+                conn.execute(
+                    update(Subscription)
+                    .where(Subscription.id == pushed_values.c.id)
+                    .values(last_push_at=pushed_values.c.pushed_at)
+                )
+
+            if gone:
+                conn.execute(
+                    update(Subscription)
+                    .where(Subscription.id.in_(gone))
+                    .values(active=False, deactivated_at=datetime.utcnow())
+                )
+
+            for statement in statements:
+                conn.execute(statement)
+
+            if statuses:
+                # Last, so the shared rollup rows stay locked for the shortest time
+                if self._dimensions is None:
+                    self._dimensions = rollups.notification_dimensions(conn, (self.notification_id,))
+                rollups.record(
+                    conn,
+                    {(self.notification_id, rollups.hour_bucket(datetime.utcnow())):
+                        Counter(status["status"] for status in statuses)},
+                    self._dimensions
+                )
+
+        if gone_by_service:
+            logger.info(f"Deactivated {len(gone)} expired subscriptions for notification {self.notification_id}")
+            metrics.incr_many("subscriptions_pruned_total", gone_by_service, label="push_service")
+
+        logger.debug(f"Flushed {len(statuses)} delivery statuses for notification {self.notification_id}")
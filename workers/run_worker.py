@@ -0,0 +1,29 @@
+"""
+Start a Celery worker for one of the pools in settings.WORKER_POOLS:
+
+    python -m workers.run_worker transactional
+"""
+import sys
+
+from config.settings import settings
+from workers.celery_worker import celery_app
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in settings.WORKER_POOLS:
+        print(f"usage: python -m workers.run_worker {{{'|'.join(settings.WORKER_POOLS)}}} [celery options]")
+        return 2
+
+    pool = settings.WORKER_POOLS[argv[1]]
+    celery_app.worker_main([
+        "worker",
+        "--loglevel=info",
+        f"--hostname={argv[1]}@%h",
+        f"--queues={','.join(pool['queues'])}",
+        f"--concurrency={pool['concurrency']}",
+        f"--prefetch-multiplier={pool['prefetch_multiplier']}",
+        *argv[2:],
+    ])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,88 @@
+"""
+Dispatches time-based notifications when their send_at comes due:
+
+    python -m workers.scheduler
+
+Pending schedules are read from the partial send_at index with
+FOR UPDATE SKIP LOCKED, so several schedulers can run side by side and a
+restarted one resumes from the table without re-sending anything.
+"""
+from datetime import datetime
+import logging
+import signal
+import time
+
+from config.settings import settings
+from core import outbox
+from core.database import SessionLocal
+from core.models import Notification, NotificationSchedule, NotificationType
+from workers.celery_worker import queue_for_priority
+from workers.tasks import process_notification
+
+logger = logging.getLogger(__name__)
+
+def dispatch_due_schedules(db, limit: int) -> int:
+    """
+    Claim up to limit due schedules, queue their notifications through the
+    outbox and mark them dispatched, in one transaction. Returns the number dispatched.
+    """
+    now = datetime.utcnow()
+    due = (
+        db.query(NotificationSchedule.id, NotificationSchedule.notification_id, Notification.priority)
+        .join(Notification, Notification.id == NotificationSchedule.notification_id)
+        .filter(
+            NotificationSchedule.dispatched_at.is_(None),
+            NotificationSchedule.type == NotificationType.time_based,
+            NotificationSchedule.send_at <= now
+        )
+        .order_by(NotificationSchedule.send_at)
+        .limit(limit)
+        .with_for_update(of=NotificationSchedule, skip_locked=True)
+        .all()
+    )
+    if not due:
+        db.rollback()
+        return 0
+
+    db.query(NotificationSchedule).filter(
+        NotificationSchedule.id.in_([schedule_id for schedule_id, _, _ in due])
+    ).update({NotificationSchedule.dispatched_at: now}, synchronize_session=False)
+
+    for _, notification_id, priority in due:
+        outbox.enqueue(db, process_notification, (notification_id,), queue=queue_for_priority(priority))
+
+    db.commit()
+    logger.info(f"Dispatched {len(due)} scheduled notifications")
+    return len(due)
+
+def run():
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("Notification scheduler started")
+
+    while not stopping:
+        db = SessionLocal()
+        try:
+            dispatched = dispatch_due_schedules(db, settings.SCHEDULER_BATCH_SIZE)
+        except Exception as e:
+            logger.error(f"Failed to dispatch scheduled notifications: {str(e)}")
+            db.rollback()
+            dispatched = 0
+        finally:
+            db.close()
+
+        # A full batch means more are due; drain them before sleeping
+        if dispatched < settings.SCHEDULER_BATCH_SIZE:
+            time.sleep(settings.SCHEDULER_POLL_INTERVAL)
+
+    logger.info("Notification scheduler stopped")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()
@@ -1,14 +1,127 @@
-from celery import shared_task
-from workers.celery_worker import celery_app
-from core.database import SessionLocal
-from core.models import Notification, Subscription, WebhookEvent
-from sqlalchemy import exc
-from datetime import datetime, timedelta
+from celery import group, chord
+from workers.celery_worker import QUEUES, celery_app, queue_for_priority
+from config.settings import settings
+from core import metrics, partitions
+from core.ab_testing import sample_filter
+from core.database import SessionLocal, engine, iter_keyset, iter_subscriptions
+from core.segment_bitmaps import (
+    build_segment_bitmap, notification_bitmap, reconcile_memberships, update_memberships
+)
+from core.segments import SegmentRuleError, notification_filter
+from core.models import Campaign, CampaignStatus, DeliveryStatus, Notification, NotificationSendProgress, Subscription
+from workers.delivery import DeliveryOutcome, deliver_notification
+from workers.result_writer import DeliveryResultWriter
+from sqlalchemy import Integer, and_, any_, case, exc, exists, func, literal, update
+from sqlalchemy.dialects.postgresql import ARRAY
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 import logging
-import httpx
 
 logger = logging.getLogger(__name__)
 
+def plan_subscription_chunks(db, chunk_size: int, where=()) -> List[Tuple[int, Optional[int]]]:
+    """
+    Split the subscription id space into (start_after, end_at) ranges of at most
+    chunk_size rows each, walking the primary key index with keyset pagination.
+    The last range is left open-ended so rows created after planning are included.
+    With a segment filter in where, chunks hold chunk_size matching rows each.
+    """
+    chunks = []
+    last_id = 0
+
+    while True:
+        boundary = (
+            db.query(Subscription.id)
+            .filter(Subscription.active, Subscription.id > last_id, *where)
+            .order_by(Subscription.id)
+            .offset(chunk_size - 1)
+            .limit(1)
+            .scalar()
+        )
+        if boundary is None:
+            break
+        chunks.append((last_id, boundary))
+        last_id = boundary
+
+    remaining = db.query(Subscription.id).filter(Subscription.active, Subscription.id > last_id, *where).first()
+    if remaining is not None:
+        chunks.append((last_id, None))
+    elif chunks:
+        # An audience of an exact multiple of chunk_size ends on a boundary; reopen the last range
+        chunks[-1] = (chunks[-1][0], None)
+
+    return chunks
+
+def plan_bitmap_chunks(bitmap, chunk_size: int) -> List[Tuple[int, Optional[int]]]:
+    """
+    Same ranges as plan_subscription_chunks, read from an audience bitmap by rank
+    """
+    chunks = []
+    last_id = 0
+    for rank in range(chunk_size - 1, len(bitmap) - 1, chunk_size):
+        chunks.append((last_id, bitmap[rank]))
+        last_id = bitmap[rank]
+    if len(bitmap) and bitmap.max() > last_id:
+        chunks.append((last_id, None))
+    return chunks
+
+def bitmap_filter(bitmap, start_after: int, end_at: Optional[int] = None):
+    """
+    Restrict subscriptions to the bitmap's members with start_after < id <= end_at,
+    sliced by rank and bound as a single array parameter
+    """
+    upper = bitmap.rank(end_at) if end_at is not None else len(bitmap)
+    members = list(bitmap[bitmap.rank(start_after):upper])
+    return Subscription.id == any_(literal(members, ARRAY(Integer)))
+
+def _with_sample(db, notification, segment_filter):
+    sample = sample_filter(db, notification)
+    if sample is not None:
+        # A/B variants and rollouts only reach their own slice of the audience
+        segment_filter = sample if segment_filter is None else and_(segment_filter, sample)
+    return segment_filter
+
+def audience_filter(db, notification, start_after: int = 0, end_at: Optional[int] = None):
+    """
+    Restrict the subscriptions of one chunk to the notification's segments, from
+    the materialized bitmaps when every segment has one, otherwise from the
+    compiled SQL rules, and A/B test notifications to their sample slots
+    """
+    bitmap = notification_bitmap(db, notification)
+    if bitmap is not None:
+        segment_filter = bitmap_filter(bitmap, start_after, end_at)
+    else:
+        segment_filter = notification_filter(db, notification)
+    return _with_sample(db, notification, segment_filter)
+
+def plan_notification_chunks(db, notification) -> List[Tuple[int, Optional[int]]]:
+    """
+    Plan the chunks of a notification's audience and record a progress row for
+    each; the caller commits
+    """
+    if notification.segments:
+        # Subscriptions created since the last pass are not in the bitmaps yet
+        reconcile_memberships(db, new_only=True)
+    bitmap = notification_bitmap(db, notification)
+    if bitmap is not None:
+        # Chunk bounds come from the bitmap; members are filtered per chunk when sent
+        chunks = plan_bitmap_chunks(bitmap, settings.SEND_CHUNK_SIZE)
+    else:
+        segment_filter = _with_sample(db, notification, notification_filter(db, notification))
+        chunks = plan_subscription_chunks(
+            db, settings.SEND_CHUNK_SIZE, where=() if segment_filter is None else (segment_filter,)
+        )
+    db.add_all(
+        NotificationSendProgress(
+            notification_id=notification.id,
+            start_after=start_after,
+            end_at=end_at,
+            last_subscription_id=start_after
+        )
+        for start_after, end_at in chunks
+    )
+    return chunks
+
 @celery_app.task(
     name='tasks.process_notification',
     bind=True,
@@ -18,7 +131,7 @@ logger = logging.getLogger(__name__)
 )
 def process_notification(self, notification_id: int):
     """
-    Process and send notification to all active subscriptions
+    Fan a notification out to the worker pool, one child task per subscription chunk
     """
     logger.info(f"Processing notification {notification_id}")
     db = SessionLocal()
@@ -30,34 +143,44 @@ def process_notification(self, notification_id: int):
             logger.error(f"Notification {notification_id} not found")
             return {"status": "error", "message": "Notification not found"}
 
-        # Get all active subscriptions
-        subscriptions = db.query(Subscription).all()
-        
-        successful_pushes = 0
-        failed_pushes = 0
-
-        for subscription in subscriptions:
-            try:
-                # Here you would implement the actual web push sending logic
-                # using pywebpush or a similar library
-                
-                # Update last push timestamp
-                subscription.last_push_at = datetime.utcnow()
-                successful_pushes += 1
-                
-            except Exception as push_error:
-                logger.error(f"Failed to push to subscription {subscription.id}: {str(push_error)}")
-                failed_pushes += 1
+        # A redelivered or retried parent resumes the chunks it planned before
+        planned = (
+            db.query(NotificationSendProgress.start_after, NotificationSendProgress.end_at,
+                     NotificationSendProgress.completed_at)
+            .filter(NotificationSendProgress.notification_id == notification_id)
+            .order_by(NotificationSendProgress.start_after)
+            .all()
+        )
+        if planned:
+            chunks = [(start_after, end_at) for start_after, end_at, completed_at in planned if completed_at is None]
+            logger.info(f"Resuming notification {notification_id}: {len(chunks)} of {len(planned)} chunks left")
+        else:
+            chunks = plan_notification_chunks(db, notification)
+            db.commit()
+
+        if not chunks:
+            logger.info(f"Nothing left to send for notification {notification_id}")
+            return aggregate_notification_results([], notification_id)
+
+        queue = queue_for_priority(notification.priority)
+        header = group(
+            send_notification_chunk.s(notification_id, start_after, end_at).set(queue=queue)
+            for start_after, end_at in chunks
+        )
+        chord(header)(aggregate_notification_results.s(notification_id).set(queue=queue))
+        logger.info(f"Dispatched notification {notification_id} in {len(chunks)} chunks on queue {queue}")
 
-        db.commit()
-        
         return {
-            "status": "success",
+            "status": "dispatched",
             "notification_id": notification_id,
-            "successful_pushes": successful_pushes,
-            "failed_pushes": failed_pushes
+            "queue": queue,
+            "chunks": len(chunks)
         }
 
+    except SegmentRuleError as rule_error:
+        logger.error(f"Invalid segment rules for notification {notification_id}: {str(rule_error)}")
+        return {"status": "error", "message": str(rule_error)}
+
     except exc.SQLAlchemyError as db_error:
         logger.error(f"Database error while processing notification {notification_id}: {str(db_error)}")
         db.rollback()
@@ -70,69 +193,414 @@ def process_notification(self, notification_id: int):
     finally:
         db.close()
 
-@celery_app.task(name='tasks.cleanup_old_notifications')
-def cleanup_old_notifications(days: int = 30):
+def campaign_paused(db, notification) -> bool:
+    """Whether the notification belongs to a campaign that is currently paused"""
+    if notification.campaign_id is None:
+        return False
+    status = db.query(Campaign.status).filter(Campaign.id == notification.campaign_id).scalar()
+    return status == CampaignStatus.paused.value
+
+def run_by_campaign_runner(notification) -> bool:
     """
-    Clean up notifications older than specified days
+    Whether the campaign runner releases and finishes the notification's chunks;
+    A/B test variants and rollouts are fanned out by process_notification instead
     """
+    return notification.campaign_id is not None and not notification.ab_test_group
+
+def release_chunk_statement(notification_id: int, start_after: int):
+    """Hand a chunk back to the campaign runner so it is dispatched again on resume"""
+    return (
+        update(NotificationSendProgress)
+        .where(
+            NotificationSendProgress.notification_id == notification_id,
+            NotificationSendProgress.start_after == start_after
+        )
+        .values(dispatched_at=None)
+    )
+
+def release_chunk(db, notification_id: int, start_after: int):
+    db.execute(release_chunk_statement(notification_id, start_after))
+    db.commit()
+
+def fail_chunk(notification_id: int, start_after: int):
+    """Give up on a chunk, so it stops holding a campaign's in-flight slot"""
     db = SessionLocal()
     try:
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        db.query(Notification).filter(Notification.created_at < cutoff_date).delete()
+        db.execute(
+            update(NotificationSendProgress)
+            .where(
+                NotificationSendProgress.notification_id == notification_id,
+                NotificationSendProgress.start_after == start_after,
+                NotificationSendProgress.completed_at.is_(None)
+            )
+            .values(dispatched_at=None, failed_at=datetime.utcnow())
+        )
         db.commit()
-        return {"status": "success", "message": f"Cleaned up notifications older than {days} days"}
-    except Exception as e:
-        logger.error(f"Failed to cleanup old notifications: {str(e)}")
-        db.rollback()
-        raise
+    except exc.SQLAlchemyError as db_error:
+        # The campaign runner fails it once it has stalled long enough
+        logger.error(f"Could not mark the chunk after {start_after} of notification {notification_id} failed: {str(db_error)}")
     finally:
         db.close()
 
-@shared_task(bind=True, max_retries=3)
-def process_webhook_event(self, event_id: int):
-    """Process webhook event and send to external systems"""
+@celery_app.task(
+    name='tasks.send_notification_chunk',
+    bind=True,
+    max_retries=3,
+    default_retry_delay=60,
+    acks_late=True
+)
+def send_notification_chunk(
+    self,
+    notification_id: int,
+    start_after: int,
+    end_at: Optional[int] = None,
+    subscription_ids: Optional[List[int]] = None,
+    deferrals: int = 0
+):
+    """
+    Send a notification to the subscriptions with start_after < id <= end_at,
+    or only to subscription_ids when re-sending pushes deferred by rate limits.
+    A re-send of pushes already deferred PUSH_MAX_DEFERRALS times records the
+    ones deferred again as failed, so a throttling push service cannot keep
+    the chunk open forever.
+
+    Progress is checkpointed every SEND_CHECKPOINT_SIZE subscriptions, in the
+    same transaction as the delivery statuses, so a retried or redelivered
+    chunk resumes after its high-water mark. Subscriptions that already have
+    a delivery status for this notification are never pushed again.
+
+    Deferred pushes are counted on the chunk's progress, which stays open
+    until the re-sends have settled all of them.
+    """
     db = SessionLocal()
+
     try:
-        event = db.query(WebhookEvent).filter(WebhookEvent.id == event_id).first()
-        if not event:
-            logger.error(f"Webhook event {event_id} not found")
-            return False
-
-        # Send webhook to external system using synchronous client
-        with httpx.Client() as client:
-            webhook_data = {
-                "notification_id": event.notification_id,
-                "subscription_id": event.subscription_id,
-                "timestamp": event.created_at.isoformat(),
-                **event.payload
-            }
+        notification = db.query(Notification).filter(Notification.id == notification_id).first()
+        if not notification:
+            logger.error(f"Notification {notification_id} not found")
+            return {"successful_pushes": 0, "failed_pushes": 0}
+
+        checkpointed = subscription_ids is None
+        resume_after = start_after
+
+        if campaign_paused(db, notification):
+            if checkpointed and run_by_campaign_runner(notification):
+                release_chunk(db, notification_id, start_after)
+            else:
+                hold_chunk(notification, start_after, end_at, subscription_ids, deferrals)
+            logger.info(f"Campaign {notification.campaign_id} is paused; holding chunk ({start_after}, {end_at}]")
+            return {"successful_pushes": 0, "failed_pushes": 0, "paused": True}
+
+        if checkpointed:
+            # Held until this session's transaction ends; statuses and checkpoints are
+            # committed by the result writer on its own connection, so that is not
+            # before the chunk is done and a duplicate delivery of it backs off
+            locked = db.query(func.pg_try_advisory_xact_lock(notification_id, start_after)).scalar()
+            if not locked:
+                logger.info(f"Chunk ({start_after}, {end_at}] of notification {notification_id} is already being sent")
+                return {"successful_pushes": 0, "failed_pushes": 0}
 
-            if event.event_type == "delivery":
-                webhook_data["event"] = "delivery"
-                response = client.post(
-                    event.payload.get("webhook_url"),
-                    json=webhook_data
+            progress = db.query(NotificationSendProgress).filter(
+                NotificationSendProgress.notification_id == notification_id,
+                NotificationSendProgress.start_after == start_after
+            ).first()
+            if progress is not None:
+                if progress.completed_at is not None:
+                    return {
+                        "successful_pushes": progress.successful_pushes,
+                        "failed_pushes": progress.failed_pushes
+                    }
+                resume_after = progress.last_subscription_id
+
+        already_sent = exists().where(
+            # The partition key prunes the probe to the notification's partition
+            DeliveryStatus.notification_created_at == notification.created_at,
+            DeliveryStatus.notification_id == notification_id,
+            DeliveryStatus.subscription_id == Subscription.id
+        )
+        where = [~already_sent]
+        segment_filter = audience_filter(db, notification, resume_after, end_at)
+        if segment_filter is not None:
+            where.append(segment_filter)
+        if subscription_ids:
+            where.append(Subscription.id.in_(subscription_ids))
+
+        def checkpoint(
+            batch_outcome: DeliveryOutcome,
+            last_subscription_id: int,
+            deferred: int = 0,
+            completed: bool = False
+        ):
+            outstanding = NotificationSendProgress.deferred_pushes + deferred
+            if completed and not checkpointed:
+                # A re-send settles the pushes it was given; deferred counts those still rate limited
+                outstanding -= len(subscription_ids)
+            values = {
+                "successful_pushes": NotificationSendProgress.successful_pushes + batch_outcome.successful_pushes,
+                "failed_pushes": NotificationSendProgress.failed_pushes + batch_outcome.failed_pushes,
+                "deferred_pushes": outstanding,
+            }
+            if checkpointed:
+                values["last_subscription_id"] = last_subscription_id
+            if completed:
+                values["completed_at"] = case(
+                    (outstanding <= 0, func.coalesce(NotificationSendProgress.completed_at, datetime.utcnow())),
+                    else_=None
                 )
-            elif event.event_type == "click":
-                webhook_data["event"] = "click"
-                response = client.post(
-                    event.payload.get("webhook_url"),
-                    json=webhook_data
+            return (
+                update(NotificationSendProgress)
+                .where(
+                    NotificationSendProgress.notification_id == notification_id,
+                    NotificationSendProgress.start_after == start_after
                 )
-            
-            response.raise_for_status()
+                .values(**values),
+            )
 
-        event.processed = True
-        db.commit()
-        return True
+        outcome = DeliveryOutcome()
+        last_subscription_id = resume_after
+        paused = False
+        with DeliveryResultWriter(notification_id) as writer:
+            batch = {}
+            for subscription in iter_subscriptions(db, start_after=resume_after, end_at=end_at, where=where):
+                batch[subscription.id] = subscription
+                if len(batch) >= settings.SEND_CHECKPOINT_SIZE:
+                    batch_outcome = deliver_notification(notification, batch, writer)
+                    last_subscription_id = subscription.id
+                    writer.flush(*checkpoint(batch_outcome, last_subscription_id))
+                    outcome.merge(batch_outcome)
+                    batch = {}
+                    # A campaign paused mid-chunk stops at this checkpoint and resumes from it
+                    if checkpointed and campaign_paused(db, notification):
+                        paused = True
+                        break
+
+            if paused:
+                if outcome.deferred_ids:
+                    # The resumed chunk sends deferred pushes itself; a re-send could finish it early
+                    last_subscription_id = min(outcome.deferred_ids) - 1
+                    outcome.deferred_ids = []
+                statements = checkpoint(DeliveryOutcome(), last_subscription_id)
+                if run_by_campaign_runner(notification):
+                    statements += (release_chunk_statement(notification_id, start_after),)
+                writer.flush(*statements)
+            else:
+                batch_outcome = deliver_notification(notification, batch, writer) if batch else DeliveryOutcome()
+                if batch:
+                    last_subscription_id = max(batch)
+                outcome.merge(batch_outcome)
+                if deferrals >= settings.PUSH_MAX_DEFERRALS:
+                    given_up = outcome.fail_deferred(writer, f"Rate limited after {deferrals} reschedules")
+                    batch_outcome.failed_pushes += given_up
+                writer.flush(
+                    *checkpoint(batch_outcome, last_subscription_id, deferred=len(outcome.deferred_ids), completed=True)
+                )
+
+        if paused and not run_by_campaign_runner(notification):
+            hold_chunk(notification, start_after, end_at)
 
-    except httpx.HTTPError as http_error:
-        logger.error(f"HTTP error while processing webhook event {event_id}: {str(http_error)}")
+        if outcome.deferred_ids:
+            logger.info(
+                f"Rescheduling {len(outcome.deferred_ids)} rate-limited pushes of notification "
+                f"{notification_id} in {outcome.retry_delay:.1f}s"
+            )
+            send_notification_chunk.apply_async(
+                args=(notification_id, start_after, end_at),
+                kwargs={"subscription_ids": outcome.deferred_ids, "deferrals": deferrals + 1},
+                countdown=outcome.retry_delay,
+                queue=queue_for_priority(notification.priority)
+            )
+        elif (not paused and not self.request.chord and not run_by_campaign_runner(notification)
+              and not open_chunks(db, notification_id)):
+            # The last re-send or held chunk finishes a notification its chord reported
+            # as still sending
+            aggregate_notification_results.delay([], notification_id)
+
+        encryption_stats = outcome.encryption_stats
+        logger.info(
+            f"Encrypted {encryption_stats.pushes} pushes for notification {notification_id} at "
+            f"{encryption_stats.pushes_per_second_per_core:.0f} pushes/sec per core"
+        )
+
+        return {
+            "successful_pushes": outcome.successful_pushes,
+            "failed_pushes": outcome.failed_pushes,
+            "paused": paused,
+            "deferred_pushes": len(outcome.deferred_ids),
+            "encrypted_pushes": encryption_stats.pushes,
+            "encryption_cpu_seconds": encryption_stats.cpu_seconds
+        }
+
+    except exc.SQLAlchemyError as db_error:
+        logger.error(f"Database error in chunk ({start_after}, {end_at}] of notification {notification_id}: {str(db_error)}")
         db.rollback()
-        raise self.retry(exc=http_error, countdown=5 * (self.request.retries + 1))
+        if self.request.retries >= self.max_retries:
+            fail_chunk(notification_id, start_after)
+        raise self.retry(exc=db_error)
+
     except Exception as e:
-        logger.error(f"Error processing webhook event {event_id}: {str(e)}")
+        logger.error(f"Unexpected error in chunk ({start_after}, {end_at}] of notification {notification_id}: {str(e)}")
         db.rollback()
-        raise self.retry(exc=e, countdown=5 * (self.request.retries + 1))
+        fail_chunk(notification_id, start_after)
+        raise
+
+    finally:
+        db.close()
+
+def hold_chunk(notification, start_after: int, end_at: Optional[int],
+               subscription_ids: Optional[List[int]] = None, deferrals: int = 0):
+    """Try a chunk of a paused campaign again after a campaign tick"""
+    send_notification_chunk.apply_async(
+        args=(notification.id, start_after, end_at),
+        kwargs={"subscription_ids": subscription_ids, "deferrals": deferrals},
+        countdown=settings.CAMPAIGN_TICK_INTERVAL,
+        queue=queue_for_priority(notification.priority)
+    )
+
+def open_chunks(db, notification_id: int) -> int:
+    """Chunks of a notification neither completed nor given up on"""
+    return db.query(func.count(NotificationSendProgress.id)).filter(
+        NotificationSendProgress.notification_id == notification_id,
+        NotificationSendProgress.completed_at.is_(None),
+        NotificationSendProgress.failed_at.is_(None)
+    ).scalar()
+
+@celery_app.task(name='tasks.aggregate_notification_results')
+def aggregate_notification_results(chunk_results: List[Dict[str, int]], notification_id: int):
+    """
+    Combine the push counts of a notification into one result. Counts come
+    from the chunk checkpoints, so chunks finished before a resume are included.
+    Chunks still waiting on deferred re-sends leave the notification sending.
+    """
+    db = SessionLocal()
+    try:
+        chunks, successful_pushes, failed_pushes, deferred_pushes = db.query(
+            func.count(NotificationSendProgress.id),
+            func.coalesce(func.sum(NotificationSendProgress.successful_pushes), 0),
+            func.coalesce(func.sum(NotificationSendProgress.failed_pushes), 0),
+            func.coalesce(func.sum(NotificationSendProgress.deferred_pushes), 0)
+        ).filter(NotificationSendProgress.notification_id == notification_id).one()
+        pending_chunks = open_chunks(db, notification_id)
     finally:
         db.close()
+
+    encrypted_pushes = sum(result.get("encrypted_pushes", 0) for result in chunk_results)
+    encryption_cpu_seconds = sum(result.get("encryption_cpu_seconds", 0.0) for result in chunk_results)
+    pushes_per_core = encrypted_pushes / encryption_cpu_seconds if encryption_cpu_seconds > 0 else 0.0
+    status = "sending" if pending_chunks else "success"
+    logger.info(
+        f"Notification {notification_id} {'is still sending' if pending_chunks else 'finished'}: "
+        f"{successful_pushes} successful, {failed_pushes} failed, "
+        f"{deferred_pushes} rescheduled pushes outstanding, "
+        f"{pushes_per_core:.0f} encrypted pushes/sec per core"
+    )
+
+    return {
+        "status": status,
+        "notification_id": notification_id,
+        "chunks": chunks,
+        "pending_chunks": pending_chunks,
+        "successful_pushes": successful_pushes,
+        "failed_pushes": failed_pushes,
+        "deferred_pushes": deferred_pushes,
+        "encryption_pushes_per_sec_per_core": round(pushes_per_core, 1)
+    }
+
+def _delete_notifications(db, notification_ids: List[int]):
+    db.query(Notification).filter(Notification.id.in_(notification_ids)).delete(synchronize_session=False)
+    db.commit()
+
+@celery_app.task(name='tasks.cleanup_old_notifications')
+def cleanup_old_notifications(days: int = 30):
+    """
+    Clean up notifications older than specified days. Their delivery statuses
+    and webhook events go first, by dropping whole partitions; the cutoff is
+    rounded down to a partition boundary so no rows are left referencing them.
+    Notifications still scheduled or sending are kept, with their partitions.
+    """
+    db = SessionLocal()
+    # Deletes commit on their own session so the streaming cursor stays open
+    writer = SessionLocal()
+    try:
+        cutoff_date = partitions.retention_cutoff(days)
+        with engine.begin() as conn:
+            dropped = partitions.drop_partitions(conn, cutoff_date)
+        if dropped:
+            logger.info(f"Dropped partitions {', '.join(dropped)}")
+
+        batch = []
+        expired = (Notification.created_at < cutoff_date, ~partitions.live_notifications())
+        for (notification_id,) in iter_keyset(db, Notification.id, where=expired):
+            batch.append(notification_id)
+            if len(batch) >= settings.STREAM_YIELD_PER:
+                _delete_notifications(writer, batch)
+                batch = []
+        if batch:
+            _delete_notifications(writer, batch)
+        return {"status": "success", "message": f"Cleaned up notifications older than {days} days"}
+    except Exception as e:
+        logger.error(f"Failed to cleanup old notifications: {str(e)}")
+        writer.rollback()
+        raise
+    finally:
+        writer.close()
+        db.close()
+
+@celery_app.task(name='tasks.maintain_partitions')
+def maintain_partitions():
+    """
+    Create the partitions for the coming days and drop those past retention
+    """
+    with engine.begin() as conn:
+        changes = partitions.maintain(conn)
+    if changes["created"] or changes["dropped"]:
+        logger.info(f"Partitions created: {changes['created']}, dropped: {changes['dropped']}")
+    return changes
+
+@celery_app.task(name='tasks.build_segment_bitmap')
+def build_segment_bitmap_task(segment_name: str, rules: Dict):
+    """
+    Materialize a newly created segment's membership bitmap
+    """
+    db = SessionLocal()
+    try:
+        return {"segment": segment_name, "size": build_segment_bitmap(db, segment_name, rules)}
+    finally:
+        db.close()
+
+@celery_app.task(name='tasks.update_segment_memberships')
+def update_segment_memberships(user_ids: List[str]):
+    """
+    Patch segment bitmaps after the profiles of user_ids changed
+    """
+    db = SessionLocal()
+    try:
+        return update_memberships(db, user_ids)
+    finally:
+        db.close()
+
+@celery_app.task(name='tasks.reconcile_segment_memberships')
+def reconcile_segment_memberships():
+    """
+    Patch segment bitmaps for subscriptions created or linked to another user
+    since they were built
+    """
+    db = SessionLocal()
+    try:
+        return {"evaluated": reconcile_memberships(db)}
+    finally:
+        db.close()
+
+@celery_app.task(name='tasks.record_queue_metrics')
+def record_queue_metrics():
+    """
+    Sample the number of waiting messages in each queue
+    """
+    depths = {}
+    with celery_app.connection_for_write() as connection:
+        channel = connection.default_channel
+        for queue in QUEUES:
+            _, message_count, consumer_count = channel.queue_declare(queue=queue, passive=True)
+            depths[queue] = message_count
+            metrics.set_gauge("queue_depth", message_count, queue=queue)
+            metrics.set_gauge("queue_consumers", consumer_count, queue=queue)
+    return depths
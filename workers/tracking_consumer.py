@@ -0,0 +1,192 @@
+"""
+Writes tracking events from the Redis stream to the database:
+
+    python -m workers.tracking_consumer
+
+Consumers share the stream through a consumer group, so several can run side
+by side. Events are collected until TRACKING_BATCH_SIZE or
+TRACKING_FLUSH_INTERVAL, applied in one transaction and only then
+acknowledged; entries left unacknowledged by a crashed consumer are claimed
+at startup and every CLAIM_IDLE_MS afterwards, and replayed. Replays are
+harmless because every event counts once.
+
+A backlog batch that fails is retried entry by entry. An entry that still
+fails after TRACKING_MAX_DELIVERIES deliveries, other than for a lost
+connection, is moved to the dead-letter stream and acknowledged, so one
+bad entry cannot hold up the ones behind it.
+"""
+from typing import Callable, Dict, List, Tuple
+import logging
+import os
+import signal
+import socket
+import time
+
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError, TimeoutError as RedisTimeoutError
+from sqlalchemy import exc
+
+from config.settings import settings
+from core import metrics
+from core.database import engine
+from core.redis_client import get_redis
+from core.tracking import (
+    TRACKING_DEAD_LETTER_STREAM, TRACKING_GROUP, TRACKING_STREAM, apply_events, decode_entry, trim_consumed
+)
+
+logger = logging.getLogger(__name__)
+
+# Entries another consumer has held this long without acknowledging are taken over
+CLAIM_IDLE_MS = 60000
+
+# Failures that say nothing about the entry itself; they never dead-letter it
+TRANSIENT_ERRORS = (exc.OperationalError, exc.InterfaceError, RedisConnectionError, RedisTimeoutError)
+
+def ensure_group(client):
+    try:
+        client.xgroup_create(TRACKING_STREAM, TRACKING_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+def claim_abandoned(client, consumer: str) -> int:
+    """Take over entries left pending by consumers that stopped"""
+    claimed = 0
+    start_id = "0-0"
+    while True:
+        start_id, entries, *_ = client.xautoclaim(
+            TRACKING_STREAM, TRACKING_GROUP, consumer, CLAIM_IDLE_MS, start_id=start_id, count=1000
+        )
+        claimed += len(entries)
+        if start_id in ("0-0", b"0-0"):
+            return claimed
+
+def read_backlog(client, consumer: str) -> list:
+    """This consumer's delivered but unacknowledged (entry_id, fields), oldest first"""
+    response = client.xreadgroup(TRACKING_GROUP, consumer, {TRACKING_STREAM: "0"}, count=100)
+    return response[0][1] if response else []
+
+def read_batch(client, consumer: str) -> Tuple[List[str], list]:
+    """Read new entries until the batch is full or the flush interval has passed"""
+    entry_ids: List[str] = []
+    events: list = []
+    deadline = time.monotonic() + settings.TRACKING_FLUSH_INTERVAL
+
+    while len(events) < settings.TRACKING_BATCH_SIZE:
+        remaining_ms = int((deadline - time.monotonic()) * 1000)
+        if remaining_ms <= 0:
+            break
+        response = client.xreadgroup(
+            TRACKING_GROUP, consumer, {TRACKING_STREAM: ">"}, count=100, block=remaining_ms
+        )
+        entries = response[0][1] if response else []
+        if not entries:
+            break
+        for entry_id, fields in entries:
+            entry_ids.append(entry_id)
+            events.extend(decode_entry(fields))
+    return entry_ids, events
+
+def flush(client, entry_ids: List[str], events: list):
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        counted = apply_events(conn, events)
+    client.xack(TRACKING_STREAM, TRACKING_GROUP, *entry_ids)
+
+    metrics.incr_many("tracking_events_total", counted, label="type")
+    metrics.observe("tracking_flush_seconds", time.perf_counter() - started)
+    logger.debug(f"Applied {len(events)} tracking events, {sum(counted.values())} counted")
+
+def delivery_counts(client, consumer: str, entries: list) -> Dict[str, int]:
+    pending = client.xpending_range(
+        TRACKING_STREAM, TRACKING_GROUP, min=entries[0][0], max=entries[-1][0],
+        count=len(entries), consumername=consumer
+    )
+    return {entry["message_id"]: entry["times_delivered"] for entry in pending}
+
+def dead_letter(client, entry_id: str, fields: Dict[str, str], error: Exception):
+    """Park an entry that keeps failing and acknowledge it"""
+    pipe = client.pipeline()
+    pipe.xadd(
+        TRACKING_DEAD_LETTER_STREAM, {**fields, "entry_id": entry_id, "error": str(error)[:1000]},
+        maxlen=settings.TRACKING_DEAD_LETTER_MAXLEN, approximate=True
+    )
+    pipe.xack(TRACKING_STREAM, TRACKING_GROUP, entry_id)
+    pipe.execute()
+    metrics.incr("tracking_dead_letters_total")
+    logger.error(f"Moved tracking entry {entry_id} to {TRACKING_DEAD_LETTER_STREAM}: {str(error)}")
+
+def drain_backlog(client, consumer: str) -> bool:
+    """Apply this consumer's pending entries; returns whether there were any"""
+    entries = read_backlog(client, consumer)
+    if not entries:
+        return False
+    try:
+        flush(client, [entry_id for entry_id, _ in entries],
+              [event for _, fields in entries for event in decode_entry(fields)])
+        return True
+    except TRANSIENT_ERRORS:
+        raise
+    except Exception as e:
+        logger.warning(f"Backlog of {len(entries)} tracking entries failed, retrying them one by one: {str(e)}")
+
+    deliveries = delivery_counts(client, consumer, entries)
+    for entry_id, fields in entries:
+        try:
+            flush(client, [entry_id], decode_entry(fields))
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            if deliveries.get(entry_id, 0) < settings.TRACKING_MAX_DELIVERIES:
+                raise
+            dead_letter(client, entry_id, fields, e)
+    return True
+
+def consume(client, consumer: str, stopping: Callable[[], bool]):
+    """Apply entries until stopping() returns True, taking over abandoned ones as they turn idle"""
+    backlog = True
+    next_claim = time.monotonic() + CLAIM_IDLE_MS / 1000
+    while not stopping():
+        try:
+            # Consumers that stop while others keep running leave entries only a claim recovers
+            if time.monotonic() >= next_claim:
+                next_claim = time.monotonic() + CLAIM_IDLE_MS / 1000
+                claimed = claim_abandoned(client, consumer)
+                if claimed:
+                    logger.info(f"Claimed {claimed} abandoned tracking entries")
+                    backlog = True
+            if backlog:
+                backlog = drain_backlog(client, consumer)
+            else:
+                entry_ids, events = read_batch(client, consumer)
+                if entry_ids:
+                    flush(client, entry_ids, events)
+            # Only entries before the oldest unacknowledged one are trimmed
+            trim_consumed(client)
+        except Exception as e:
+            # Unacknowledged entries stay pending and are retried from the backlog
+            logger.error(f"Failed to apply tracking events: {str(e)}")
+            backlog = True
+            time.sleep(settings.TRACKING_FLUSH_INTERVAL)
+
+def run():
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    client = get_redis()
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    ensure_group(client)
+    claimed = claim_abandoned(client, consumer)
+    logger.info(f"Tracking consumer {consumer} started, {claimed} abandoned entries claimed")
+
+    consume(client, consumer, lambda: stopping)
+    logger.info("Tracking consumer stopped")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()
@@ -0,0 +1,351 @@
+"""
+Delivers webhook events to their registered webhook, or to the webhook_url
+in their payload:
+
+    python -m workers.webhook_dispatcher
+
+Due events are claimed from the partial next_attempt_at index with FOR
+UPDATE SKIP LOCKED and leased for WEBHOOK_CLAIM_LEASE, so several dispatchers
+can run side by side and the events of a stopped one are picked up again.
+Events for the same endpoint that come due within WEBHOOK_COALESCE_WINDOW
+are sent together as {"events": [...]} POSTs, signed once per body for
+registered webhooks, over one keep-alive connection pool per origin. Every
+endpoint has its own concurrency cap and circuit breaker, so a slow or
+failing customer endpoint only holds back its own events.
+"""
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import signal
+import time
+
+import httpx
+from sqlalchemy import BigInteger, Boolean, DateTime, Integer, String, column, update, values
+
+from config.settings import settings
+from core import metrics
+from core.database import SessionLocal, engine
+from core.models import WebhookEvent
+from core.push_delivery import parse_retry_after, push_service_origin
+from core.webhooks import get_registry, signature_headers
+
+logger = logging.getLogger(__name__)
+
+# Responses whose Retry-After is honoured
+THROTTLE_STATUS_CODES = (429, 503)
+
+@dataclass
+class PendingEvent:
+    id: int
+    created_at: datetime
+    attempts: int
+    url: str
+    body: Dict[str, Any] = field(default_factory=dict)
+    secret: Optional[str] = None
+
+# (id, created_at, processed, attempts, next_attempt_at, last_error)
+Outcome = Tuple[int, datetime, bool, int, Optional[datetime], Optional[str]]
+
+def event_body(row) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "notification_id": row.notification_id,
+        "subscription_id": row.subscription_id,
+        "timestamp": row.created_at.isoformat(),
+        **row.payload,
+        "event": row.event_type,
+    }
+
+def claim_events(db, limit: int, now: Optional[datetime] = None) -> List[PendingEvent]:
+    """
+    Claim up to limit due events and lease them to this dispatcher. Events
+    whose webhook was removed, or without one or a webhook_url, have nowhere
+    to go and are marked processed.
+    """
+    now = now or datetime.utcnow()
+    rows = (
+        db.query(
+            WebhookEvent.id, WebhookEvent.created_at, WebhookEvent.event_type, WebhookEvent.notification_id,
+            WebhookEvent.subscription_id, WebhookEvent.payload, WebhookEvent.attempts, WebhookEvent.webhook_id
+        )
+        .filter(WebhookEvent.processed.isnot(True), WebhookEvent.next_attempt_at <= now)
+        .order_by(WebhookEvent.next_attempt_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if not rows:
+        db.rollback()
+        return []
+
+    registry = get_registry()
+    events = []
+    undeliverable = []
+    for row in rows:
+        if not isinstance(row.payload, dict):
+            undeliverable.append(row.id)
+            continue
+        if row.webhook_id is not None:
+            endpoint = registry.get(row.webhook_id)
+            url, secret = (endpoint.url, endpoint.secret) if endpoint else (None, None)
+        else:
+            url, secret = row.payload.get("webhook_url"), None
+        if url:
+            events.append(PendingEvent(row.id, row.created_at, row.attempts, url, event_body(row), secret))
+        else:
+            undeliverable.append(row.id)
+
+    # The oldest claimed day bounds both updates to the partitions involved
+    since = min(row.created_at for row in rows)
+    if undeliverable:
+        db.query(WebhookEvent).filter(
+            WebhookEvent.created_at >= since, WebhookEvent.id.in_(undeliverable)
+        ).update({WebhookEvent.processed: True}, synchronize_session=False)
+    if events:
+        db.query(WebhookEvent).filter(
+            WebhookEvent.created_at >= since, WebhookEvent.id.in_([event.id for event in events])
+        ).update(
+            {WebhookEvent.next_attempt_at: now + timedelta(seconds=settings.WEBHOOK_CLAIM_LEASE)},
+            synchronize_session=False
+        )
+    db.commit()
+    return events
+
+def claim(limit: int) -> List[PendingEvent]:
+    db = SessionLocal()
+    try:
+        return claim_events(db, limit)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff after the given number of failed attempts"""
+    return min(settings.WEBHOOK_RETRY_BASE_DELAY * 2 ** (attempts - 1), settings.WEBHOOK_RETRY_MAX_DELAY)
+
+def record_outcomes(outcomes: List[Outcome]):
+    """Write the outcome of a batch with one UPDATE webhook_events ... FROM (VALUES ...)"""
+    if not outcomes:
+        return
+    outcome_values = values(
+        column("id", BigInteger), column("created_at", DateTime), column("processed", Boolean),
+        column("attempts", Integer), column("next_attempt_at", DateTime), column("last_error", String),
+        name="outcomes"
+    ).data(outcomes)
+    with engine.begin() as conn:
+        conn.execute(
+            update(WebhookEvent)
+            .where(
+                WebhookEvent.created_at >= min(outcome[1] for outcome in outcomes),
+                WebhookEvent.created_at == outcome_values.c.created_at,
+                WebhookEvent.id == outcome_values.c.id
+            )
+            .values(
+                processed=outcome_values.c.processed,
+                attempts=outcome_values.c.attempts,
+                next_attempt_at=outcome_values.c.next_attempt_at,
+                last_error=outcome_values.c.last_error
+            )
+        )
+
+class CircuitBreaker:
+    """
+    Opens after threshold consecutive failures. Once the cooldown has passed a
+    single probe batch is let through; its success closes the circuit again.
+    """
+
+    def __init__(self, threshold: Optional[int] = None, cooldown: Optional[float] = None):
+        self.threshold = threshold or settings.WEBHOOK_BREAKER_THRESHOLD
+        self.cooldown = cooldown or settings.WEBHOOK_BREAKER_COOLDOWN
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allow(self, now: float) -> bool:
+        if self.failures < self.threshold:
+            return True
+        if now < self.open_until:
+            return False
+        # Half-open: hold everything else back while this probe is out
+        self.open_until = now + self.cooldown
+        return True
+
+    def succeeded(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+    def failed(self, now: float):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = now + self.cooldown
+
+class WebhookDispatcher:
+    """
+    Posts batches of events over one keep-alive connection pool per origin,
+    with a global and a per-endpoint concurrency cap and a circuit breaker per
+    endpoint URL.
+    """
+
+    def __init__(self, max_concurrency: Optional[int] = None, concurrency_per_endpoint: Optional[int] = None,
+                 timeout: Optional[float] = None):
+        self.max_concurrency = max_concurrency or settings.WEBHOOK_MAX_CONCURRENCY
+        self.concurrency_per_endpoint = concurrency_per_endpoint or settings.WEBHOOK_CONCURRENCY_PER_ENDPOINT
+        self.timeout = timeout or settings.WEBHOOK_REQUEST_TIMEOUT
+        self.in_flight = 0
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._endpoint_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._tasks = set()
+
+    def _client_for(self, origin: str) -> httpx.AsyncClient:
+        client = self._clients.get(origin)
+        if client is None:
+            client = httpx.AsyncClient(
+                http2=True,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.concurrency_per_endpoint,
+                    max_keepalive_connections=self.concurrency_per_endpoint,
+                ),
+            )
+            self._clients[origin] = client
+        return client
+
+    def dispatch(self, events: List[PendingEvent]):
+        """Start delivering claimed events, one POST per endpoint and batch"""
+        by_endpoint: Dict[Tuple[str, Optional[str]], List[PendingEvent]] = defaultdict(list)
+        for event in events:
+            by_endpoint[(event.url, event.secret)].append(event)
+
+        size = settings.WEBHOOK_MAX_EVENTS_PER_REQUEST
+        for (url, _), endpoint_events in by_endpoint.items():
+            for start in range(0, len(endpoint_events), size):
+                batch = endpoint_events[start:start + size]
+                self.in_flight += len(batch)
+                task = asyncio.create_task(self._deliver(url, batch))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _post(self, url: str, batch: List[PendingEvent]) -> Tuple[Optional[str], Optional[float]]:
+        """POST a batch; returns (error, retry_after), both None on success"""
+        client = self._client_for(push_service_origin(url))
+        body = json.dumps({"events": [event.body for event in batch]}, separators=(",", ":")).encode()
+        headers = {"Content-Type": "application/json"}
+        if batch[0].secret:
+            headers.update(signature_headers(batch[0].secret, body))
+        try:
+            response = await client.post(url, content=body, headers=headers)
+        except httpx.HTTPError as e:
+            return f"{type(e).__name__}: {e}", None
+        if response.is_success:
+            return None, None
+        retry_after = None
+        if response.status_code in THROTTLE_STATUS_CODES:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        return f"HTTP {response.status_code}", retry_after
+
+    async def _deliver(self, url: str, batch: List[PendingEvent]):
+        breaker = self._breakers.setdefault(url, CircuitBreaker())
+        endpoint_semaphore = self._endpoint_semaphores.setdefault(
+            url, asyncio.Semaphore(self.concurrency_per_endpoint)
+        )
+        try:
+            async with endpoint_semaphore, self._semaphore:
+                started = time.monotonic()
+                held = not breaker.allow(started)
+                if not held:
+                    error, retry_after = await self._post(url, batch)
+                    metrics.observe("webhook_request_seconds", time.monotonic() - started)
+                    if error is None:
+                        breaker.succeeded()
+                    else:
+                        breaker.failed(time.monotonic())
+
+            now = datetime.utcnow()
+            outcomes: List[Outcome] = []
+            if held:
+                # Held back until the circuit half-opens, without spending an attempt
+                until = now + timedelta(seconds=max(breaker.open_until - time.monotonic(), 0.0))
+                outcomes = [
+                    (event.id, event.created_at, False, event.attempts, until, "circuit open") for event in batch
+                ]
+                metrics.incr("webhook_events_total", len(batch), outcome="held")
+            elif error is None:
+                outcomes = [(event.id, event.created_at, True, event.attempts + 1, None, None) for event in batch]
+                metrics.incr("webhook_events_total", len(batch), outcome="delivered")
+            else:
+                for event in batch:
+                    attempts = event.attempts + 1
+                    exhausted = attempts >= settings.WEBHOOK_MAX_ATTEMPTS
+                    delay = max(retry_delay(attempts), retry_after or 0.0)
+                    outcomes.append((
+                        event.id, event.created_at, exhausted, attempts,
+                        None if exhausted else now + timedelta(seconds=delay), error[:200]
+                    ))
+                metrics.incr("webhook_events_total", len(batch), outcome="failed")
+                logger.warning(f"Webhook batch of {len(batch)} events to {url} failed: {error}")
+
+            await asyncio.to_thread(record_outcomes, outcomes)
+        except Exception as e:
+            # The events stay leased and are claimed again once the lease runs out
+            logger.error(f"Failed to record webhook outcomes for {url}: {str(e)}")
+        finally:
+            self.in_flight -= len(batch)
+
+    async def aclose(self):
+        """Wait for the deliveries in flight, then close the connection pools"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+async def dispatch_events(stopping: asyncio.Event):
+    registry = get_registry()
+    # Loaded before the first claim, so no registered webhook looks removed
+    await asyncio.to_thread(registry.reload)
+    listener = asyncio.create_task(registry.listen())
+    dispatcher = WebhookDispatcher()
+    try:
+        while not stopping.is_set():
+            limit = min(settings.WEBHOOK_CLAIM_BATCH_SIZE, settings.WEBHOOK_MAX_IN_FLIGHT - dispatcher.in_flight)
+            claimed = []
+            if limit > 0:
+                try:
+                    claimed = await asyncio.to_thread(claim, limit)
+                except Exception as e:
+                    logger.error(f"Failed to claim webhook events: {str(e)}")
+            dispatcher.dispatch(claimed)
+
+            # A full claim means a backlog; take the next batch straight away
+            if len(claimed) < settings.WEBHOOK_CLAIM_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(stopping.wait(), settings.WEBHOOK_COALESCE_WINDOW)
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        listener.cancel()
+        await dispatcher.aclose()
+
+def run():
+    loop = asyncio.new_event_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    logger.info("Webhook dispatcher started")
+    try:
+        loop.run_until_complete(dispatch_events(stopping))
+    finally:
+        loop.close()
+    logger.info("Webhook dispatcher stopped")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()